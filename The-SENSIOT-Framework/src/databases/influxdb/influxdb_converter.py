@@ -7,34 +7,46 @@ logger = logging.getLogger("sensiot")
 logger.setLevel(logging.DEBUG)
 
 
+# Optional window statistics emitted by the fog nodes, written as extra fields
+# when present
+STATISTIC_FIELDS = tuple(
+    f"{statistic}_{metric}"
+    for metric in ("temperature", "humidity")
+    for statistic in ("min", "max", "var", "p50", "p95", "p99")
+)
+
+
 class InfluxDBConverter:
+    @staticmethod
+    def _timestamp_to_iso(ts):
+        if isinstance(ts, (int, float)):
+            dt = datetime.fromtimestamp(ts, tz=timezone.utc)
+            return dt.isoformat()
+        if isinstance(ts, str):
+            ts = ts.strip()  # remove any trailing whitespace
+            # If the string uses a space between date and time, replace it with 'T'
+            if 'T' not in ts:
+                ts = ts.replace(' ', 'T', 1)
+            try:
+                dt = datetime.fromisoformat(ts)
+            except Exception as e:
+                logger.error(f"fromisoformat failed for timestamp '{ts}': {e}")
+                # Fallback: try interpreting the string as an epoch float
+                dt = datetime.utcfromtimestamp(float(ts))
+            return dt.replace(tzinfo=timezone.utc).isoformat()
+        raise ValueError("Timestamp format not recognized")
+
     @staticmethod
     def convert_to_influxdb_format(payload):
         """
         Convert an aggregated payload to an InfluxDB Point.
         Expects keys: device_id, device_name, region, avg_temperature, avg_humidity, timestamp, and event.
+        sample_count and the STATISTIC_FIELDS (min/max/variance/percentiles) are added when present.
         If the timestamp is numeric (epoch), it is converted to an ISO8601 string in UTC.
         If the timestamp is a string that does not include 'T' as the separator, it replaces the first space with 'T'.
         """
         try:
-            ts = payload.get("timestamp")
-            if isinstance(ts, (int, float)):
-                dt = datetime.fromtimestamp(ts, tz=timezone.utc)
-                ts_iso = dt.isoformat()
-            elif isinstance(ts, str):
-                ts = ts.strip()  # remove any trailing whitespace
-                # If the string uses a space between date and time, replace it with 'T'
-                if 'T' not in ts:
-                    ts = ts.replace(' ', 'T', 1)
-                try:
-                    dt = datetime.fromisoformat(ts)
-                except Exception as e:
-                    logger.error(f"fromisoformat failed for timestamp '{ts}': {e}")
-                    # Fallback: try interpreting the string as an epoch float
-                    dt = datetime.utcfromtimestamp(float(ts))
-                ts_iso = dt.replace(tzinfo=timezone.utc).isoformat()
-            else:
-                raise ValueError("Timestamp format not recognized")
+            ts_iso = InfluxDBConverter._timestamp_to_iso(payload.get("timestamp"))
 
             temperature = float(payload.get("avg_temperature", 0))
             avg_humidity = float(payload.get("avg_humidity", 0))
@@ -48,9 +60,38 @@ class InfluxDBConverter:
                 .field("avg_humidity", avg_humidity)
                 .field("event", 1 if payload.get("event") else 0)
             )
+            if payload.get("sample_count") is not None:
+                point.field("sample_count", int(payload["sample_count"]))
+            for field in STATISTIC_FIELDS:
+                value = payload.get(field)
+                if value is not None:
+                    point.field(field, float(value))
             point.time(ts_iso)
             logger.debug(f"Created InfluxDB point: {point.to_line_protocol()}")
             return point
         except Exception as e:
             logger.error(f"Failed to convert payload to InfluxDB format: {e}")
             return None
+
+    @staticmethod
+    def convert_event_to_influxdb_format(payload):
+        """
+        Convert a single event reading from a fog node's priority outbox
+        (``kind: "event"``) to a point in the sensor_events measurement, so it
+        is never mistaken for a window aggregate.
+        """
+        try:
+            point = (
+                Point("sensor_events")
+                .tag("device_id", payload.get("device_id", "unknown"))
+                .tag("device_name", payload.get("device_name", "unknown"))
+                .tag("region", payload.get("region", "unknown"))
+                .field("temperature", float(payload["temperature"]))
+                .field("humidity", float(payload["humidity"]))
+            )
+            point.time(InfluxDBConverter._timestamp_to_iso(payload.get("timestamp")))
+            logger.debug(f"Created InfluxDB event point: {point.to_line_protocol()}")
+            return point
+        except Exception as e:
+            logger.error(f"Failed to convert event payload to InfluxDB format: {e}")
+            return None
@@ -1,9 +1,9 @@
 import time
 import logging
 import threading
-import json
 import os
 from databases.influxdb.influxdb_converter import InfluxDBConverter
+from utilities import codec
 from influxdb_client import InfluxDBClient
 from influxdb_client.client.write_api import SYNCHRONOUS
 
@@ -66,16 +66,18 @@ class InfluxDBWriter(threading.Thread):
                     payload = self.queue.get()
                     logger.debug(f"Fetched payload from Memcached: {payload}")
 
-                    if isinstance(payload, str):
+                    if isinstance(payload, (str, bytes)):
                         try:
-                            payload = json.loads(payload)
+                            payload = codec.loads(payload)
                             logger.debug(f"Converted JSON string to dictionary: {payload}")
-                        except json.JSONDecodeError:
+                        except codec.JSONDecodeError:
                             logger.error(f"Error decoding JSON payload: {payload}")
                             continue
 
                     influx_data = None
-                    if "avg_temperature" in payload:
+                    if payload.get("kind") == "event":
+                        influx_data = InfluxDBConverter.convert_event_to_influxdb_format(payload)
+                    elif "avg_temperature" in payload:
                         influx_data = InfluxDBConverter.convert_to_influxdb_format(payload)
                     elif "battery_data" in payload:
                         influx_data = InfluxDBConverter.convert_battery_to_influxdb_format(payload)
@@ -1,8 +1,8 @@
 import logging
 import threading
 import time
-import json
 import memcache
+from utilities import codec
 
 logger = logging.getLogger("sensiot")
 logger.setLevel(logging.INFO)
@@ -41,11 +41,11 @@ class MemcacheReader(threading.Thread):
 
                     if payload:
                         # Ensure JSON parsing
-                        if isinstance(payload, str):
+                        if isinstance(payload, (str, bytes)):
                             try:
-                                payload = json.loads(payload)
+                                payload = codec.loads(payload)
                                 logger.debug(f"Converted JSON string to dictionary: {payload}")
-                            except json.JSONDecodeError:
+                            except codec.JSONDecodeError:
                                 logger.error(f"Failed to parse JSON from Memcached: {payload}")
                                 continue
 
@@ -0,0 +1,45 @@
+import json
+import unittest
+from unittest import mock
+
+from utilities import codec
+
+AGGREGATE = {
+    "aggregate_id": "eu868-1760793600:0101010101010142",
+    "device_id": "0101010101010142",
+    "region": "eu868",
+    "avg_temperature": 23.4,
+    "avg_humidity": 51.2,
+    "event": False,
+}
+
+
+class CodecTests(unittest.TestCase):
+    def assert_round_trip(self):
+        raw = json.dumps(AGGREGATE).encode("utf-8")
+        for payload in (raw, bytearray(raw), memoryview(raw), raw.decode("utf-8")):
+            with self.subTest(type=type(payload).__name__):
+                self.assertEqual(codec.loads(payload), AGGREGATE)
+        encoded = codec.dumps(AGGREGATE)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), AGGREGATE)
+
+    def test_active_backend_decodes_payload_buffers(self):
+        self.assert_round_trip()
+
+    def test_standard_library_fallback(self):
+        with mock.patch.object(codec, "orjson", None):
+            self.assertEqual(codec.backend(), "json")
+            self.assert_round_trip()
+            self.assertEqual(codec.dumps({"a": 1}), b'{"a":1}')
+
+    def test_invalid_json_raises_json_decode_error(self):
+        with self.assertRaises(codec.JSONDecodeError):
+            codec.loads(b"{not json")
+        with mock.patch.object(codec, "orjson", None):
+            with self.assertRaises(codec.JSONDecodeError):
+                codec.loads(b"{not json")
+
+
+if __name__ == "__main__":
+    unittest.main()
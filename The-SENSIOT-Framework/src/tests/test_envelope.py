@@ -0,0 +1,106 @@
+import importlib.util
+import json
+import os
+import queue
+import sys
+import unittest
+import zlib
+from types import SimpleNamespace
+from unittest import mock
+
+from prometheus_client import REGISTRY
+
+from utilities import codec
+from utilities.mqtt.envelope import decode_envelope, is_envelope
+from utilities.mqtt.mqtt_reader import MqttReader
+
+AGGREGATES = [
+    {
+        "aggregate_id": f"eu868-1760793600:device-{index}",
+        "device_id": f"device-{index}",
+        "region": "eu868",
+        "avg_temperature": 20.5 + index,
+    }
+    for index in range(3)
+]
+
+FOG_ENVELOPE = os.path.join(
+    os.path.dirname(__file__), "..", "..", "..", "fog-nodes", "envelope.py"
+)
+
+
+def _envelope(body, compression_code=1, version=1):
+    return b"SNVE" + bytes([version, compression_code]) + body
+
+
+def _fog_node_envelope_module():
+    """Load the fog node's encoder when the fog-nodes tree sits next to SensIoT."""
+    spec = importlib.util.spec_from_file_location("fog_envelope", FOG_ENVELOPE)
+    module = importlib.util.module_from_spec(spec)
+    # The fog node imports its own copy of the codec as a top-level module
+    with mock.patch.dict(sys.modules, {"codec": codec}):
+        spec.loader.exec_module(module)
+    return module
+
+
+class EnvelopeDecoderTests(unittest.TestCase):
+    def test_plain_and_zlib_bodies_are_decoded(self):
+        body = json.dumps(AGGREGATES).encode("utf-8")
+        self.assertEqual(decode_envelope(_envelope(body, 0)), AGGREGATES)
+        self.assertEqual(decode_envelope(_envelope(zlib.compress(body), 1)), AGGREGATES)
+
+    def test_plain_json_aggregate_is_not_an_envelope(self):
+        self.assertFalse(is_envelope(json.dumps(AGGREGATES[0]).encode("utf-8")))
+
+    def test_unknown_version_and_compression_are_rejected(self):
+        body = json.dumps(AGGREGATES).encode("utf-8")
+        for payload in (_envelope(body, 0, version=99), _envelope(body, 9), b"SNVE"):
+            with self.subTest(payload=payload[:6]):
+                with self.assertRaises(ValueError):
+                    decode_envelope(payload)
+
+
+class MqttReaderEnvelopeTests(unittest.TestCase):
+    def setUp(self):
+        config = {
+            "broker": "localhost",
+            "port": 1883,
+            "topics": {"processed_topic": "central/data"},
+            "connection": {"keepalive": 60},
+        }
+        with mock.patch.dict(os.environ, {"MQTT_TLS_ENABLED": "false"}):
+            self.reader = MqttReader("MQTT Reader", None, queue.Queue(), config)
+
+    def receive(self, payload):
+        message = SimpleNamespace(topic="central/data", payload=payload)
+        self.reader._MqttReader__on_message(None, None, message)
+        queued = []
+        while not self.reader.queue.empty():
+            queued.append(self.reader.queue.get_nowait())
+        return queued
+
+    def dropped(self):
+        return REGISTRY.get_sample_value(
+            "sensiot_dropped_messages_total", {"region": "unknown", "device_id": "unknown"}
+        ) or 0
+
+    @unittest.skipUnless(os.path.exists(FOG_ENVELOPE), "fog-nodes tree is not checked out")
+    def test_fog_node_envelopes_are_unpacked_into_separate_aggregates(self):
+        fog_envelope = _fog_node_envelope_module()
+        for compression in ("none", "zlib"):
+            with self.subTest(compression=compression):
+                payload = fog_envelope.encode_envelope(AGGREGATES, compression)
+                self.assertEqual(self.receive(payload), AGGREGATES)
+
+    def test_plain_json_aggregates_are_still_accepted(self):
+        self.assertEqual(self.receive(codec.dumps(AGGREGATES[0])), [AGGREGATES[0]])
+
+    def test_corrupt_envelope_is_dropped(self):
+        before = self.dropped()
+
+        self.assertEqual(self.receive(_envelope(b"not zlib", 1)), [])
+        self.assertEqual(self.dropped(), before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+"""
+JSON codec for the per-message hot paths.
+
+A copy of ``fog-nodes/codec.py``: SensIoT and the fog nodes are built as
+separate images, so each carries its own. Change both together.
+
+Uses orjson when it is installed and the standard library otherwise. ``loads``
+accepts ``bytes``, ``bytearray``, ``memoryview`` or ``str``, so MQTT payloads
+are decoded without a ``.decode()`` copy. ``dumps`` always returns compact
+UTF-8 ``bytes``.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; the standard library always works
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause
+# covers both backends
+JSONDecodeError = json.JSONDecodeError
+
+
+def backend():
+    return "orjson" if orjson is not None else "json"
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
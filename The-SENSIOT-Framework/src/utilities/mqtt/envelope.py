@@ -0,0 +1,50 @@
+"""
+Decoder for the batched aggregate envelope published by fog nodes.
+
+An envelope packs many aggregate messages into one MQTT payload:
+
+    b"SNVE" | version (1 byte) | compression (1 byte) | body
+
+The body is a JSON array of aggregates, optionally compressed. Plain JSON
+aggregates start with ``{`` and can never be mistaken for an envelope, so
+consumers can accept both formats during a rollout.
+
+The decoding half of ``fog-nodes/envelope.py``, copied because SensIoT and
+the fog nodes are built as separate images. Change both together.
+"""
+import zlib
+
+from utilities import codec
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional; zlib is always available
+    zstandard = None
+
+ENVELOPE_MAGIC = b"SNVE"
+ENVELOPE_VERSION = 1
+COMPRESSION_CODES = {"none": 0, "zlib": 1, "zstd": 2}
+_HEADER_SIZE = len(ENVELOPE_MAGIC) + 2
+
+
+def is_envelope(payload):
+    return bytes(payload[: len(ENVELOPE_MAGIC)]) == ENVELOPE_MAGIC
+
+
+def decode_envelope(payload):
+    if not is_envelope(payload) or len(payload) < _HEADER_SIZE:
+        raise ValueError("Payload is not an aggregate envelope")
+    version = payload[len(ENVELOPE_MAGIC)]
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f"Unsupported aggregate envelope version {version}")
+    compression = payload[len(ENVELOPE_MAGIC) + 1]
+    body = memoryview(payload)[_HEADER_SIZE:]
+    if compression == COMPRESSION_CODES["zlib"]:
+        body = zlib.decompress(body)
+    elif compression == COMPRESSION_CODES["zstd"]:
+        if zstandard is None:
+            raise ValueError("Aggregate envelope uses zstd but zstandard is not installed")
+        body = zstandard.ZstdDecompressor().decompress(body)
+    elif compression != COMPRESSION_CODES["none"]:
+        raise ValueError(f"Unknown aggregate envelope compression code {compression}")
+    return codec.loads(body)
@@ -1,11 +1,12 @@
 import logging
 import os
 import threading
-import json
 import paho.mqtt.client as mqtt
 from datetime import datetime
 # Import the counters from metrics.py
 from metrics import received_counter, dropped_counter
+from utilities import codec
+from utilities.mqtt.envelope import decode_envelope, is_envelope
 from utilities.mqtt.mqtt_tls import configure_mqtt_tls
 
 logger = logging.getLogger("sensiot")
@@ -67,24 +68,36 @@ class MqttReader(threading.Thread):
         """Handle received MQTT messages with enriched payload."""
         logger.info(f"Message received from MQTT topic {msg.topic}")
         try:
-            data = msg.payload.decode()
-            parsed_data = json.loads(data)
-            logger.debug(f"Parsed data keys: {parsed_data.keys()}")
-            device_id = self.__extract_device_id(parsed_data)
-            region = parsed_data.get("region", "unknown")
-
-            # Increment Prometheus counter
-            received_counter.labels(region=region, device_id=device_id).inc()
-
-            # Queue the enriched data for further processing
-            self.queue.put(parsed_data)
-            logger.info(f"Enriched data queued for device_id={device_id}, region={region}")
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON decoding failed: {e}")
+            # Fog nodes may pack many aggregates into one envelope
+            if is_envelope(msg.payload):
+                messages = decode_envelope(msg.payload)
+                logger.debug(f"Unpacked envelope with {len(messages)} aggregate(s)")
+            else:
+                messages = [codec.loads(msg.payload)]
+        except (codec.JSONDecodeError, ValueError) as e:
+            logger.error(f"Payload decoding failed: {e}")
             dropped_counter.labels(region="unknown", device_id="unknown").inc()
+            return
         except Exception as e:
             logger.error(f"Error while processing message: {e}")
             dropped_counter.labels(region="unknown", device_id="unknown").inc()
+            return
+
+        for parsed_data in messages:
+            try:
+                logger.debug(f"Parsed data keys: {parsed_data.keys()}")
+                device_id = self.__extract_device_id(parsed_data)
+                region = parsed_data.get("region", "unknown")
+
+                # Increment Prometheus counter
+                received_counter.labels(region=region, device_id=device_id).inc()
+
+                # Queue the enriched data for further processing
+                self.queue.put(parsed_data)
+                logger.info(f"Enriched data queued for device_id={device_id}, region={region}")
+            except Exception as e:
+                logger.error(f"Error while processing message: {e}")
+                dropped_counter.labels(region="unknown", device_id="unknown").inc()
 
     def run(self):
         """Start the MQTT client and subscribe to the topic."""
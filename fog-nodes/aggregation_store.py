@@ -1,84 +1,827 @@
 import hashlib
-import json
+import math
+import os
+import socket
 import time
 import uuid
+from collections import namedtuple
 from datetime import datetime, timezone
 
 import redis
+from redis.cluster import ClusterNode, RedisCluster
+from redis.exceptions import NoScriptError
 from redis.sentinel import Sentinel
 
+import codec
+from metrics import stage_timers
+from uplink import HUMIDITY_RANGE, TEMPERATURE_RANGE, normalize_region
 
+
+# Deduplication backends define accept_reading(keys, args), which is prepended
+# to the update and merge scripts. It returns true when the reading is new.
+_ACCEPT_READING_BY_KEY = """
+local function accept_reading(keys, args)
+    return redis.call('SET', keys[1], '1', 'NX', 'EX', args[1])
+end
+"""
+
+
+_ACCEPT_READING_BY_BLOOM = """
+local function accept_reading(keys, args)
+    for k = 1, #keys do
+        local seen = true
+        for i = 2, #args do
+            if redis.call('GETBIT', keys[k], args[i]) == 0 then
+                seen = false
+                break
+            end
+        end
+        if seen then
+            return false
+        end
+    end
+    for i = 2, #args do
+        redis.call('SETBIT', keys[1], args[i], 1)
+    end
+    redis.call('EXPIRE', keys[1], args[1])
+    return true
+end
+"""
+
+
+# Window snapshots bump a region's generation, so readings that arrive while a
+# frozen window is drained land in new keys. Generation 0 keeps the original
+# key names.
+_AGGREGATE_KEY = """
+local function aggregate_key(base_key, generation)
+    if not generation or generation == '0' then
+        return base_key
+    end
+    return base_key .. ':g' .. generation
+end
+"""
+
+
+# Per-metric window statistics kept next to the sums in the aggregate hash:
+# <metric>_min, <metric>_max, <metric>_sq_sum and, with a quantile sketch,
+# <metric>_q:<bucket> counts over fixed-width buckets of the metric's valid
+# range. Every field is O(1) to update and merges by addition or comparison.
+_STATISTICS = """
+local function format_number(value)
+    return string.format('%.17g', value)
+end
+
+local function sketch_bucket(metric, value)
+    local range = SKETCH_RANGES[metric]
+    local bucket = math.floor((value - range[1]) / range[2])
+    return math.max(0, math.min(QUANTILE_BUCKETS - 1, bucket))
+end
+
+local function new_statistics()
+    return {count = 0, sq_sum = 0, buckets = {}}
+end
+
+local function add_value(statistics, metric, value)
+    if statistics.count == 0 or value < statistics.min then
+        statistics.min = value
+    end
+    if statistics.count == 0 or value > statistics.max then
+        statistics.max = value
+    end
+    statistics.count = statistics.count + 1
+    statistics.sq_sum = statistics.sq_sum + value * value
+    if QUANTILE_BUCKETS > 0 then
+        local bucket = sketch_bucket(metric, value)
+        statistics.buckets[bucket] = (statistics.buckets[bucket] or 0) + 1
+    end
+end
+
+local function store_statistics(key, metric, statistics)
+    local current = redis.call('HMGET', key, metric .. '_min', metric .. '_max')
+    if not current[1] or statistics.min < tonumber(current[1]) then
+        redis.call('HSET', key, metric .. '_min', format_number(statistics.min))
+    end
+    if not current[2] or statistics.max > tonumber(current[2]) then
+        redis.call('HSET', key, metric .. '_max', format_number(statistics.max))
+    end
+    redis.call('HINCRBYFLOAT', key, metric .. '_sq_sum', format_number(statistics.sq_sum))
+    for bucket, count in pairs(statistics.buckets) do
+        redis.call('HINCRBY', key, metric .. '_q:' .. bucket, count)
+    end
+end
+
+local function sketch_quantile(counts, total, fraction)
+    local rank = math.max(math.ceil(total * fraction), 1)
+    local seen = 0
+    for bucket = 0, QUANTILE_BUCKETS - 1 do
+        seen = seen + (counts[bucket] or 0)
+        if seen >= rank then
+            return bucket
+        end
+    end
+    return QUANTILE_BUCKETS - 1
+end
+
+local function add_statistics(message, aggregate, metric, count)
+    local low = aggregate[metric .. '_min']
+    if low then
+        local mean = tonumber(aggregate[metric .. '_sum']) / count
+        local sq_sum = tonumber(aggregate[metric .. '_sq_sum'])
+        message['min_' .. metric] = tonumber(low)
+        message['max_' .. metric] = tonumber(aggregate[metric .. '_max'])
+        message['sum_sq_' .. metric] = sq_sum
+        message['var_' .. metric] = math.max(sq_sum / count - mean * mean, 0)
+    end
+    if QUANTILE_BUCKETS == 0 then
+        return
+    end
+    local counts = {}
+    local sparse = {}
+    local total = 0
+    for bucket = 0, QUANTILE_BUCKETS - 1 do
+        local bucket_count = tonumber(aggregate[metric .. '_q:' .. bucket])
+        if bucket_count then
+            counts[bucket] = bucket_count
+            sparse[tostring(bucket)] = bucket_count
+            total = total + bucket_count
+        end
+    end
+    if total == 0 then
+        return
+    end
+    local range = SKETCH_RANGES[metric]
+    message[metric .. '_sketch'] = {
+        low = range[1], width = range[2], counts = sparse
+    }
+    for _, percentile in ipairs(QUANTILES) do
+        local bucket = sketch_quantile(counts, total, percentile / 100)
+        message['p' .. percentile .. '_' .. metric] = range[1] + (bucket + 0.5) * range[2]
+    end
+end
+"""
+
+
+_ADD_READING = """
+local function add_reading(key, temperature, humidity, device_id, device_name, region, event)
+    redis.call('HINCRBYFLOAT', key, 'temperature_sum', temperature)
+    redis.call('HINCRBYFLOAT', key, 'humidity_sum', humidity)
+    redis.call('HINCRBY', key, 'count', 1)
+    local temperature_statistics = new_statistics()
+    add_value(temperature_statistics, 'temperature', tonumber(temperature))
+    store_statistics(key, 'temperature', temperature_statistics)
+    local humidity_statistics = new_statistics()
+    add_value(humidity_statistics, 'humidity', tonumber(humidity))
+    store_statistics(key, 'humidity', humidity_statistics)
+    redis.call('HSET', key, 'device_id', device_id, 'device_name', device_name, 'region', region)
+    if event == '1' then
+        redis.call('HSET', key, 'event', 1)
+    end
+end
+"""
+
+
+# Consumer group every replica reads the stream outbox through
+OUTBOX_GROUP = "fog-outbox"
+
+# Every script appends to an outbox through outbox_add. The ZSET outbox scores
+# a message by the time it is due; the stream outbox ignores the score because
+# entries are handed out through a consumer group and redelivered by idle time.
+# Acknowledged entries are deleted but the stream key stays, so the group is
+# created only with the stream.
+_OUTBOX_ADD = {
+    "zset": """
+local function outbox_add(key, score, message)
+    redis.call('ZADD', key, score, cjson.encode(message))
+end
+""",
+    "stream": f"""
+local function outbox_add(key, score, message)
+    if redis.call('EXISTS', key) == 0 then
+        redis.call('XGROUP', 'CREATE', key, '{OUTBOX_GROUP}', '0', 'MKSTREAM')
+    end
+    redis.call('XADD', key, '*', 'payload', cjson.encode(message))
+end
+""",
+}
+
+
+# Scripts that queue messages top the region's wake list up to one token per
+# replica registered in its waiters set, so every idle replica blocked in
+# wait_for_outbox drains at once. With no waiter one token is kept for the
+# next replica to wait. The waiters key shares the wake key's hash tag.
+_WAKE_OUTBOX = """
+local function wake_outbox(key)
+    local tokens = math.max(redis.call('ZCARD', key .. ':waiters'), 1)
+    for _ = redis.call('LLEN', key) + 1, tokens do
+        redis.call('LPUSH', key, '1')
+    end
+end
+"""
+
+
+# Event readings are also queued on their own in the region's priority
+# outbox, so they reach central without waiting for the window to close.
+_QUEUE_PRIORITY_READING = """
+local function queue_priority_reading(outbox_key, wake_key, args, timestamp, now)
+    local reading_id = args[7]
+    if reading_id == '' then
+        reading_id = args[3] .. ':' .. timestamp
+    end
+    local message = {
+        kind = 'event',
+        aggregate_id = 'event:' .. reading_id,
+        device_id = args[3],
+        device_name = args[4],
+        region = args[5],
+        temperature = tonumber(args[1]),
+        humidity = tonumber(args[2]),
+        event = true,
+        timestamp = tonumber(timestamp),
+        queued_at = tonumber(now)
+    }
+    outbox_add(outbox_key, now, message)
+    wake_outbox(wake_key)
+end
+"""
+
+
+# KEYS: aggregate, index, generation, priority outbox, wake list, dedupe keys
+# ARGV: temperature, humidity, device id, device name, region, event flag,
+# reading id, reading time, now, priority flag, dedupe args
 _UPDATE_AGGREGATE = """
 if ARGV[7] ~= '' then
-    local accepted = redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[8])
-    if not accepted then
+    if not accept_reading({unpack(KEYS, 6)}, {unpack(ARGV, 11)}) then
         return 0
     end
 end
 
-redis.call('HINCRBYFLOAT', KEYS[1], 'temperature_sum', ARGV[1])
-redis.call('HINCRBYFLOAT', KEYS[1], 'humidity_sum', ARGV[2])
-redis.call('HINCRBY', KEYS[1], 'count', 1)
-redis.call('HSET', KEYS[1], 'device_id', ARGV[3], 'device_name', ARGV[4], 'region', ARGV[5])
-if ARGV[6] == '1' then
-    redis.call('HSET', KEYS[1], 'event', 1)
-end
+local key = aggregate_key(KEYS[1], redis.call('GET', KEYS[3]))
+add_reading(key, ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6])
 redis.call('SADD', KEYS[2], ARGV[3])
+if ARGV[6] == '1' and ARGV[10] == '1' then
+    queue_priority_reading(KEYS[4], KEYS[5], ARGV, ARGV[8], ARGV[9])
+end
+return 1
+"""
+
+
+# Event-time windows are identified by their start in epoch seconds. Each
+# keeps per-device aggregates under <window prefix><start>:<device_id> and a
+# <start>:index set. Open windows are scored by their end; once the region's
+# watermark passes the end they are emitted and kept, scored by end plus the
+# allowed lateness, so late readings can still amend them. A reading is only
+# too late once its window is neither open nor within the allowed lateness:
+# the watermark follows the newest reading of any device in the region, so a
+# window it has passed may still wait for the next flush. With an idle
+# timeout the watermark never trails the node's clock by more than the delay
+# plus that timeout, so a region that stops sending still emits its windows.
+_EVENT_WINDOWS = """
+local function event_watermark(clock_key, now, delay, idle_timeout)
+    local newest = tonumber(redis.call('GET', clock_key))
+    local watermark = newest and math.min(newest, now) - delay
+    if idle_timeout > 0 then
+        watermark = math.max(watermark or -math.huge, now - delay - idle_timeout)
+    end
+    return watermark
+end
+
+local function window_starts(timestamp, size, slide)
+    local starts = {}
+    local start = math.floor(timestamp / slide) * slide
+    while start > timestamp - size do
+        starts[#starts + 1] = start
+        start = start - slide
+    end
+    return starts
+end
+"""
+
+
+# KEYS: open windows, closed windows, event clock, amended windows, priority
+# outbox, wake list, dedupe keys
+# ARGV: reading (as _UPDATE_AGGREGATE), event time, now, size, slide,
+# allowed lateness, watermark delay, max clock skew, window prefix, priority
+# flag, idle timeout, dedupe args
+# Returns 1 when applied, 0 for a duplicate and -1 when too late or too early.
+_UPDATE_EVENT_AGGREGATE = """
+local timestamp = tonumber(ARGV[8])
+local now = tonumber(ARGV[9])
+local size = tonumber(ARGV[10])
+local lateness = tonumber(ARGV[12])
+local delay = tonumber(ARGV[13])
+local skew = tonumber(ARGV[14])
+if timestamp > now + skew then
+    return -1
+end
+-- Without an idle timeout the region's first reading has no watermark; judge
+-- it against the node's clock, allowing a device clock behind by the skew cap
+local watermark = event_watermark(KEYS[3], now, delay, tonumber(ARGV[17]))
+    or now - skew - delay
+local starts = {}
+for _, start in ipairs(window_starts(timestamp, size, tonumber(ARGV[11]))) do
+    if start + size + lateness > watermark
+            or redis.call('ZSCORE', KEYS[1], start) then
+        starts[#starts + 1] = start
+    end
+end
+if #starts == 0 then
+    return -1
+end
+
+if ARGV[7] ~= '' then
+    if not accept_reading({unpack(KEYS, 7)}, {unpack(ARGV, 18)}) then
+        return 0
+    end
+end
+
+for _, start in ipairs(starts) do
+    local window = ARGV[15] .. start
+    add_reading(window .. ':' .. ARGV[3], ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5], ARGV[6])
+    redis.call('SADD', window .. ':index', ARGV[3])
+    if redis.call('ZSCORE', KEYS[2], start) then
+        redis.call('SADD', window .. ':amended', ARGV[3])
+        redis.call('SADD', KEYS[4], start)
+    else
+        redis.call('ZADD', KEYS[1], start + size, start)
+    end
+end
+local newest = tonumber(redis.call('GET', KEYS[3]))
+if not newest or timestamp > newest then
+    redis.call('SET', KEYS[3], ARGV[8])
+end
+if ARGV[6] == '1' and ARGV[16] == '1' then
+    queue_priority_reading(KEYS[5], KEYS[6], ARGV, ARGV[8], ARGV[9])
+end
 return 1
 """
 
 
+_MERGE_AGGREGATE = """
+local shared_key_count = tonumber(ARGV[4])
+local reading_key_count = tonumber(ARGV[5])
+local reading_arg_count = tonumber(ARGV[6])
+local stride = 4 + reading_arg_count
+
+local accepted = {}
+local temperature_sum = 0
+local humidity_sum = 0
+local temperature = new_statistics()
+local humidity = new_statistics()
+local count = 0
+local event = false
+for i = 1, (#ARGV - 6) / stride do
+    local base = 7 + (i - 1) * stride
+    local is_new = true
+    if ARGV[base] ~= '' then
+        local dedupe_keys = {}
+        for k = 1, shared_key_count do
+            dedupe_keys[k] = KEYS[3 + k]
+        end
+        local first_key = 4 + shared_key_count + (i - 1) * reading_key_count
+        for k = 0, reading_key_count - 1 do
+            dedupe_keys[#dedupe_keys + 1] = KEYS[first_key + k]
+        end
+        is_new = accept_reading(
+            dedupe_keys, {unpack(ARGV, base + 4, base + 3 + reading_arg_count)}
+        )
+    end
+    if is_new then
+        temperature_sum = temperature_sum + tonumber(ARGV[base + 1])
+        humidity_sum = humidity_sum + tonumber(ARGV[base + 2])
+        add_value(temperature, 'temperature', tonumber(ARGV[base + 1]))
+        add_value(humidity, 'humidity', tonumber(ARGV[base + 2]))
+        count = count + 1
+        if ARGV[base + 3] == '1' then
+            event = true
+        end
+        accepted[i] = 1
+    else
+        accepted[i] = 0
+    end
+end
+
+if count > 0 then
+    local key = aggregate_key(KEYS[1], redis.call('GET', KEYS[3]))
+    redis.call('HINCRBYFLOAT', key, 'temperature_sum', string.format('%.17g', temperature_sum))
+    redis.call('HINCRBYFLOAT', key, 'humidity_sum', string.format('%.17g', humidity_sum))
+    redis.call('HINCRBY', key, 'count', count)
+    store_statistics(key, 'temperature', temperature)
+    store_statistics(key, 'humidity', humidity)
+    redis.call('HSET', key, 'device_id', ARGV[1], 'device_name', ARGV[2], 'region', ARGV[3])
+    if event then
+        redis.call('HSET', key, 'event', 1)
+    end
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+return accepted
+"""
+
+
+_QUEUE_AGGREGATE = """
+local function build_aggregate(key, device_id, window_id, timestamp)
+    local values = redis.call('HGETALL', key)
+    if #values == 0 then
+        return nil
+    end
+    local aggregate = {}
+    for i = 1, #values, 2 do
+        aggregate[values[i]] = values[i + 1]
+    end
+
+    local count = tonumber(aggregate['count'])
+    if not count or count <= 0 then
+        return nil
+    end
+    local message = {
+        aggregate_id = window_id .. ':' .. device_id,
+        device_id = device_id,
+        device_name = aggregate['device_name'],
+        region = aggregate['region'],
+        avg_temperature = tonumber(aggregate['temperature_sum']) / count,
+        avg_humidity = tonumber(aggregate['humidity_sum']) / count,
+        sample_count = count,
+        timestamp = timestamp,
+        event = aggregate['event'] == '1'
+    }
+    add_statistics(message, aggregate, 'temperature', count)
+    add_statistics(message, aggregate, 'humidity', count)
+    return message
+end
+
+local function queue_aggregate(key, device_id, outbox_key, window_id, timestamp, score)
+    local message = build_aggregate(key, device_id, window_id, timestamp)
+    local queued = 0
+    if message then
+        outbox_add(outbox_key, score, message)
+        queued = 1
+    end
+    redis.call('DEL', key)
+    return queued
+end
+"""
+
+
 _FLUSH_WINDOW = """
 local marker_set = redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[4])
 if not marker_set then
     return -1
 end
 
+local generation = redis.call('GET', KEYS[4])
 local device_ids = redis.call('SMEMBERS', KEYS[1])
 local queued = 0
 for _, device_id in ipairs(device_ids) do
-    local aggregate_key = ARGV[1] .. device_id
-    local values = redis.call('HGETALL', aggregate_key)
-    if #values > 0 then
-        local aggregate = {}
-        for i = 1, #values, 2 do
-            aggregate[values[i]] = values[i + 1]
-        end
+    queued = queued + queue_aggregate(
+        aggregate_key(ARGV[1] .. device_id, generation),
+        device_id, KEYS[2], ARGV[2], ARGV[3], ARGV[5]
+    )
+end
+redis.call('DEL', KEYS[1])
+if queued > 0 then
+    wake_outbox(KEYS[5])
+end
+return queued
+"""
+
+
+# Freeze the live window in O(1): bump the generation so new readings use new
+# aggregate keys, and rename the index to a frozen copy that is drained later.
+_SNAPSHOT_WINDOW = """
+local marker_set = redis.call('SET', KEYS[3], '1', 'NX', 'EX', ARGV[4])
+if not marker_set then
+    return -1
+end
+
+local generation = redis.call('GET', KEYS[2]) or '0'
+redis.call('INCR', KEYS[2])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local frozen_index = ARGV[1] .. generation
+redis.call('RENAME', KEYS[1], frozen_index)
+redis.call('ZADD', KEYS[4], ARGV[5], cjson.encode({
+    generation = generation,
+    index = frozen_index,
+    window_id = ARGV[2],
+    timestamp = ARGV[3]
+}))
+return redis.call('SCARD', frozen_index)
+"""
+
 
-        local count = tonumber(aggregate['count'])
-        if count and count > 0 then
-            local message = {
-                aggregate_id = ARGV[2] .. ':' .. device_id,
-                device_id = device_id,
-                device_name = aggregate['device_name'],
-                region = aggregate['region'],
-                avg_temperature = tonumber(aggregate['temperature_sum']) / count,
-                avg_humidity = tonumber(aggregate['humidity_sum']) / count,
-                sample_count = count,
-                timestamp = ARGV[3],
-                event = aggregate['event'] == '1'
-            }
-            redis.call('ZADD', KEYS[2], ARGV[5], cjson.encode(message))
+_DRAIN_SNAPSHOT = """
+local snapshots = redis.call('ZRANGE', KEYS[1], 0, 0)
+if #snapshots == 0 then
+    return {0, 0}
+end
+local snapshot = cjson.decode(snapshots[1])
+local device_ids = redis.call('SPOP', snapshot['index'], ARGV[2])
+local queued = 0
+for _, device_id in ipairs(device_ids) do
+    queued = queued + queue_aggregate(
+        aggregate_key(ARGV[1] .. device_id, snapshot['generation']),
+        device_id, KEYS[2], snapshot['window_id'], snapshot['timestamp'], ARGV[3]
+    )
+end
+if redis.call('SCARD', snapshot['index']) == 0 then
+    redis.call('ZREM', KEYS[1], snapshots[1])
+end
+if queued > 0 then
+    wake_outbox(KEYS[3])
+end
+return {queued, redis.call('ZCARD', KEYS[1])}
+"""
+
+
+# KEYS: open windows, closed windows, event clock, amended windows, outbox,
+# revisions, wake list. ARGV: now, watermark delay, allowed lateness, window prefix,
+# region, outbox score, window size, windows per step, idle timeout.
+# Returns {queued aggregates, windows processed}.
+_FLUSH_EVENT_WINDOWS = """
+local watermark = event_watermark(
+    KEYS[3], tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[9])
+)
+if not watermark then
+    return {0, 0}
+end
+local lateness = tonumber(ARGV[3])
+local size = tonumber(ARGV[7])
+local limit = tonumber(ARGV[8])
+local queued = 0
+local windows = 0
+
+local function emit(start, device_ids, revision)
+    local window = ARGV[4] .. start
+    for _, device_id in ipairs(device_ids) do
+        local message = build_aggregate(
+            window .. ':' .. device_id, device_id, ARGV[5] .. '-' .. start,
+            tonumber(start) + size
+        )
+        if message then
+            message['window_start'] = tonumber(start)
+            message['window_end'] = tonumber(start) + size
+            message['revision'] = revision
+            message['amended'] = revision > 0
+            outbox_add(KEYS[5], ARGV[6], message)
             queued = queued + 1
         end
-        redis.call('DEL', aggregate_key)
     end
 end
-redis.call('DEL', KEYS[1])
-return queued
+
+for _, start in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', watermark, 'LIMIT', 0, limit)) do
+    emit(start, redis.call('SMEMBERS', ARGV[4] .. start .. ':index'), 0)
+    redis.call('ZREM', KEYS[1], start)
+    redis.call('ZADD', KEYS[2], tonumber(start) + size + lateness, start)
+    windows = windows + 1
+end
+
+for _, start in ipairs(redis.call('SPOP', KEYS[4], limit)) do
+    local amended = ARGV[4] .. start .. ':amended'
+    emit(start, redis.call('SMEMBERS', amended), redis.call('HINCRBY', KEYS[6], start, 1))
+    redis.call('DEL', amended)
+    windows = windows + 1
+end
+
+for _, start in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', watermark, 'LIMIT', 0, limit)) do
+    if redis.call('SISMEMBER', KEYS[4], start) == 0 then
+        local window = ARGV[4] .. start
+        for _, device_id in ipairs(redis.call('SMEMBERS', window .. ':index')) do
+            redis.call('DEL', window .. ':' .. device_id)
+        end
+        redis.call('DEL', window .. ':index', window .. ':amended')
+        redis.call('ZREM', KEYS[2], start)
+        redis.call('HDEL', KEYS[6], start)
+        windows = windows + 1
+    end
+end
+if queued > 0 then
+    wake_outbox(KEYS[7])
+end
+return {queued, windows}
 """
 
 
-_CLAIM_OUTBOX_MESSAGE = """
-local item = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
-if #item == 0 or tonumber(item[2]) > tonumber(ARGV[1]) then
-    return nil
+_CLAIM_OUTBOX_BATCH = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, item in ipairs(items) do
+    redis.call('ZADD', KEYS[1], ARGV[2], item)
 end
-redis.call('ZADD', KEYS[1], ARGV[2], item[1])
-return item[1]
+return items
 """
 
 
+# KEYS: stream. ARGV: group, consumer, minimum idle milliseconds, count.
+# Reclaims entries other consumers left unacknowledged for longer than the
+# visibility timeout, then tops the batch up with entries never delivered.
+# Returns a flat list of entry ids and payloads.
+_CLAIM_STREAM_BATCH = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {}
+end
+local count = tonumber(ARGV[4])
+local entries = redis.call(
+    'XAUTOCLAIM', KEYS[1], ARGV[1], ARGV[2], ARGV[3], '0-0', 'COUNT', count
+)[2]
+if #entries < count then
+    local fresh = redis.call(
+        'XREADGROUP', 'GROUP', ARGV[1], ARGV[2], 'COUNT', count - #entries, 'STREAMS', KEYS[1], '>'
+    )
+    if fresh then
+        for _, entry in ipairs(fresh[1][2]) do
+            table.insert(entries, entry)
+        end
+    end
+end
+local claimed = {}
+for _, entry in ipairs(entries) do
+    if entry[2] then
+        table.insert(claimed, entry[1])
+        table.insert(claimed, entry[2][2])
+    end
+end
+return claimed
+"""
+
+
+_ACKNOWLEDGE_STREAM_BATCH = """
+local acknowledged = redis.call('XACK', KEYS[1], ARGV[1], unpack(ARGV, 2))
+redis.call('XDEL', KEYS[1], unpack(ARGV, 2))
+return acknowledged
+"""
+
+
+def _region_tag(region, hash_tags):
+    """Wrap the region in a cluster hash tag so its keys share one slot."""
+    return f"{{{region}}}" if hash_tags else region
+
+
+class KeyDeduplication:
+    """Exact deduplication with one ``SET NX EX`` string key per reading ID."""
+
+    lua = _ACCEPT_READING_BY_KEY
+
+    def __init__(self, prefix, ttl, hash_tags=False):
+        self.prefix = prefix
+        self.ttl = int(ttl)
+        self.hash_tags = hash_tags
+
+    def _namespace(self, name, region):
+        if self.hash_tags and region is not None:
+            return f"{self.prefix}:{name}:{_region_tag(region, True)}"
+        return f"{self.prefix}:{name}"
+
+    def key(self, reading_id, region=None):
+        digest = hashlib.sha256(str(reading_id).encode("utf-8")).hexdigest()
+        return f"{self._namespace('dedupe', region)}:{digest}"
+
+    def shared_keys(self, now=None, region=None):
+        return []
+
+    def reading_keys(self, reading_id, region=None):
+        if not reading_id:
+            return [self._namespace("no-dedupe", region)]
+        return [self.key(reading_id, region)]
+
+    def reading_args(self, reading_id):
+        return [self.ttl]
+
+
+class BloomDeduplication:
+    """
+    Approximate deduplication with rotating, time-bucketed Bloom filters stored
+    as Redis bitmaps. Each bucket covers ``bucket_seconds`` and holds up to
+    ``capacity`` readings; a reading is remembered for at least ``ttl`` seconds.
+    ``error_rate`` is the false-positive target across all live buckets, so a
+    false positive drops a new reading as a duplicate at that rate.
+    """
+
+    lua = _ACCEPT_READING_BY_BLOOM
+
+    def __init__(
+        self,
+        prefix,
+        ttl,
+        capacity=1000000,
+        error_rate=0.001,
+        bucket_seconds=3600,
+        hash_tags=False,
+    ):
+        if not 0 < float(error_rate) < 1:
+            raise ValueError("Bloom deduplication error_rate must be between 0 and 1")
+        self.prefix = prefix
+        self.ttl = int(ttl)
+        self.hash_tags = hash_tags
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = float(error_rate)
+        self.bucket_seconds = max(int(bucket_seconds), 1)
+        self.bucket_count = -(-self.ttl // self.bucket_seconds) + 1
+        bucket_error_rate = self.error_rate / self.bucket_count
+        self.bits = math.ceil(-self.capacity * math.log(bucket_error_rate) / math.log(2) ** 2)
+        if self.bits >= 2 ** 32:
+            raise ValueError("Bloom deduplication bucket exceeds the 512 MB Redis bitmap limit")
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.expire = self.ttl + self.bucket_seconds
+
+    def bucket_key(self, bucket, region=None):
+        # With hash tags each region keeps its own filters on its own slot
+        if self.hash_tags and region is not None:
+            return f"{self.prefix}:dedupe-bloom:{_region_tag(region, True)}:{bucket}"
+        return f"{self.prefix}:dedupe-bloom:{bucket}"
+
+    def memory_bytes(self):
+        """Upper bound of the Redis memory used by all live buckets."""
+        return self.bucket_count * math.ceil(self.bits / 8)
+
+    def shared_keys(self, now=None, region=None):
+        now = time.time() if now is None else float(now)
+        current = int(now) // self.bucket_seconds
+        return [
+            self.bucket_key(current - offset, region)
+            for offset in range(self.bucket_count)
+        ]
+
+    def reading_keys(self, reading_id, region=None):
+        return []
+
+    def reading_args(self, reading_id):
+        if not reading_id:
+            return [self.expire] + [0] * self.hashes
+        digest = hashlib.sha256(str(reading_id).encode("utf-8")).digest()
+        first = int.from_bytes(digest[:8], "big")
+        step = int.from_bytes(digest[8:16], "big") | 1
+        return [self.expire] + [
+            (first + index * step) % self.bits for index in range(self.hashes)
+        ]
+
+
+Reading = namedtuple(
+    "Reading",
+    "device_id device_name region temperature humidity event_detected reading_id event_time",
+    defaults=(None, None),
+)
+
+
+def _raw_messages(items):
+    return [item[0] if isinstance(item, tuple) else item for item in items]
+
+
+def _memory_usage(info):
+    # A cluster client answers with one INFO section per node
+    nodes = [info] if "used_memory" in info else list(info.values())
+    usage = [
+        int(node["used_memory"]) / int(node["maxmemory"])
+        for node in nodes
+        if isinstance(node, dict) and int(node.get("maxmemory", 0))
+    ]
+    return max(usage, default=None)
+
+
+def _update_result(result):
+    if isinstance(result, Exception):
+        return result
+    return _accepted(result)
+
+
+def _accepted(result):
+    """Map an update script result to True, False (duplicate) or None (late)."""
+    result = int(result)
+    return None if result < 0 else bool(result)
+
+
+def _update_result(result):
+    """Like ``_accepted``, but pass through a failed command's exception."""
+    if isinstance(result, Exception):
+        return result
+    return _accepted(result)
+
+
+FLUSH_MODES = ("atomic", "chunked")
+WINDOW_TIMES = ("processing", "event")
+OUTBOX_BACKENDS = ("zset", "stream")
+# Longest single BLPOP in wait_for_outbox; below the 5 s socket timeout of
+# the clients the from_* constructors build
+WAKE_BLOCK_SECONDS = 4
+# Percentiles estimated from the quantile sketch and emitted as p<N>_<metric>
+QUANTILES = (50, 95, 99)
+
+
+def _statistics_lua(quantile_buckets):
+    """Bind the sketch size and each metric's valid range into ``_STATISTICS``."""
+    ranges = []
+    for metric, (low, high) in (
+        ("temperature", TEMPERATURE_RANGE),
+        ("humidity", HUMIDITY_RANGE),
+    ):
+        width = (high - low) / quantile_buckets if quantile_buckets else 1
+        ranges.append(f"{metric} = {{{low!r}, {width!r}}}")
+    return (
+        f"local QUANTILE_BUCKETS = {quantile_buckets}\n"
+        f"local QUANTILES = {{{', '.join(str(q) for q in QUANTILES)}}}\n"
+        f"local SKETCH_RANGES = {{{', '.join(ranges)}}}\n"
+        + _STATISTICS
+    )
+
+
 class RedisAggregationStore:
     """Durable, replica-safe aggregation windows and publish outbox."""
 
@@ -88,14 +831,145 @@ class RedisAggregationStore:
         prefix="sensiot:fog",
         deduplication_ttl=86400,
         outbox_visibility_timeout=30,
+        deduplication_backend="key",
+        bloom_capacity=1000000,
+        bloom_error_rate=0.001,
+        bloom_bucket_seconds=3600,
+        flush_mode="atomic",
+        flush_chunk_size=500,
+        hash_tags=False,
+        quantile_buckets=0,
+        window_time="processing",
+        window_size=300,
+        window_slide=None,
+        allowed_lateness=0,
+        watermark_delay=0,
+        watermark_idle_timeout=None,
+        max_clock_skew=60,
+        event_flush_limit=100,
+        priority_events=True,
+        outbox_backend="zset",
+        outbox_consumer=None,
     ):
+        if flush_mode not in FLUSH_MODES:
+            raise ValueError(
+                f"Unknown flush mode {flush_mode!r}; "
+                f"expected one of {', '.join(FLUSH_MODES)}"
+            )
+        if window_time not in WINDOW_TIMES:
+            raise ValueError(
+                f"Unknown window time {window_time!r}; "
+                f"expected one of {', '.join(WINDOW_TIMES)}"
+            )
+        if outbox_backend not in OUTBOX_BACKENDS:
+            raise ValueError(
+                f"Unknown outbox backend {outbox_backend!r}; "
+                f"expected one of {', '.join(OUTBOX_BACKENDS)}"
+            )
+        window_size = int(window_size)
+        window_slide = int(window_slide or window_size)
+        if not 0 < window_slide <= window_size:
+            raise ValueError("window_slide must be between 1 and window_size seconds")
         self.client = client
         self.prefix = prefix.rstrip(":")
         self.deduplication_ttl = int(deduplication_ttl)
         self.outbox_visibility_timeout = int(outbox_visibility_timeout)
-        self._update = self.client.register_script(_UPDATE_AGGREGATE)
-        self._flush = self.client.register_script(_FLUSH_WINDOW)
-        self._claim = self.client.register_script(_CLAIM_OUTBOX_MESSAGE)
+        self.flush_mode = flush_mode
+        self.flush_chunk_size = max(int(flush_chunk_size), 1)
+        self.hash_tags = bool(hash_tags)
+        self.quantile_buckets = max(int(quantile_buckets), 0)
+        self.window_time = window_time
+        self.window_size = window_size
+        self.window_slide = window_slide
+        self.allowed_lateness = max(float(allowed_lateness), 0)
+        self.watermark_delay = max(float(watermark_delay), 0)
+        # Defaults to one window, so an idle region's last window closes one
+        # window length after its final reading
+        if watermark_idle_timeout is None:
+            watermark_idle_timeout = window_size
+        self.watermark_idle_timeout = max(float(watermark_idle_timeout), 0)
+        self.max_clock_skew = max(float(max_clock_skew), 0)
+        self.event_flush_limit = max(int(event_flush_limit), 1)
+        self.priority_events = bool(priority_events)
+        self.outbox_backend = outbox_backend
+        # Stream consumers are per process; entries a dead consumer left
+        # pending are reclaimed by the others after the visibility timeout
+        self.outbox_consumer = outbox_consumer or f"{socket.gethostname()}-{os.getpid()}"
+        if deduplication_backend == "key":
+            self.deduplication = KeyDeduplication(
+                self.prefix, self.deduplication_ttl, self.hash_tags
+            )
+        elif deduplication_backend == "bloom":
+            self.deduplication = BloomDeduplication(
+                self.prefix,
+                self.deduplication_ttl,
+                bloom_capacity,
+                bloom_error_rate,
+                bloom_bucket_seconds,
+                self.hash_tags,
+            )
+        else:
+            raise ValueError(
+                f"Unknown deduplication backend {deduplication_backend!r}; "
+                "expected 'key' or 'bloom'"
+            )
+        statistics = _statistics_lua(self.quantile_buckets)
+        outbox_add = _OUTBOX_ADD[self.outbox_backend]
+        if self.window_time == "event":
+            update = _EVENT_WINDOWS + _UPDATE_EVENT_AGGREGATE
+        else:
+            update = _AGGREGATE_KEY + _UPDATE_AGGREGATE
+        self._update = self.client.register_script(
+            self.deduplication.lua
+            + statistics
+            + _ADD_READING
+            + outbox_add
+            + _WAKE_OUTBOX
+            + _QUEUE_PRIORITY_READING
+            + update
+        )
+        self._merge = self.client.register_script(
+            self.deduplication.lua + statistics + _AGGREGATE_KEY + _MERGE_AGGREGATE
+        )
+        self._flush = self.client.register_script(
+            statistics
+            + outbox_add
+            + _WAKE_OUTBOX
+            + _AGGREGATE_KEY
+            + _QUEUE_AGGREGATE
+            + _FLUSH_WINDOW
+        )
+        self._snapshot = self.client.register_script(_SNAPSHOT_WINDOW)
+        self._drain_snapshot = self.client.register_script(
+            statistics
+            + outbox_add
+            + _WAKE_OUTBOX
+            + _AGGREGATE_KEY
+            + _QUEUE_AGGREGATE
+            + _DRAIN_SNAPSHOT
+        )
+        self._flush_event = self.client.register_script(
+            statistics
+            + outbox_add
+            + _WAKE_OUTBOX
+            + _QUEUE_AGGREGATE
+            + _EVENT_WINDOWS
+            + _FLUSH_EVENT_WINDOWS
+        )
+        self._claim_batch = self.client.register_script(
+            _CLAIM_STREAM_BATCH if self.outbox_backend == "stream" else _CLAIM_OUTBOX_BATCH
+        )
+        self._acknowledge_stream = self.client.register_script(_ACKNOWLEDGE_STREAM_BATCH)
+        self._scripts = [
+            self._update,
+            self._merge,
+            self._flush,
+            self._snapshot,
+            self._drain_snapshot,
+            self._flush_event,
+            self._claim_batch,
+            self._acknowledge_stream,
+        ]
 
     @classmethod
     def from_connection(
@@ -145,21 +1019,156 @@ class RedisAggregationStore:
         )
         return cls(sentinel.master_for(service_name), **kwargs)
 
+    @classmethod
+    def from_cluster(cls, nodes, password=None, **kwargs):
+        """
+        Connect to a Redis Cluster. Every key of a region carries a ``{region}``
+        hash tag, so each Lua script touches a single slot and regions spread
+        across the shards.
+        """
+        client = RedisCluster(
+            startup_nodes=[ClusterNode(host, int(port)) for host, port in nodes],
+            password=password or None,
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            health_check_interval=30,
+        )
+        kwargs.setdefault("hash_tags", True)
+        return cls(client, **kwargs)
+
     def ping(self):
-        return self.client.ping()
+        result = self.client.ping()
+        if isinstance(self.client, RedisCluster):
+            self.load_scripts()
+        return result
+
+    def load_scripts(self):
+        """
+        Cache every Lua script on the server, or on every primary of a
+        cluster. Cluster pipelines cannot load a missing script on demand.
+        """
+        for script in self._scripts:
+            script.sha = self.client.script_load(script.script)
+
+    def _execute(self, pipeline, raise_on_error=True):
+        try:
+            results = pipeline.execute(raise_on_error=raise_on_error)
+        except NoScriptError:
+            # A failed-over primary starts with an empty script cache; reload
+            # so the caller's retry or the next batch succeeds.
+            self.load_scripts()
+            raise
+        if any(isinstance(result, NoScriptError) for result in results):
+            self.load_scripts()
+        return results
+
+    def _region_tag(self, region):
+        return _region_tag(region, self.hash_tags)
 
     def _region_prefix(self, region):
-        return f"{self.prefix}:aggregate:{region}:"
+        return f"{self.prefix}:aggregate:{self._region_tag(region)}:"
 
     def _index_key(self, region):
-        return f"{self.prefix}:aggregate-index:{region}"
+        return f"{self.prefix}:aggregate-index:{self._region_tag(region)}"
 
     def _outbox_key(self, region):
-        return f"{self.prefix}:outbox:{region}"
+        return f"{self.prefix}:{self._outbox_name}:{self._region_tag(region)}"
 
-    def _deduplication_key(self, reading_id):
-        digest = hashlib.sha256(str(reading_id).encode("utf-8")).hexdigest()
-        return f"{self.prefix}:dedupe:{digest}"
+    def _priority_outbox_key(self, region):
+        return f"{self.prefix}:priority-{self._outbox_name}:{self._region_tag(region)}"
+
+    @property
+    def _outbox_name(self):
+        # A different key per backend, so switching never meets the other type
+        return "outbox-stream" if self.outbox_backend == "stream" else "outbox"
+
+    def _wake_key(self, region):
+        return f"{self.prefix}:outbox-wake:{self._region_tag(region)}"
+
+    def _waiters_key(self, region):
+        return f"{self._wake_key(region)}:waiters"
+
+    def _lane_key(self, region, priority):
+        return self._priority_outbox_key(region) if priority else self._outbox_key(region)
+
+    def _generation_key(self, region):
+        return f"{self.prefix}:aggregate-generation:{self._region_tag(region)}"
+
+    def _frozen_index_prefix(self, region):
+        return f"{self.prefix}:aggregate-frozen:{self._region_tag(region)}:"
+
+    def _snapshots_key(self, region):
+        return f"{self.prefix}:aggregate-snapshots:{self._region_tag(region)}"
+
+    def _flushed_marker_key(self, region, window_number):
+        return f"{self.prefix}:flushed:{self._region_tag(region)}:{window_number}"
+
+    def _event_window_prefix(self, region):
+        return f"{self.prefix}:event-window:{self._region_tag(region)}:"
+
+    def _event_key(self, region, name):
+        return f"{self.prefix}:event-{name}:{self._region_tag(region)}"
+
+    def _update_command(
+        self,
+        device_id,
+        device_name,
+        region,
+        temperature,
+        humidity,
+        event_detected,
+        reading_id=None,
+        event_time=None,
+    ):
+        now = time.time()
+        args = [
+            temperature,
+            humidity,
+            device_id,
+            device_name,
+            region,
+            "1" if event_detected else "0",
+            str(reading_id) if reading_id else "",
+            repr(float(event_time if event_time is not None else now)),
+            repr(now),
+        ]
+        priority = "1" if self.priority_events else "0"
+        if self.window_time == "event":
+            keys = [
+                self._event_key(region, "open"),
+                self._event_key(region, "closed"),
+                self._event_key(region, "clock"),
+                self._event_key(region, "amended"),
+                self._priority_outbox_key(region),
+                self._wake_key(region),
+            ]
+            args.extend(
+                [
+                    self.window_size,
+                    self.window_slide,
+                    self.allowed_lateness,
+                    self.watermark_delay,
+                    self.max_clock_skew,
+                    self._event_window_prefix(region),
+                    priority,
+                    self.watermark_idle_timeout,
+                ]
+            )
+        else:
+            keys = [
+                f"{self._region_prefix(region)}{device_id}",
+                self._index_key(region),
+                self._generation_key(region),
+                self._priority_outbox_key(region),
+                self._wake_key(region),
+            ]
+            args.append(priority)
+        if reading_id:
+            keys.extend(self.deduplication.shared_keys(region=region))
+            keys.extend(self.deduplication.reading_keys(reading_id, region))
+            args.extend(self.deduplication.reading_args(reading_id))
+        return keys, args
 
     def update(
         self,
@@ -170,60 +1179,399 @@ class RedisAggregationStore:
         humidity,
         event_detected,
         reading_id=None,
+        event_time=None,
     ):
-        aggregate_key = f"{self._region_prefix(region)}{device_id}"
-        dedupe_key = self._deduplication_key(reading_id) if reading_id else f"{self.prefix}:no-dedupe"
-        result = self._update(
-            keys=[aggregate_key, self._index_key(region), dedupe_key],
-            args=[
-                temperature,
-                humidity,
-                device_id,
-                device_name,
-                region,
-                "1" if event_detected else "0",
-                str(reading_id) if reading_id else "",
-                self.deduplication_ttl,
-            ],
+        """
+        Add one reading to its window. Returns True when applied, False for a
+        duplicate and None when an event-time reading is too late or too far
+        ahead of this node's clock for any open window.
+        """
+        keys, args = self._update_command(
+            device_id,
+            device_name,
+            region,
+            temperature,
+            humidity,
+            event_detected,
+            reading_id,
+            event_time,
         )
-        return bool(result)
+        started = stage_timers.start()
+        result = self._update(keys=keys, args=args)
+        stage_timers.observe(normalize_region(region), "redis_update", started)
+        return _accepted(result)
 
-    def flush_window(self, region, aggregation_interval, now=None):
+    def update_many(self, readings, raise_on_error=True):
+        """
+        Apply several readings in one pipelined round trip. Each reading still
+        runs the same atomic Lua script, so deduplication is unchanged.
+        Returns one result per reading, in input order, as for ``update``.
+
+        The pipeline is not a transaction: when one reading fails the others
+        are still applied. By default the first error is raised anyway; with
+        ``raise_on_error=False`` the failed reading's entry is its exception
+        so callers can tell applied readings from failed ones.
+        """
+        readings = list(readings)
+        if not readings:
+            return []
+        started = stage_timers.start()
+        pipeline = self.client.pipeline(transaction=False)
+        for reading in readings:
+            keys, args = self._update_command(*reading)
+            self._update(keys=keys, args=args, client=pipeline)
+        results = self._execute(pipeline, raise_on_error)
+        stage_timers.observe(normalize_region(readings[0][2]), "redis_update", started)
+        return [_update_result(result) for result in results]
+
+    def _merge_command(self, device_id, device_name, region, readings):
+        if self.window_time == "event":
+            raise ValueError("Pre-aggregated merges need processing-time windows")
+        shared_keys = self.deduplication.shared_keys(region=region)
+        reading_key_count = len(self.deduplication.reading_keys(None))
+        reading_arg_count = len(self.deduplication.reading_args(None))
+        keys = [
+            f"{self._region_prefix(region)}{device_id}",
+            self._index_key(region),
+            self._generation_key(region),
+            *shared_keys,
+        ]
+        args = [
+            device_id,
+            device_name,
+            region,
+            len(shared_keys),
+            reading_key_count,
+            reading_arg_count,
+        ]
+        for reading_id, temperature, humidity, event_detected in readings:
+            keys.extend(self.deduplication.reading_keys(reading_id, region))
+            args.extend(
+                [
+                    str(reading_id) if reading_id else "",
+                    temperature,
+                    humidity,
+                    "1" if event_detected else "0",
+                ]
+            )
+            args.extend(self.deduplication.reading_args(reading_id))
+        return keys, args
+
+    def merge_many(self, partials):
+        """
+        Fold pre-aggregated device windows into Redis. Each partial is
+        ``(device_id, device_name, region, readings)`` where readings are
+        ``(reading_id, temperature, humidity, event_detected)`` tuples. Every
+        device costs one atomic Lua call, all sent in one pipelined round trip.
+        Returns, per partial, one accepted flag per reading.
+        """
+        partials = list(partials)
+        if not partials:
+            return []
+        started = stage_timers.start()
+        pipeline = self.client.pipeline(transaction=False)
+        for partial in partials:
+            keys, args = self._merge_command(*partial)
+            self._merge(keys=keys, args=args, client=pipeline)
+        results = self._execute(pipeline)
+        stage_timers.observe(normalize_region(partials[0][2]), "redis_merge", started)
+        return [[bool(flag) for flag in flags] for flags in results]
+
+    def _window(self, region, aggregation_interval, now=None):
+        """Return ``(now, window_id, marker_key, marker_ttl)`` for a flush."""
         now = now or datetime.now(timezone.utc)
         window_number = int(now.timestamp()) // int(aggregation_interval)
         window_id = f"{region}-{window_number}-{uuid.uuid4().hex}"
-        marker_key = f"{self.prefix}:flushed:{region}:{window_number}"
+        marker_key = self._flushed_marker_key(region, window_number)
         marker_ttl = max(int(aggregation_interval) * 2, 60)
+        return now, window_id, marker_key, marker_ttl
+
+    def _flush_command(self, region, window_id, marker_key, marker_ttl, now):
+        keys = [
+            self._index_key(region),
+            self._outbox_key(region),
+            marker_key,
+            self._generation_key(region),
+            self._wake_key(region),
+        ]
+        args = [
+            self._region_prefix(region),
+            window_id,
+            now.isoformat(),
+            marker_ttl,
+            now.timestamp(),
+        ]
+        return keys, args
+
+    def _snapshot_command(self, region, window_id, marker_key, marker_ttl, now):
+        keys = [
+            self._index_key(region),
+            self._generation_key(region),
+            marker_key,
+            self._snapshots_key(region),
+        ]
+        args = [
+            self._frozen_index_prefix(region),
+            window_id,
+            now.isoformat(),
+            marker_ttl,
+            now.timestamp(),
+        ]
+        return keys, args
 
-        return int(
-            self._flush(
-                keys=[self._index_key(region), self._outbox_key(region), marker_key],
-                args=[
-                    self._region_prefix(region),
-                    window_id,
-                    now.isoformat(),
-                    marker_ttl,
-                    now.timestamp(),
-                ],
+    def _drain_command(self, region, score):
+        keys = [
+            self._snapshots_key(region),
+            self._outbox_key(region),
+            self._wake_key(region),
+        ]
+        args = [self._region_prefix(region), self.flush_chunk_size, score]
+        return keys, args
+
+    def _event_flush_command(self, region, now):
+        keys = [
+            self._event_key(region, "open"),
+            self._event_key(region, "closed"),
+            self._event_key(region, "clock"),
+            self._event_key(region, "amended"),
+            self._outbox_key(region),
+            self._event_key(region, "revisions"),
+            self._wake_key(region),
+        ]
+        args = [
+            now.timestamp(),
+            self.watermark_delay,
+            self.allowed_lateness,
+            self._event_window_prefix(region),
+            region,
+            now.timestamp(),
+            self.window_size,
+            self.event_flush_limit,
+            self.watermark_idle_timeout,
+        ]
+        return keys, args
+
+    def _claim_batch_command(self, region, n, now=None, priority=False):
+        now = time.time() if now is None else float(now)
+        keys = [self._lane_key(region, priority)]
+        if self.outbox_backend == "stream":
+            # Redis tracks how long a stream entry has been pending, so a
+            # message claimed more than the visibility timeout before ``now``
+            # is one idle for at least the timeout less the time until ``now``
+            min_idle = self.outbox_visibility_timeout - (now - time.time())
+            args = [
+                OUTBOX_GROUP,
+                self.outbox_consumer,
+                max(int(min_idle * 1000), 0),
+                max(int(n), 1),
+            ]
+        else:
+            args = [now, now + self.outbox_visibility_timeout, max(int(n), 1)]
+        return keys, args
+
+    def _claimed(self, result):
+        """Pair each claimed raw message (stream entry id or payload) with its message."""
+        if self.outbox_backend == "stream":
+            return [
+                (entry_id, codec.loads(payload))
+                for entry_id, payload in zip(result[::2], result[1::2])
+            ]
+        return [(payload, codec.loads(payload)) for payload in result]
+
+    def _deferred_idle(self, retry_delay):
+        """
+        Idle time, in ms, that makes a stream entry reclaimable after
+        ``retry_delay``. A pending entry has no not-before time of its own,
+        so a delay longer than the visibility timeout cannot be honoured.
+        """
+        if float(retry_delay) > self.outbox_visibility_timeout:
+            raise ValueError(
+                f"A retry delay of {retry_delay}s exceeds the stream outbox's "
+                f"visibility timeout of {self.outbox_visibility_timeout}s"
             )
+        return max(int((self.outbox_visibility_timeout - float(retry_delay)) * 1000), 0)
+
+    def flush_window(self, region, aggregation_interval, now=None):
+        """
+        Queue the current window's aggregates in the outbox. Returns the number
+        queued, or -1 if another replica already flushed this window.
+
+        ``atomic`` mode does everything in one Lua call, which blocks Redis for
+        as long as it takes to walk every device. ``chunked`` mode freezes the
+        window in O(1) and then drains it ``flush_chunk_size`` devices per call.
+        Event-time windows are flushed by ``flush_event_windows`` instead.
+        """
+        started = stage_timers.start()
+        queued = self._flush_window(region, aggregation_interval, now)
+        stage_timers.observe(region, "flush", started)
+        return queued
+
+    def _flush_window(self, region, aggregation_interval, now):
+        if self.window_time == "event":
+            return self.flush_event_windows(region, now)
+        now, window_id, marker_key, marker_ttl = self._window(
+            region, aggregation_interval, now
         )
 
-    def claim_outbox_message(self, region, now=None):
-        now = time.time() if now is None else float(now)
-        payload = self._claim(
-            keys=[self._outbox_key(region)],
-            args=[now, now + self.outbox_visibility_timeout],
+        if self.flush_mode == "chunked":
+            frozen = self.snapshot_window(
+                region, window_id, marker_key, marker_ttl, now
+            )
+            # Also finishes snapshots left behind by a replica that crashed
+            # mid-drain, so a lost marker race still makes progress.
+            queued = self.drain_snapshots(region, now.timestamp())
+            return -1 if frozen < 0 and not queued else queued
+
+        keys, args = self._flush_command(
+            region, window_id, marker_key, marker_ttl, now
+        )
+        return int(self._flush(keys=keys, args=args))
+
+    def snapshot_window(self, region, window_id, marker_key, marker_ttl, now):
+        """
+        Freeze the live window; later readings go to the next generation.
+        Returns the number of frozen devices, or -1 if the marker was taken.
+        """
+        keys, args = self._snapshot_command(
+            region, window_id, marker_key, marker_ttl, now
+        )
+        return int(self._snapshot(keys=keys, args=args))
+
+    def drain_snapshots(self, region, score=None):
+        """Move every frozen window into the outbox, one chunk per Lua call."""
+        keys, args = self._drain_command(
+            region, time.time() if score is None else float(score)
         )
-        return (payload, json.loads(payload)) if payload else None
+        queued = 0
+        while True:
+            chunk_queued, snapshots_left = self._drain_snapshot(keys=keys, args=args)
+            queued += int(chunk_queued)
+            if not int(snapshots_left):
+                return queued
+
+    def flush_event_windows(self, region, now=None):
+        """
+        Emit event-time windows the watermark has passed, re-emit windows
+        amended by late readings with the next ``revision``, and drop windows
+        past their allowed lateness, ``event_flush_limit`` windows per call.
+        Returns the number of aggregates queued.
+        """
+        keys, args = self._event_flush_command(
+            region, now or datetime.now(timezone.utc)
+        )
+        queued = 0
+        while True:
+            step_queued, windows = self._flush_event(keys=keys, args=args)
+            queued += int(step_queued)
+            if not int(windows):
+                return queued
+
+    def claim_outbox_message(self, region, now=None):
+        claimed = self.claim_outbox_batch(region, 1, now)
+        return claimed[0] if claimed else None
+
+    def claim_outbox_batch(self, region, n, now=None, priority=False):
+        """
+        Claim up to ``n`` due outbox messages in one call. Each claimed message
+        stays hidden for the visibility timeout unless it is acknowledged.
+        ``priority`` selects the outbox of individually queued event readings.
+        Returns ``(raw message, message)`` pairs; the raw message is what
+        acknowledging or deferring takes back.
+        """
+        started = stage_timers.start()
+        keys, args = self._claim_batch_command(region, n, now, priority)
+        claimed = self._claimed(self._claim_batch(keys=keys, args=args))
+        stage_timers.observe(region, "outbox_claim", started)
+        return claimed
 
     def acknowledge_outbox_message(self, region, raw_message):
-        return self.client.zrem(self._outbox_key(region), raw_message)
+        return self.acknowledge_outbox_batch(region, [raw_message])
+
+    def acknowledge_outbox_batch(self, region, items, priority=False):
+        raw_messages = _raw_messages(items)
+        if not raw_messages:
+            return 0
+        started = stage_timers.start()
+        key = self._lane_key(region, priority)
+        if self.outbox_backend == "stream":
+            removed = self._acknowledge_stream(keys=[key], args=[OUTBOX_GROUP, *raw_messages])
+        else:
+            removed = self.client.zrem(key, *raw_messages)
+        stage_timers.observe(region, "outbox_ack", started)
+        return removed
 
     def defer_outbox_message(self, region, raw_message, retry_delay):
-        return self.client.zadd(
-            self._outbox_key(region),
-            {raw_message: time.time() + float(retry_delay)},
-        )
+        return self.defer_outbox_batch(region, [raw_message], retry_delay)
+
+    def defer_outbox_batch(self, region, items, retry_delay, priority=False):
+        raw_messages = _raw_messages(items)
+        if not raw_messages:
+            return 0
+        key = self._lane_key(region, priority)
+        if self.outbox_backend == "stream":
+            return len(
+                self.client.xclaim(
+                    key,
+                    OUTBOX_GROUP,
+                    self.outbox_consumer,
+                    0,
+                    raw_messages,
+                    idle=self._deferred_idle(retry_delay),
+                    justid=True,
+                )
+            )
+        retry_at = time.time() + float(retry_delay)
+        return self.client.zadd(key, {raw_message: retry_at for raw_message in raw_messages})
+
+    def outbox_size(self, region, priority=False):
+        key = self._lane_key(region, priority)
+        if self.outbox_backend == "stream":
+            return self.client.xlen(key)
+        return self.client.zcard(key)
+
+    def memory_usage(self):
+        """
+        Redis used memory as a fraction of ``maxmemory``, the highest of any
+        cluster primary, or None when no limit is set.
+        """
+        return _memory_usage(self.client.info("memory"))
+
+    def _wake_timeouts(self, timeout):
+        """Yield BLPOP timeouts that add up to ``timeout`` seconds."""
+        deadline = time.monotonic() + float(timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            # BLPOP treats 0 as "block forever"
+            if remaining < 0.01:
+                return
+            yield round(min(remaining, WAKE_BLOCK_SECONDS), 2)
+
+    def _register_waiter(self, pipeline, region, timeout):
+        """
+        Queue the commands that add one wait to the region's waiters set and
+        return its member. Entries of replicas that died while waiting expire
+        a few seconds after their timeout and are pruned by the next wait.
+        """
+        waiter = uuid.uuid4().hex
+        now = time.time()
+        waiters_key = self._waiters_key(region)
+        pipeline.zremrangebyscore(waiters_key, "-inf", now)
+        pipeline.zadd(waiters_key, {waiter: now + float(timeout) + WAKE_BLOCK_SECONDS})
+        return waiter
 
-    def outbox_size(self, region):
-        return self.client.zcard(self._outbox_key(region))
+    def wait_for_outbox(self, region, timeout):
+        """
+        Block until a script queues a message in the region's outbox, or for
+        ``timeout`` seconds. Returns True when woken by a queued message.
+        """
+        wake_key = self._wake_key(region)
+        pipeline = self.client.pipeline(transaction=False)
+        waiter = self._register_waiter(pipeline, region, timeout)
+        pipeline.execute()
+        try:
+            for block in self._wake_timeouts(timeout):
+                if self.client.blpop([wake_key], block):
+                    return True
+            return False
+        finally:
+            self.client.zrem(self._waiters_key(region), waiter)
@@ -1,12 +1,19 @@
 import logging
 import time
+import redis
 from metrics import (
+    device_labels,
     forwarded_counter,
     avg_temperature_gauge,
     dropped_counter,
     outbox_messages_gauge,
+    priority_event_latency_histogram,
+    priority_outbox_messages_gauge,
+    stage_timers,
 )
-from publisher import publish_to_central
+import codec
+from envelope import encode_envelope
+from publisher import PublishWindow
 from collections import defaultdict
 
 logger = logging.getLogger(__name__)
@@ -14,6 +21,155 @@ logger = logging.getLogger(__name__)
 # Local in-memory counter for published aggregated messages per region
 local_published_counter = defaultdict(int)
 
+MAX_REDIS_RETRY_DELAY = 30
+
+
+def _next_aligned_flush(aggregation_interval, delay):
+    """Monotonic time of the next wall-clock window boundary plus ``delay``."""
+    now = time.time()
+    boundary = (now // aggregation_interval + 1) * aggregation_interval
+    return time.monotonic() + boundary + delay - now
+
+
+def _publish_groups(claimed_messages, envelope_compression, envelope_max_messages):
+    """Yield ``(raw_messages, messages)`` pairs, one per MQTT publish."""
+    group_size = 1 if envelope_compression is None else envelope_max_messages
+    for start in range(0, len(claimed_messages), group_size):
+        group = claimed_messages[start:start + group_size]
+        yield (
+            tuple(raw_message for raw_message, _ in group),
+            [msg for _, msg in group],
+        )
+
+
+def _encode_group(messages, envelope_compression):
+    """Return the payload of one publish: the message itself or an envelope."""
+    if envelope_compression is None:
+        return codec.dumps(messages[0])
+    return encode_envelope(messages, envelope_compression)
+
+
+def _outbox_lanes(aggregation_store):
+    return (True, False) if aggregation_store.priority_events else (False,)
+
+
+def _claim_next_batch(aggregation_store, region, outbox_batch_size):
+    """Claim from the priority outbox first; returns ``(claimed, priority)``."""
+    for priority in _outbox_lanes(aggregation_store):
+        claimed_messages = aggregation_store.claim_outbox_batch(
+            region, outbox_batch_size, priority=priority
+        )
+        if claimed_messages:
+            return claimed_messages, priority
+    return [], False
+
+
+def _record_publish_results(region, messages, completed, publish_retry_delay):
+    """
+    Count and log finished publishes. ``completed`` holds ``(raw_messages,
+    error)`` pairs; returns the raw messages to acknowledge and to defer.
+    """
+    published = []
+    failed = []
+    acknowledged_at = time.time()
+    for raw_messages, error in completed:
+        for raw_message in raw_messages:
+            msg = messages[raw_message]
+            if error is not None:
+                failed.append(raw_message)
+                logger.error(
+                    f"[{region}] Failed to publish aggregate {msg.get('aggregate_id')}; "
+                    f"retrying in {publish_retry_delay}s: {error}"
+                )
+                dropped_counter.labels(
+                    region=msg["region"],
+                    device_id=device_labels.label(msg["region"], msg["device_id"], weight=0),
+                ).inc()
+                continue
+            published.append(raw_message)
+            device_label = device_labels.label(msg["region"], msg["device_id"], weight=0)
+            forwarded_counter.labels(region=msg["region"], device_id=device_label).inc()
+            local_published_counter[msg["region"]] += 1
+            if msg.get("kind") == "event":
+                # A single reading from the priority outbox, not a window average
+                priority_event_latency_histogram.labels(region=msg["region"]).observe(
+                    max(acknowledged_at - msg["queued_at"], 0)
+                )
+                logger.info(f"[{region}] Forwarded event reading {msg['aggregate_id']}")
+                continue
+            avg_temperature_gauge.labels(
+                region=msg["region"], device_id=device_label
+            ).set(msg["avg_temperature"])
+            logger.info(
+                f"[{region}] Forwarded aggregate {msg['aggregate_id']} "
+                f"(published total={local_published_counter[msg['region']]})"
+            )
+    return published, failed
+
+
+def drain_outbox(
+    mqtt_client,
+    aggregation_store,
+    region,
+    central_topic,
+    outbox_batch_size=100,
+    publish_retry_delay=5,
+    max_in_flight=20,
+    publish_timeout=10,
+    envelope_compression=None,
+    envelope_max_messages=100,
+):
+    """
+    Publish due outbox messages with up to ``max_in_flight`` unacknowledged
+    QoS 1 publishes. Messages are claimed in batches; each one is acknowledged
+    once its PUBACK arrives or deferred after a failure or timeout. Before
+    every batch the priority outbox of event readings is checked first, so
+    alerts never wait behind a large window.
+
+    With ``envelope_compression`` set, up to ``envelope_max_messages``
+    aggregates share one envelope publish and are acknowledged together.
+    Returns the number of messages published.
+    """
+    window = PublishWindow(
+        mqtt_client, central_topic, max_in_flight, publish_timeout, region
+    )
+    total_published = 0
+    while True:
+        claimed_messages, priority = _claim_next_batch(
+            aggregation_store, region, outbox_batch_size
+        )
+        if not claimed_messages:
+            return total_published
+        messages = dict(claimed_messages)
+        completed = []
+        started = stage_timers.start()
+        for raw_messages, group in _publish_groups(
+            claimed_messages, envelope_compression, envelope_max_messages
+        ):
+            # A group that cannot be encoded fails alone; the rest of the
+            # batch is still published and acknowledged
+            try:
+                payload = _encode_group(group, envelope_compression)
+            except Exception as e:
+                completed.append((raw_messages, e))
+                continue
+            completed.extend(window.publish(raw_messages, payload))
+        completed.extend(window.drain())
+        stage_timers.observe(region, "publish", started)
+
+        published, failed = _record_publish_results(
+            region, messages, completed, publish_retry_delay
+        )
+        aggregation_store.acknowledge_outbox_batch(region, published, priority=priority)
+        if failed:
+            aggregation_store.defer_outbox_batch(
+                region, failed, publish_retry_delay, priority=priority
+            )
+        total_published += len(published)
+        if failed or (not priority and len(claimed_messages) < outbox_batch_size):
+            return total_published
+
+
 def aggregation_worker(
     mqtt_client,
     aggregation_store,
@@ -22,52 +178,83 @@ def aggregation_worker(
     central_topic,
     outbox_poll_interval=1,
     publish_retry_delay=5,
+    pre_aggregator=None,
+    outbox_batch_size=100,
+    max_in_flight=20,
+    publish_timeout=10,
+    envelope_compression=None,
+    envelope_max_messages=100,
+    outbox_wake_timeout=30,
 ):
     """
     Periodically move a region's aggregate window into Redis's durable outbox and
-    publish due messages. Redis coordinates flushes across all replicas.
+    publish due messages. Redis coordinates flushes across all replicas, and the
+    outbox is drained in batches of ``outbox_batch_size`` claimed messages.
+
+    While the outbox is empty the worker blocks until a flush or an event
+    reading queues a message, for at most ``outbox_wake_timeout`` seconds.
+    While messages wait for a retry or another replica's claim it polls every
+    ``outbox_poll_interval``. A wake timeout of 0 always polls.
+
+    With a pre-aggregator, flushes are aligned to wall-clock window boundaries
+    and delayed by one merge interval so every replica has merged its readings.
+
+    Redis errors are logged and retried with a doubling delay of up to
+    ``MAX_REDIS_RETRY_DELAY`` seconds, so a failover never stops the worker.
     """
     logger.info(
         f"[{region}] Aggregator worker started; interval={aggregation_interval}s, "
-        f"outbox_poll={outbox_poll_interval}s"
+        f"outbox_poll={outbox_poll_interval}s, outbox_wake_timeout={outbox_wake_timeout}s"
     )
-    next_flush = time.monotonic() + aggregation_interval
+    if pre_aggregator is not None:
+        flush_delay = pre_aggregator.merge_interval + 1
+        next_flush = _next_aligned_flush(aggregation_interval, flush_delay)
+    else:
+        next_flush = time.monotonic() + aggregation_interval
+    retry_delay = outbox_poll_interval
     while True:
-        if time.monotonic() >= next_flush:
-            queued = aggregation_store.flush_window(region, aggregation_interval)
-            if queued >= 0:
-                logger.info(f"[{region}] Queued {queued} aggregate(s) in the durable outbox")
-            next_flush = time.monotonic() + aggregation_interval
-
-        while True:
-            claimed_message = aggregation_store.claim_outbox_message(region)
-            if not claimed_message:
-                break
-            raw_message, msg = claimed_message
-            try:
-                publish_to_central(mqtt_client, msg, central_topic)
-                forwarded_counter.labels(region=msg["region"], device_id=msg["device_id"]).inc()
-                avg_temperature_gauge.labels(
-                    region=msg["region"], device_id=msg["device_id"]
-                ).set(msg["avg_temperature"])
-                local_published_counter[msg["region"]] += 1
-                aggregation_store.acknowledge_outbox_message(region, raw_message)
-                logger.info(
-                    f"[{region}] Forwarded aggregate {msg['aggregate_id']} "
-                    f"(published total={local_published_counter[msg['region']]})"
-                )
-            except Exception as e:
-                aggregation_store.defer_outbox_message(
-                    region, raw_message, publish_retry_delay
-                )
-                logger.error(
-                    f"[{region}] Failed to publish aggregate {msg.get('aggregate_id')}; "
-                    f"retrying in {publish_retry_delay}s: {e}"
-                )
-                dropped_counter.labels(region=msg["region"], device_id=msg["device_id"]).inc()
-                break
+        try:
+            if time.monotonic() >= next_flush:
+                if pre_aggregator is not None:
+                    pre_aggregator.flush()
+                queued = aggregation_store.flush_window(region, aggregation_interval)
+                if queued >= 0:
+                    logger.info(f"[{region}] Queued {queued} aggregate(s) in the durable outbox")
+                if pre_aggregator is not None:
+                    next_flush = _next_aligned_flush(aggregation_interval, flush_delay)
+                else:
+                    next_flush = time.monotonic() + aggregation_interval
 
-        outbox_messages_gauge.labels(region=region).set(
-            aggregation_store.outbox_size(region)
-        )
-        time.sleep(min(outbox_poll_interval, max(next_flush - time.monotonic(), 0.1)))
+            drain_outbox(
+                mqtt_client,
+                aggregation_store,
+                region,
+                central_topic,
+                outbox_batch_size,
+                publish_retry_delay,
+                max_in_flight,
+                publish_timeout,
+                envelope_compression,
+                envelope_max_messages,
+            )
+
+            backlog = aggregation_store.outbox_size(region)
+            outbox_messages_gauge.labels(region=region).set(backlog)
+            if aggregation_store.priority_events:
+                priority_backlog = aggregation_store.outbox_size(region, priority=True)
+                priority_outbox_messages_gauge.labels(region=region).set(priority_backlog)
+                backlog += priority_backlog
+            until_flush = max(next_flush - time.monotonic(), 0.1)
+            if backlog or not outbox_wake_timeout:
+                time.sleep(min(outbox_poll_interval, until_flush))
+            else:
+                aggregation_store.wait_for_outbox(region, min(outbox_wake_timeout, until_flush))
+            retry_delay = outbox_poll_interval
+        except redis.RedisError as e:
+            # Ride out failovers and restarts; a flush that failed is retried
+            logger.error(
+                f"[{region}] Aggregator worker cannot reach Redis: {e}. "
+                f"Retrying in {retry_delay:.1f}s."
+            )
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, MAX_REDIS_RETRY_DELAY)
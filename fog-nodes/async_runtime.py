@@ -0,0 +1,463 @@
+"""
+asyncio runtime for the fog node.
+
+One event loop runs MQTT ingest, update batching, window flushes and outbox
+draining as cooperating tasks instead of paho's network thread plus worker
+threads. Redis calls go through ``AsyncRedisAggregationStore`` pipelines and
+outbox publishes overlap up to the in-flight limit while their PUBACKs are
+awaited, so neither side blocks the other.
+"""
+import asyncio
+import logging
+import os
+import ssl
+import time
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timezone
+
+try:
+    import aiomqtt
+except ImportError:  # only needed with RUNTIME=asyncio
+    aiomqtt = None
+
+from aggregation_store import Reading
+from aggregator import _encode_group, _outbox_lanes, _publish_groups, _record_publish_results
+from batcher import resolve_batch
+from mqtt_client import drop_if_paused, handle_message
+from metrics import (
+    outbox_messages_gauge,
+    priority_outbox_messages_gauge,
+    publish_ack_latency_histogram,
+    publish_in_flight_gauge,
+    stage_timers,
+)
+from utils import get_region_secret
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncUpdateBatcher:
+    """
+    Collect aggregate updates on the event loop and apply them with pipelined
+    ``update_many`` calls, up to ``max_in_flight`` batches at once.
+
+    ``update`` has the same signature as ``UpdateBatcher.update`` and returns
+    a Future, so ``process_message`` is shared with the threaded runtime.
+    """
+
+    def __init__(
+        self,
+        aggregation_store,
+        max_batch_size=100,
+        max_delay=0.005,
+        max_pending=None,
+        max_in_flight=4,
+    ):
+        self.aggregation_store = aggregation_store
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_delay = max(float(max_delay), 0)
+        self.max_pending = max_pending or self.max_batch_size * 10
+        self._pending = deque()
+        self._slots = asyncio.Semaphore(max(int(max_in_flight), 1))
+        self._tasks = set()
+        self._wake = asyncio.Event()
+        self._room = asyncio.Event()
+        self._room.set()
+
+    def update(
+        self,
+        device_id,
+        device_name,
+        region,
+        temperature,
+        humidity,
+        event_detected,
+        reading_id=None,
+        event_time=None,
+    ):
+        future = Future()
+        reading = Reading(
+            device_id,
+            device_name,
+            region,
+            temperature,
+            humidity,
+            event_detected,
+            reading_id,
+            event_time,
+        )
+        self._pending.append((reading, future))
+        if len(self._pending) >= self.max_pending:
+            self._room.clear()
+        self._wake.set()
+        return future
+
+    def pending(self):
+        return len(self._pending)
+
+    async def wait_for_room(self):
+        """
+        Wait while ``max_pending`` readings are queued. Ingest stops taking
+        messages off aiomqtt's incoming queue meanwhile; aiomqtt keeps reading
+        the socket and discards messages once that queue is full.
+        """
+        await self._room.wait()
+
+    def _take_batch(self):
+        batch = [
+            self._pending.popleft()
+            for _ in range(min(self.max_batch_size, len(self._pending)))
+        ]
+        if len(self._pending) < self.max_pending:
+            self._room.set()
+        return batch
+
+    async def _apply_batch(self, batch):
+        try:
+            results = await self.aggregation_store.update_many(
+                [reading for reading, _ in batch], raise_on_error=False
+            )
+        except Exception as e:
+            logger.error(f"Failed to apply a batch of {len(batch)} aggregate update(s): {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        resolve_batch(batch, results)
+
+    async def _submit(self, batch):
+        await self._slots.acquire()
+        task = asyncio.create_task(self._apply_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Apply every queued update and wait for batches still in flight."""
+        while self._pending:
+            await self._submit(self._take_batch())
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    async def run(self):
+        logger.info(
+            f"Async aggregate update batcher started; batch_size={self.max_batch_size}, "
+            f"max_delay={self.max_delay * 1000:.1f}ms"
+        )
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+            if len(self._pending) < self.max_batch_size and self.max_delay:
+                await asyncio.sleep(self.max_delay)
+            await self._submit(self._take_batch())
+
+
+def mqtt_client_options(client_id, region, broker, port):
+    """``aiomqtt.Client`` options from the same environment as ``setup_mqtt_client``."""
+    options = {
+        "hostname": broker,
+        "port": int(port),
+        "identifier": client_id,
+        "protocol": aiomqtt.ProtocolVersion.V311,
+        "keepalive": 60,
+    }
+    username = get_region_secret("MQTT_USERNAME", region)
+    password = get_region_secret("MQTT_PASSWORD", region)
+    if username and password:
+        options["username"] = username
+        options["password"] = password
+    if os.getenv("MQTT_TLS_ENABLED", "true").lower() in ("1", "true", "yes"):
+        tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        tls_context.load_verify_locations(cafile=os.environ["MQTT_TLS_CA"])
+        tls_context.load_cert_chain(
+            certfile=os.environ["MQTT_TLS_CERT"], keyfile=os.environ["MQTT_TLS_KEY"]
+        )
+        options["tls_context"] = tls_context
+        options["tls_insecure"] = False
+    return options
+
+
+async def ingest(mqtt_client, userdata, batcher):
+    """Subscribe and feed every received uplink through ``handle_message``."""
+    region = userdata["region"]
+    topic = userdata["fog_sub_topic"]
+    await mqtt_client.subscribe(topic, qos=1)
+    logger.info(f"[{region}] Subscribed to topic at QoS 1: {topic}")
+    async for message in mqtt_client.messages:
+        received_at_fog = datetime.now(timezone.utc)
+        if drop_if_paused(region, str(message.topic)):
+            continue
+        handle_message(userdata, str(message.topic), message.payload, received_at_fog)
+        # Hold further messages in aiomqtt's bounded queue while Redis is behind
+        await batcher.wait_for_room()
+
+
+async def _publish(
+    mqtt_client, slots, central_topic, messages, envelope_compression, publish_timeout, region
+):
+    """Publish one group at QoS 1; returns None once acknowledged, else the error."""
+    async with slots:
+        in_flight = publish_in_flight_gauge.labels(region=region)
+        in_flight.inc()
+        started = time.monotonic()
+        try:
+            await mqtt_client.publish(
+                central_topic,
+                _encode_group(messages, envelope_compression),
+                qos=1,
+                timeout=publish_timeout,
+            )
+        except Exception as e:
+            return e
+        finally:
+            in_flight.dec()
+        publish_ack_latency_histogram.labels(region=region).observe(
+            time.monotonic() - started
+        )
+        return None
+
+
+async def drain_outbox(
+    mqtt_client,
+    aggregation_store,
+    region,
+    central_topic,
+    outbox_batch_size=100,
+    publish_retry_delay=5,
+    max_in_flight=20,
+    publish_timeout=10,
+    envelope_compression=None,
+    envelope_max_messages=100,
+):
+    """
+    Publish due outbox messages concurrently, with up to ``max_in_flight``
+    QoS 1 publishes awaiting their PUBACK. Claims, acknowledges, defers and
+    counts messages exactly like the threaded ``aggregator.drain_outbox``,
+    priority outbox first.
+    """
+    slots = asyncio.Semaphore(max(int(max_in_flight), 1))
+    total_published = 0
+    while True:
+        for priority in _outbox_lanes(aggregation_store):
+            claimed_messages = await aggregation_store.claim_outbox_batch(
+                region, outbox_batch_size, priority=priority
+            )
+            if claimed_messages:
+                break
+        else:
+            return total_published
+        groups = list(
+            _publish_groups(claimed_messages, envelope_compression, envelope_max_messages)
+        )
+        started = stage_timers.start()
+        errors = await asyncio.gather(
+            *(
+                _publish(
+                    mqtt_client,
+                    slots,
+                    central_topic,
+                    messages,
+                    envelope_compression,
+                    publish_timeout,
+                    region,
+                )
+                for _, messages in groups
+            )
+        )
+        stage_timers.observe(region, "publish", started)
+        completed = [
+            (raw_messages, error) for (raw_messages, _), error in zip(groups, errors)
+        ]
+
+        published, failed = _record_publish_results(
+            region, dict(claimed_messages), completed, publish_retry_delay
+        )
+        await aggregation_store.acknowledge_outbox_batch(
+            region, published, priority=priority
+        )
+        if failed:
+            await aggregation_store.defer_outbox_batch(
+                region, failed, publish_retry_delay, priority=priority
+            )
+        total_published += len(published)
+        if failed or (not priority and len(claimed_messages) < outbox_batch_size):
+            return total_published
+
+
+async def flush_windows(aggregation_store, batcher, region, aggregation_interval, outbox_ready):
+    """Move the region's window into the outbox every ``aggregation_interval``."""
+    next_flush = time.monotonic() + aggregation_interval
+    while True:
+        await asyncio.sleep(max(next_flush - time.monotonic(), 0))
+        next_flush = time.monotonic() + aggregation_interval
+        try:
+            await batcher.flush()
+            queued = await aggregation_store.flush_window(region, aggregation_interval)
+        except Exception as e:
+            logger.error(f"[{region}] Failed to flush aggregate window: {e}")
+            continue
+        if queued >= 0:
+            logger.info(f"[{region}] Queued {queued} aggregate(s) in the durable outbox")
+            outbox_ready.set()
+
+
+async def publish_outbox(
+    mqtt_client,
+    aggregation_store,
+    region,
+    central_topic,
+    outbox_ready,
+    outbox_poll_interval=1,
+    outbox_wake_timeout=30,
+    **drain_options,
+):
+    """
+    Drain the outbox after every flush. While the outbox is empty, wait for
+    a replica's flush or an event reading to queue a message, for at most
+    ``outbox_wake_timeout`` seconds; otherwise drain every
+    ``outbox_poll_interval``.
+    """
+    while True:
+        outbox_ready.clear()
+        backlog = None
+        try:
+            await drain_outbox(
+                mqtt_client, aggregation_store, region, central_topic, **drain_options
+            )
+            backlog = await aggregation_store.outbox_size(region)
+            outbox_messages_gauge.labels(region=region).set(backlog)
+            if aggregation_store.priority_events:
+                priority_backlog = await aggregation_store.outbox_size(region, priority=True)
+                priority_outbox_messages_gauge.labels(region=region).set(priority_backlog)
+                backlog += priority_backlog
+        except Exception as e:
+            logger.error(f"[{region}] Failed to drain the outbox: {e}")
+        try:
+            if backlog == 0 and outbox_wake_timeout:
+                await aggregation_store.wait_for_outbox(region, outbox_wake_timeout)
+            else:
+                await asyncio.wait_for(outbox_ready.wait(), outbox_poll_interval)
+        except asyncio.TimeoutError:
+            pass
+        except Exception as e:
+            logger.error(f"[{region}] Failed to wait for outbox messages: {e}")
+            await asyncio.sleep(outbox_poll_interval)
+
+
+async def connect_store(aggregation_store, redis_target, retry_seconds=5):
+    while True:
+        try:
+            await aggregation_store.ping()
+            logger.info(f"Connected to fog state store at {redis_target}")
+            return aggregation_store
+        except Exception as e:
+            logger.warning(
+                f"Fog state store {redis_target} is not reachable yet: {e}. "
+                f"Retrying in {retry_seconds} seconds."
+            )
+            await asyncio.sleep(retry_seconds)
+
+
+async def _run_until_first_error(*coroutines):
+    """Run coroutines as tasks; cancel the rest and re-raise once one fails."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_fog_node(
+    aggregation_store,
+    region,
+    fog_sub_topic,
+    central_topic,
+    mqtt_options,
+    aggregation_interval,
+    outbox_poll_interval=1,
+    publish_retry_delay=5,
+    outbox_batch_size=100,
+    max_in_flight=20,
+    publish_timeout=10,
+    envelope_compression=None,
+    envelope_max_messages=100,
+    update_batch_size=100,
+    update_batch_max_delay=0.005,
+    mqtt_connect_retry_seconds=5,
+    outbox_wake_timeout=30,
+    max_queued_messages=1000,
+):
+    """
+    Run the fog node on the current event loop. Flushes and update batching
+    keep running across MQTT reconnects; ingest and publishing restart with
+    every new connection. aiomqtt buffers at most ``max_queued_messages``
+    received messages (0 for no limit) and discards further ones while
+    ingest waits for the update batcher.
+    """
+    if aiomqtt is None:
+        raise RuntimeError("RUNTIME=asyncio requires the aiomqtt package")
+
+    batcher = AsyncUpdateBatcher(
+        aggregation_store, update_batch_size, update_batch_max_delay
+    )
+    outbox_ready = asyncio.Event()
+    background = [
+        asyncio.create_task(batcher.run(), name="aggregate-update-batcher"),
+        asyncio.create_task(
+            flush_windows(
+                aggregation_store, batcher, region, aggregation_interval, outbox_ready
+            ),
+            name="window-flush",
+        ),
+    ]
+    userdata = {
+        "region": region,
+        "fog_sub_topic": fog_sub_topic,
+        "aggregation_store": batcher,
+    }
+    logger.info(
+        f"[{region}] asyncio runtime started; interval={aggregation_interval}s, "
+        f"outbox_poll={outbox_poll_interval}s, outbox_wake_timeout={outbox_wake_timeout}s"
+    )
+    try:
+        while True:
+            try:
+                async with aiomqtt.Client(
+                    max_inflight_messages=max(int(max_in_flight), 20),
+                    max_queued_incoming_messages=max_queued_messages,
+                    **mqtt_options,
+                ) as mqtt_client:
+                    logger.info(f"[{region}] Connected to MQTT broker")
+                    await _run_until_first_error(
+                        ingest(mqtt_client, userdata, batcher),
+                        publish_outbox(
+                            mqtt_client,
+                            aggregation_store,
+                            region,
+                            central_topic,
+                            outbox_ready,
+                            outbox_poll_interval,
+                            outbox_wake_timeout,
+                            outbox_batch_size=outbox_batch_size,
+                            publish_retry_delay=publish_retry_delay,
+                            max_in_flight=max_in_flight,
+                            publish_timeout=publish_timeout,
+                            envelope_compression=envelope_compression,
+                            envelope_max_messages=envelope_max_messages,
+                        ),
+                    )
+            except (aiomqtt.MqttError, OSError) as e:
+                logger.warning(
+                    f"[{region}] MQTT connection lost: {e}. "
+                    f"Reconnecting in {mqtt_connect_retry_seconds} seconds."
+                )
+            await asyncio.sleep(mqtt_connect_retry_seconds)
+    finally:
+        for task in background:
+            task.cancel()
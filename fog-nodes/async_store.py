@@ -0,0 +1,297 @@
+"""
+``redis.asyncio`` front end for the fog aggregation store.
+
+``AsyncRedisAggregationStore`` keeps the keys, Lua scripts and command
+building of ``RedisAggregationStore``; only the I/O methods are coroutines.
+Scripts registered on an asyncio client run through asyncio pipelines, so
+several batches can be in flight on one event loop.
+"""
+import time
+from datetime import datetime, timezone
+
+import redis.asyncio as aioredis
+from redis.asyncio.cluster import ClusterNode, RedisCluster
+from redis.asyncio.sentinel import Sentinel
+from redis.exceptions import NoScriptError
+
+from aggregation_store import (
+    OUTBOX_GROUP,
+    RedisAggregationStore,
+    _accepted,
+    _memory_usage,
+    _raw_messages,
+    _update_result,
+)
+from metrics import stage_timers
+from uplink import normalize_region
+
+
+class AsyncRedisAggregationStore(RedisAggregationStore):
+    """The same aggregation windows and outbox as ``RedisAggregationStore``, awaited."""
+
+    @classmethod
+    def from_connection(
+        cls,
+        host,
+        port=6379,
+        db=0,
+        password=None,
+        **kwargs,
+    ):
+        client = aioredis.Redis(
+            host=host,
+            port=int(port),
+            db=int(db),
+            password=password or None,
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            health_check_interval=30,
+        )
+        return cls(client, **kwargs)
+
+    @classmethod
+    def from_sentinel(
+        cls,
+        sentinels,
+        service_name,
+        db=0,
+        password=None,
+        sentinel_password=None,
+        **kwargs,
+    ):
+        sentinel = Sentinel(
+            sentinels,
+            min_other_sentinels=1,
+            sentinel_kwargs={
+                "password": sentinel_password or password or None,
+                "socket_connect_timeout": 5,
+                "socket_timeout": 5,
+            },
+            password=password or None,
+            db=int(db),
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            health_check_interval=30,
+        )
+        return cls(sentinel.master_for(service_name), **kwargs)
+
+    @classmethod
+    def from_cluster(cls, nodes, password=None, **kwargs):
+        client = RedisCluster(
+            startup_nodes=[ClusterNode(host, int(port)) for host, port in nodes],
+            password=password or None,
+            decode_responses=True,
+            socket_connect_timeout=5,
+            socket_timeout=5,
+            health_check_interval=30,
+        )
+        kwargs.setdefault("hash_tags", True)
+        return cls(client, **kwargs)
+
+    async def ping(self):
+        result = await self.client.ping()
+        if isinstance(self.client, RedisCluster):
+            await self.load_scripts()
+        return result
+
+    async def load_scripts(self):
+        for script in self._scripts:
+            script.sha = await self.client.script_load(script.script)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def _execute(self, pipeline, raise_on_error=True):
+        try:
+            results = await pipeline.execute(raise_on_error=raise_on_error)
+        except NoScriptError:
+            await self.load_scripts()
+            raise
+        if any(isinstance(result, NoScriptError) for result in results):
+            await self.load_scripts()
+        return results
+
+    async def update(
+        self,
+        device_id,
+        device_name,
+        region,
+        temperature,
+        humidity,
+        event_detected,
+        reading_id=None,
+        event_time=None,
+    ):
+        keys, args = self._update_command(
+            device_id,
+            device_name,
+            region,
+            temperature,
+            humidity,
+            event_detected,
+            reading_id,
+            event_time,
+        )
+        started = stage_timers.start()
+        result = await self._update(keys=keys, args=args)
+        stage_timers.observe(normalize_region(region), "redis_update", started)
+        return _accepted(result)
+
+    async def update_many(self, readings, raise_on_error=True):
+        readings = list(readings)
+        if not readings:
+            return []
+        started = stage_timers.start()
+        pipeline = self.client.pipeline(transaction=False)
+        for reading in readings:
+            keys, args = self._update_command(*reading)
+            await self._update(keys=keys, args=args, client=pipeline)
+        results = await self._execute(pipeline, raise_on_error)
+        stage_timers.observe(normalize_region(readings[0][2]), "redis_update", started)
+        return [_update_result(result) for result in results]
+
+    async def merge_many(self, partials):
+        partials = list(partials)
+        if not partials:
+            return []
+        started = stage_timers.start()
+        pipeline = self.client.pipeline(transaction=False)
+        for partial in partials:
+            keys, args = self._merge_command(*partial)
+            await self._merge(keys=keys, args=args, client=pipeline)
+        results = await self._execute(pipeline)
+        stage_timers.observe(normalize_region(partials[0][2]), "redis_merge", started)
+        return [[bool(flag) for flag in flags] for flags in results]
+
+    async def flush_window(self, region, aggregation_interval, now=None):
+        started = stage_timers.start()
+        queued = await self._flush_window(region, aggregation_interval, now)
+        stage_timers.observe(region, "flush", started)
+        return queued
+
+    async def _flush_window(self, region, aggregation_interval, now):
+        if self.window_time == "event":
+            return await self.flush_event_windows(region, now)
+        now, window_id, marker_key, marker_ttl = self._window(
+            region, aggregation_interval, now
+        )
+
+        if self.flush_mode == "chunked":
+            frozen = await self.snapshot_window(
+                region, window_id, marker_key, marker_ttl, now
+            )
+            queued = await self.drain_snapshots(region, now.timestamp())
+            return -1 if frozen < 0 and not queued else queued
+
+        keys, args = self._flush_command(
+            region, window_id, marker_key, marker_ttl, now
+        )
+        return int(await self._flush(keys=keys, args=args))
+
+    async def snapshot_window(self, region, window_id, marker_key, marker_ttl, now):
+        keys, args = self._snapshot_command(
+            region, window_id, marker_key, marker_ttl, now
+        )
+        return int(await self._snapshot(keys=keys, args=args))
+
+    async def drain_snapshots(self, region, score=None):
+        keys, args = self._drain_command(
+            region, time.time() if score is None else float(score)
+        )
+        queued = 0
+        while True:
+            chunk_queued, snapshots_left = await self._drain_snapshot(
+                keys=keys, args=args
+            )
+            queued += int(chunk_queued)
+            if not int(snapshots_left):
+                return queued
+
+    async def flush_event_windows(self, region, now=None):
+        keys, args = self._event_flush_command(
+            region, now or datetime.now(timezone.utc)
+        )
+        queued = 0
+        while True:
+            step_queued, windows = await self._flush_event(keys=keys, args=args)
+            queued += int(step_queued)
+            if not int(windows):
+                return queued
+
+    async def claim_outbox_message(self, region, now=None):
+        claimed = await self.claim_outbox_batch(region, 1, now)
+        return claimed[0] if claimed else None
+
+    async def claim_outbox_batch(self, region, n, now=None, priority=False):
+        started = stage_timers.start()
+        keys, args = self._claim_batch_command(region, n, now, priority)
+        claimed = self._claimed(await self._claim_batch(keys=keys, args=args))
+        stage_timers.observe(region, "outbox_claim", started)
+        return claimed
+
+    async def acknowledge_outbox_message(self, region, raw_message):
+        return await self.acknowledge_outbox_batch(region, [raw_message])
+
+    async def acknowledge_outbox_batch(self, region, items, priority=False):
+        raw_messages = _raw_messages(items)
+        if not raw_messages:
+            return 0
+        started = stage_timers.start()
+        key = self._lane_key(region, priority)
+        if self.outbox_backend == "stream":
+            removed = await self._acknowledge_stream(
+                keys=[key], args=[OUTBOX_GROUP, *raw_messages]
+            )
+        else:
+            removed = await self.client.zrem(key, *raw_messages)
+        stage_timers.observe(region, "outbox_ack", started)
+        return removed
+
+    async def defer_outbox_message(self, region, raw_message, retry_delay):
+        return await self.defer_outbox_batch(region, [raw_message], retry_delay)
+
+    async def defer_outbox_batch(self, region, items, retry_delay, priority=False):
+        raw_messages = _raw_messages(items)
+        if not raw_messages:
+            return 0
+        key = self._lane_key(region, priority)
+        if self.outbox_backend == "stream":
+            return len(
+                await self.client.xclaim(
+                    key,
+                    OUTBOX_GROUP,
+                    self.outbox_consumer,
+                    0,
+                    raw_messages,
+                    idle=self._deferred_idle(retry_delay),
+                    justid=True,
+                )
+            )
+        retry_at = time.time() + float(retry_delay)
+        return await self.client.zadd(
+            key, {raw_message: retry_at for raw_message in raw_messages}
+        )
+
+    async def outbox_size(self, region, priority=False):
+        key = self._lane_key(region, priority)
+        if self.outbox_backend == "stream":
+            return await self.client.xlen(key)
+        return await self.client.zcard(key)
+
+    async def memory_usage(self):
+        return _memory_usage(await self.client.info("memory"))
+
+    async def wait_for_outbox(self, region, timeout):
+        wake_key = self._wake_key(region)
+        pipeline = self.client.pipeline(transaction=False)
+        waiter = self._register_waiter(pipeline, region, timeout)
+        await pipeline.execute()
+        try:
+            for block in self._wake_timeouts(timeout):
+                if await self.client.blpop([wake_key], block):
+                    return True
+            return False
+        finally:
+            await self.client.zrem(self._waiters_key(region), waiter)
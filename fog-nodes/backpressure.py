@@ -0,0 +1,176 @@
+"""
+Backpressure from the durable outbox to MQTT ingest.
+
+While central is unreachable the outbox stops draining, yet ingest keeps
+queuing aggregates and events until Redis runs out of memory. The controller
+checks each region's outbox depth and Redis memory use every ``interval``
+seconds and moves the region between three states:
+
+* ``normal``: every reading is aggregated.
+* ``shedding``: readings that trip no event rule are dropped; events are
+  still aggregated and queued in the priority outbox.
+* ``paused``: every message of the region is dropped on receipt, events
+  included, before it reaches Redis.
+
+A region starts shedding once a signal reaches its ``high`` watermark and
+pauses once one reaches its ``pause`` watermark. It stops pausing when every
+signal is below ``high`` again, and goes back to normal only when every
+signal is at or below ``low``, so a signal hovering around one watermark does
+not flap between states. A ``high`` of 0 ignores that signal.
+
+Pausing never blocks an MQTT callback or stops reading the socket: the same
+client publishes the outbox to central, and its network loop must keep
+running for the outbox to drain and the pause to end. The subscription is
+kept too. Every replica of a region sees the same outbox depth and pauses at
+the same moment, so unsubscribing would leave the shared subscription group
+empty and the broker would drop the region's uplinks anyway.
+"""
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+
+from uplink import normalize_region
+
+logger = logging.getLogger(__name__)
+
+NORMAL, SHEDDING, PAUSED = 0, 1, 2
+STATES = ("normal", "shedding", "paused")
+
+Watermarks = namedtuple("Watermarks", ("low", "high", "pause"), defaults=(0, 0, 0))
+
+
+def _watermarks(name, low, high, pause):
+    watermarks = Watermarks(float(low), float(high), float(pause))
+    if watermarks.high and not 0 <= watermarks.low <= watermarks.high:
+        raise ValueError(f"{name} low watermark must be between 0 and the high watermark")
+    if watermarks.pause and watermarks.pause < watermarks.high:
+        raise ValueError(f"{name} pause watermark must not be below the high watermark")
+    return watermarks
+
+
+def next_state(state, signals):
+    """
+    Return the state that follows ``state`` for ``(value, Watermarks)``
+    signals. A value of None (not measured) is ignored.
+    """
+    entered = NORMAL
+    held = NORMAL
+    for value, (low, high, pause) in signals:
+        if value is None or not high:
+            continue
+        if pause and value >= pause:
+            entered = PAUSED
+        elif value >= high:
+            entered = max(entered, SHEDDING)
+        if value >= high:
+            held = PAUSED
+        elif value > low:
+            held = max(held, SHEDDING)
+    return max(entered, min(state, held))
+
+
+class BackpressureController:
+    """Per-region ingest throttling driven by outbox depth and Redis memory."""
+
+    def __init__(self, state_gauge):
+        self.state_gauge = state_gauge
+        self._states = {}
+        self._thread = None
+        self._stop = threading.Event()
+        self.configure()
+
+    def configure(self, outbox=(), memory=(), interval=2):
+        """
+        ``outbox`` holds ``(low, high, pause)`` outbox messages per region and
+        ``memory`` the same as fractions of Redis ``maxmemory``.
+        """
+        self.outbox = _watermarks("Outbox", *Watermarks(*outbox))
+        self.memory = _watermarks("Memory", *Watermarks(*memory))
+        self.interval = max(float(interval), 0.1)
+        return self
+
+    @property
+    def enabled(self):
+        return bool(self.outbox.high or self.memory.high)
+
+    def state(self, region):
+        return self._states.get(normalize_region(region), NORMAL)
+
+    def shedding(self, region):
+        """True while non-event readings of ``region`` should be dropped."""
+        return self._states.get(normalize_region(region), NORMAL) >= SHEDDING
+
+    def paused(self, region):
+        """True while every message of ``region`` should be dropped on receipt."""
+        return self._states.get(normalize_region(region), NORMAL) == PAUSED
+
+    def update(self, region, outbox_depth=None, memory_usage=None):
+        """Apply one measurement of the signals; returns the region's new state."""
+        region = normalize_region(region)
+        previous = self._states.get(region, NORMAL)
+        state = next_state(
+            previous, ((outbox_depth, self.outbox), (memory_usage, self.memory))
+        )
+        if state != previous:
+            self._states[region] = state
+            log = logger.warning if state > previous else logger.info
+            log(
+                f"[{region}] Backpressure {STATES[previous]} -> {STATES[state]}; "
+                f"outbox={outbox_depth}, redis_memory={memory_usage}"
+            )
+        self.state_gauge.labels(region=region).set(state)
+        return state
+
+    def _depth(self, aggregation_store, region):
+        depth = aggregation_store.outbox_size(region)
+        if aggregation_store.priority_events:
+            depth += aggregation_store.outbox_size(region, priority=True)
+        return depth
+
+    def check(self, aggregation_store, regions):
+        memory_usage = aggregation_store.memory_usage() if self.memory.high else None
+        for region in regions:
+            depth = self._depth(aggregation_store, region) if self.outbox.high else None
+            self.update(region, depth, memory_usage)
+
+    async def check_async(self, aggregation_store, regions):
+        memory_usage = None
+        if self.memory.high:
+            memory_usage = await aggregation_store.memory_usage()
+        for region in regions:
+            depth = None
+            if self.outbox.high:
+                depth = await aggregation_store.outbox_size(region)
+                if aggregation_store.priority_events:
+                    depth += await aggregation_store.outbox_size(region, priority=True)
+            self.update(region, depth, memory_usage)
+
+    def start(self, aggregation_store, regions):
+        if self._thread is None and self.enabled:
+            self._thread = threading.Thread(
+                target=self.run,
+                args=(aggregation_store, list(regions)),
+                name="backpressure",
+                daemon=True,
+            )
+            self._thread.start()
+        return self
+
+    def run(self, aggregation_store, regions):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check(aggregation_store, regions)
+            except Exception as e:
+                # Keep the current states until Redis answers again
+                logger.error(f"Backpressure check failed: {e}")
+
+    async def run_async(self, aggregation_store, regions):
+        if not self.enabled:
+            return
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check_async(aggregation_store, regions)
+            except Exception as e:
+                logger.error(f"Backpressure check failed: {e}")
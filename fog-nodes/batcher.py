@@ -0,0 +1,134 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from aggregation_store import Reading
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_batch(batch, results):
+    """
+    Resolve each reading's future from its own pipeline result. Readings that
+    failed get their exception; the rest of the batch was applied and must
+    not be redelivered.
+    """
+    failures = 0
+    for (_, future), result in zip(batch, results):
+        if isinstance(result, Exception):
+            failures += 1
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+    if failures:
+        logger.error(f"{failures} of {len(batch)} batched aggregate update(s) failed")
+
+
+class UpdateBatcher:
+    """
+    Collect aggregate updates for a few milliseconds and apply them with one
+    pipelined Redis round trip.
+
+    ``update`` takes the same arguments as ``RedisAggregationStore.update`` but
+    returns immediately with a Future that resolves to the accepted flag.
+    """
+
+    def __init__(
+        self,
+        aggregation_store,
+        max_batch_size=100,
+        max_delay=0.005,
+        max_pending=None,
+    ):
+        self.aggregation_store = aggregation_store
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.max_delay = max(float(max_delay), 0)
+        self._queue = queue.Queue(maxsize=max_pending or self.max_batch_size * 10)
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self.run, name="aggregate-update-batcher", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def update(
+        self,
+        device_id,
+        device_name,
+        region,
+        temperature,
+        humidity,
+        event_detected,
+        reading_id=None,
+        event_time=None,
+    ):
+        future = Future()
+        reading = Reading(
+            device_id,
+            device_name,
+            region,
+            temperature,
+            humidity,
+            event_detected,
+            reading_id,
+            event_time,
+        )
+        # Blocks when the batcher falls behind, which slows the MQTT loop
+        # instead of buffering without limit.
+        self._queue.put((reading, future))
+        return future
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _collect_batch(self, timeout=None):
+        batch = [self._queue.get(timeout=timeout)]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _apply_batch(self, batch):
+        try:
+            results = self.aggregation_store.update_many(
+                [reading for reading, _ in batch], raise_on_error=False
+            )
+        except Exception as e:
+            logger.error(f"Failed to apply a batch of {len(batch)} aggregate update(s): {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        resolve_batch(batch, results)
+
+    def flush(self):
+        """Apply every queued update on the calling thread."""
+        while True:
+            try:
+                batch = self._collect_batch(timeout=0)
+            except queue.Empty:
+                return
+            self._apply_batch(batch)
+
+    def run(self):
+        logger.info(
+            f"Aggregate update batcher started; batch_size={self.max_batch_size}, "
+            f"max_delay={self.max_delay * 1000:.1f}ms"
+        )
+        while True:
+            self._apply_batch(self._collect_batch())
@@ -0,0 +1,93 @@
+"""
+Time JSON decoding of ChirpStack uplinks and encoding of aggregates.
+
+    python -m benchmarks.codec_benchmark --iterations 20000
+    python -m benchmarks.codec_benchmark --sample path/to/uplink.json
+
+Uplinks are read as raw bytes, exactly as they arrive in ``msg.payload``. The
+``legacy`` row is the old ``json.loads(payload.decode())`` path; the others go
+through each available codec backend. Results are printed as JSON.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import timeit
+
+import codec
+from benchmarks.envelope_benchmark import sample_aggregates
+
+SAMPLES = os.path.join(os.path.dirname(__file__), "samples", "chirpstack_uplink_*.json")
+
+
+def _backends():
+    backends = {
+        "legacy": (
+            lambda payload: json.loads(payload.decode()),
+            lambda obj: json.dumps(obj).encode("utf-8"),
+        ),
+        "json": (
+            json.loads,
+            lambda obj: json.dumps(obj, separators=(",", ":")).encode("utf-8"),
+        ),
+    }
+    if codec.orjson is not None:
+        backends["orjson"] = (codec.orjson.loads, codec.orjson.dumps)
+    return backends
+
+
+def _per_second(function, argument, iterations):
+    seconds = min(timeit.repeat(lambda: function(argument), number=iterations, repeat=3))
+    return iterations / seconds if seconds else 0
+
+
+def run(samples, iterations):
+    aggregate = sample_aggregates(1)[0]
+    results = []
+    for name, (loads, dumps) in _backends().items():
+        for path in samples:
+            with open(path, "rb") as sample:
+                payload = sample.read()
+            results.append(
+                {
+                    "backend": name,
+                    "operation": "decode-uplink",
+                    "sample": os.path.basename(path),
+                    "payload_bytes": len(payload),
+                    "per_second": _per_second(loads, payload, iterations),
+                }
+            )
+        results.append(
+            {
+                "backend": name,
+                "operation": "encode-aggregate",
+                "payload_bytes": len(dumps(aggregate)),
+                "per_second": _per_second(dumps, aggregate, iterations),
+            }
+        )
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sample", action="append", help="uplink JSON file; repeatable")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    samples = args.sample or sorted(glob.glob(SAMPLES))
+    json.dump(
+        {
+            "benchmark": "json-codec",
+            "active_backend": codec.backend(),
+            "iterations": args.iterations,
+            "results": run(samples, args.iterations),
+        },
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Compare Redis memory and false-positive rate of the deduplication backends.
+
+Run from the fog-nodes directory against a disposable Redis server:
+
+    python -m benchmarks.dedupe_benchmark --redis-url redis://localhost:6379/15 --readings 200000
+
+Every key written by the benchmark uses a random prefix and is deleted
+afterwards. Results are printed as JSON.
+"""
+import argparse
+import json
+import sys
+import time
+import uuid
+
+import redis
+
+from aggregation_store import Reading, RedisAggregationStore
+
+
+def _scan_memory(client, pattern):
+    keys = 0
+    memory = 0
+    for key in client.scan_iter(pattern, count=1000):
+        keys += 1
+        memory += client.memory_usage(key, samples=0) or 0
+    return keys, memory
+
+
+def _delete(client, pattern):
+    batch = []
+    for key in client.scan_iter(pattern, count=1000):
+        batch.append(key)
+        if len(batch) == 1000:
+            client.delete(*batch)
+            batch = []
+    if batch:
+        client.delete(*batch)
+
+
+def _seen(client, store, reading_ids):
+    """Ask the backend whether it already knows each ID without recording it."""
+    backend = store.deduplication
+    pipeline = client.pipeline(transaction=False)
+    shared_keys = backend.shared_keys()
+    for reading_id in reading_ids:
+        if shared_keys:
+            for key in shared_keys:
+                for offset in backend.reading_args(reading_id)[1:]:
+                    pipeline.getbit(key, offset)
+        else:
+            pipeline.exists(*backend.reading_keys(reading_id))
+    results = pipeline.execute()
+    if not shared_keys:
+        return [bool(result) for result in results]
+
+    per_bucket = backend.hashes
+    per_reading = per_bucket * len(shared_keys)
+    seen = []
+    for start in range(0, len(results), per_reading):
+        bits = results[start:start + per_reading]
+        seen.append(
+            any(
+                all(bits[bucket:bucket + per_bucket])
+                for bucket in range(0, per_reading, per_bucket)
+            )
+        )
+    return seen
+
+
+def run_backend(client, backend, readings, probes, batch_size, options):
+    prefix = f"bench:dedupe:{uuid.uuid4().hex}"
+    store = RedisAggregationStore(
+        client,
+        prefix=prefix,
+        deduplication_backend=backend,
+        **options,
+    )
+    try:
+        started = time.perf_counter()
+        for start in range(0, readings, batch_size):
+            store.update_many(
+                Reading("device-1", "Sensor 1", "bench", 20, 50, False, f"seen-{index}")
+                for index in range(start, min(start + batch_size, readings))
+            )
+        insert_seconds = time.perf_counter() - started
+
+        keys, memory = _scan_memory(client, f"{prefix}:dedupe*")
+
+        false_positives = 0
+        for start in range(0, probes, batch_size):
+            seen = _seen(
+                client,
+                store,
+                [f"new-{index}" for index in range(start, min(start + batch_size, probes))],
+            )
+            false_positives += seen.count(True)
+
+        duplicates_missed = sum(
+            store.update_many(
+                Reading("device-1", "Sensor 1", "bench", 20, 50, False, f"seen-{index}")
+                for index in range(min(probes, readings))
+            )
+        )
+
+        return {
+            "backend": backend,
+            "readings": readings,
+            "dedupe_keys": keys,
+            "dedupe_memory_bytes": memory,
+            "bytes_per_reading": memory / readings if readings else 0,
+            "false_positive_rate": false_positives / probes if probes else 0,
+            "missed_duplicates": duplicates_missed,
+            "insert_readings_per_second": readings / insert_seconds if insert_seconds else 0,
+        }
+    finally:
+        _delete(client, f"{prefix}:*")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--readings", type=int, default=100000)
+    parser.add_argument("--probes", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--ttl", type=int, default=86400)
+    parser.add_argument("--bloom-capacity", type=int, default=None)
+    parser.add_argument("--bloom-error-rate", type=float, default=0.001)
+    parser.add_argument("--bloom-bucket-seconds", type=int, default=3600)
+    args = parser.parse_args(argv)
+
+    client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    client.ping()
+    common = {"deduplication_ttl": args.ttl}
+    bloom = {
+        **common,
+        "bloom_capacity": args.bloom_capacity or args.readings,
+        "bloom_error_rate": args.bloom_error_rate,
+        "bloom_bucket_seconds": args.bloom_bucket_seconds,
+    }
+    results = [
+        run_backend(client, "key", args.readings, args.probes, args.batch_size, common),
+        run_backend(client, "bloom", args.readings, args.probes, args.batch_size, bloom),
+    ]
+    json.dump({"benchmark": "deduplication", "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Estimate bytes and MQTT messages per window for the central topic formats.
+
+    python -m benchmarks.envelope_benchmark --devices 5000 --envelope-size 100
+
+Aggregates mirror what _FLUSH_WINDOW queues. Sizes include the MQTT PUBLISH
+fixed header, topic and packet id, but not TLS record overhead. Results are
+printed as JSON.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import codec
+from envelope import COMPRESSION_CODES, decode_envelope, encode_envelope, zstandard
+
+
+def _remaining_length_size(length):
+    size = 1
+    while length >= 128:
+        length //= 128
+        size += 1
+    return size
+
+
+def mqtt_publish_size(topic, payload):
+    """Bytes on the wire for one QoS 1 PUBLISH."""
+    variable = 2 + len(topic.encode("utf-8")) + 2 + len(payload)
+    return 1 + _remaining_length_size(variable) + variable
+
+
+def sample_aggregates(devices, region="eu868", seed=7):
+    rng = random.Random(seed)
+    window_id = f"{region}-{int(time.time()) // 300}-{uuid.UUID(int=rng.getrandbits(128)).hex}"
+    timestamp = datetime.now(timezone.utc).isoformat()
+    return [
+        {
+            "aggregate_id": f"{window_id}:{index:016x}",
+            "device_id": f"{index:016x}",
+            "device_name": f"sensor-{region}-{index}",
+            "region": region,
+            "avg_temperature": round(rng.uniform(-10, 40), 6),
+            "avg_humidity": round(rng.uniform(10, 95), 6),
+            "sample_count": rng.randint(20, 40),
+            "timestamp": timestamp,
+            "event": rng.random() < 0.05,
+        }
+        for index in range(devices)
+    ]
+
+
+def measure(aggregates, topic, envelope_size, compression):
+    started = time.perf_counter()
+    if compression is None:
+        payloads = [codec.dumps(aggregate) for aggregate in aggregates]
+    else:
+        payloads = [
+            encode_envelope(aggregates[start:start + envelope_size], compression)
+            for start in range(0, len(aggregates), envelope_size)
+        ]
+    encode_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    decoded = 0
+    for payload in payloads:
+        decoded += len(decode_envelope(payload)) if compression else 1
+    decode_seconds = time.perf_counter() - started
+
+    return {
+        "format": "json" if compression is None else f"envelope-{compression}",
+        "messages": len(payloads),
+        "payload_bytes": sum(len(payload) for payload in payloads),
+        "wire_bytes": sum(mqtt_publish_size(topic, payload) for payload in payloads),
+        "encode_seconds": encode_seconds,
+        "decode_seconds": decode_seconds,
+        "aggregates_decoded": decoded,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--devices", type=int, default=5000)
+    parser.add_argument("--envelope-size", type=int, default=100)
+    parser.add_argument("--topic", default="central/data")
+    args = parser.parse_args(argv)
+
+    aggregates = sample_aggregates(args.devices)
+    compressions = [None] + [
+        compression
+        for compression in COMPRESSION_CODES
+        if compression != "zstd" or zstandard is not None
+    ]
+    results = [
+        measure(aggregates, args.topic, args.envelope_size, compression)
+        for compression in compressions
+    ]
+    baseline = results[0]
+    for result in results:
+        result["messages_saved"] = baseline["messages"] - result["messages"]
+        result["wire_bytes_saved"] = baseline["wire_bytes"] - result["wire_bytes"]
+    json.dump(
+        {
+            "benchmark": "central-envelope",
+            "devices_per_window": args.devices,
+            "envelope_size": args.envelope_size,
+            "results": results,
+        },
+        sys.stdout,
+        indent=2,
+    )
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
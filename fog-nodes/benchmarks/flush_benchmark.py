@@ -0,0 +1,102 @@
+"""
+Measure how long other Redis clients stall while a window is flushed.
+
+Run from the fog-nodes directory against a disposable Redis server:
+
+    python -m benchmarks.flush_benchmark --redis-url redis://localhost:6379/15 --devices 1000,10000,50000
+
+A probe thread sends PING in a loop while each flush mode flushes a window of
+the given size; the probe's worst and p99 latency show how long Redis was
+blocked. Every key written by the benchmark uses a random prefix and is
+deleted afterwards. Results are printed as JSON.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import redis
+
+from aggregation_store import Reading, RedisAggregationStore
+from benchmarks.dedupe_benchmark import _delete
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+def _probe(client, stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        client.ping()
+        latencies.append(time.perf_counter() - started)
+
+
+def run_mode(client, probe_client, mode, devices, chunk_size, batch_size):
+    prefix = f"bench:flush:{uuid.uuid4().hex}"
+    store = RedisAggregationStore(
+        client,
+        prefix=prefix,
+        flush_mode=mode,
+        flush_chunk_size=chunk_size,
+    )
+    try:
+        for start in range(0, devices, batch_size):
+            store.update_many(
+                Reading(f"device-{index}", "Sensor", "bench", 20, 50, False)
+                for index in range(start, min(start + batch_size, devices))
+            )
+
+        latencies = []
+        stop = threading.Event()
+        probe = threading.Thread(target=_probe, args=(probe_client, stop, latencies))
+        probe.start()
+        time.sleep(0.05)
+        started = time.perf_counter()
+        queued = store.flush_window("bench", 300, datetime.now(timezone.utc))
+        flush_seconds = time.perf_counter() - started
+        time.sleep(0.05)
+        stop.set()
+        probe.join()
+
+        return {
+            "mode": mode,
+            "devices": devices,
+            "queued": queued,
+            "flush_seconds": flush_seconds,
+            "probe_samples": len(latencies),
+            "probe_max_ms": max(latencies, default=0) * 1000,
+            "probe_p99_ms": _percentile(latencies, 0.99) * 1000,
+        }
+    finally:
+        _delete(client, f"{prefix}:*")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--devices", default="1000,10000,50000")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+
+    client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    probe_client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    client.ping()
+    results = [
+        run_mode(client, probe_client, mode, int(devices), args.chunk_size, args.batch_size)
+        for devices in args.devices.split(",")
+        for mode in ("atomic", "chunked")
+    ]
+    json.dump({"benchmark": "window_flush", "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
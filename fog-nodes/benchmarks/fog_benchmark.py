@@ -0,0 +1,287 @@
+"""
+Measure end-to-end throughput and latency of one fog replica.
+
+Run from the fog-nodes directory against a disposable Redis server:
+
+    python -m benchmarks.fog_benchmark --redis-url redis://localhost:6379/15 --devices 2000 --uplinks-per-device 5
+    python -m benchmarks.fog_benchmark --batch-size 100 --output results.json
+
+Realistic ChirpStack uplinks for ``--devices`` devices spread over the four
+regions are generated from the sample in ``benchmarks/samples`` and fed
+through ``mqtt_client.on_message`` exactly as paho would deliver them. Each
+region's window is then flushed and its outbox drained through an in-process
+MQTT client that acknowledges every publish at once.
+
+The report has messages per second, latency percentiles for each stage
+(decode, processing, Redis update, the whole ``on_message``, flush and
+drain), Redis commands per message from ``INFO commandstats`` and Redis
+memory per device while the windows are open. Every key written by the
+benchmark uses a random prefix and is deleted afterwards. Results are
+printed as JSON, or written to ``--output``, so runs of different versions
+can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import paho.mqtt.client as mqtt
+import redis
+
+import codec
+import mqtt_client
+from aggregation_store import RedisAggregationStore
+from aggregator import drain_outbox
+from batcher import UpdateBatcher
+from benchmarks.dedupe_benchmark import _delete
+from logsampling import message_log, setup_logging
+
+SAMPLE = os.path.join(os.path.dirname(__file__), "samples", "chirpstack_uplink_eu868.json")
+REGIONS = ("eu868", "us915_0", "ru864", "in865")
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000
+
+    return {
+        "count": len(samples),
+        "p50_ms": at(0.5),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def generate_uplinks(devices, uplinks_per_device, event_ratio=0.01, seed=1):
+    """
+    Return ``(region, topic, payload bytes)`` for every uplink, device by
+    device interleaved as a network server would deliver them.
+    """
+    with open(SAMPLE, "rb") as sample_file:
+        template = codec.loads(sample_file.read())
+    rng = random.Random(seed)
+    started = datetime.now(timezone.utc) - timedelta(seconds=uplinks_per_device * 60)
+    uplinks = []
+    for sequence in range(uplinks_per_device):
+        for index in range(devices):
+            region = REGIONS[index % len(REGIONS)]
+            sent_at = started + timedelta(seconds=sequence * 60 + rng.random())
+            hot = rng.random() < event_ratio
+            payload = dict(template)
+            payload["deduplicationId"] = str(uuid.UUID(int=rng.getrandbits(128)))
+            payload["time"] = sent_at.isoformat()
+            payload["regionConfigId"] = region
+            payload["fCnt"] = sequence
+            payload["deviceInfo"] = dict(
+                template["deviceInfo"],
+                devEui=f"{index:016x}",
+                deviceName=f"{region}-sensor-{index:05d}",
+                deviceProfileName=f"THS-{region.upper()}",
+            )
+            payload["object"] = {
+                "temperature": round(rng.gauss(38 if hot else 22, 2), 2),
+                "humidity": round(min(max(rng.gauss(55, 10), 0), 79), 2),
+                "battery": round(rng.uniform(3.3, 3.7), 2),
+            }
+            payload["rxInfo"] = [
+                dict(gateway, nsTime=(sent_at - timedelta(milliseconds=200)).isoformat())
+                for gateway in template["rxInfo"]
+            ]
+            topic = f"region/{region}/application/sensiot/device/{index:016x}/event/up"
+            uplinks.append((region, topic, codec.dumps(payload)))
+    return uplinks
+
+
+class _AcknowledgedPublish:
+    rc = mqtt.MQTT_ERR_SUCCESS
+
+    def __init__(self, mid):
+        self.mid = mid
+
+    def is_published(self):
+        return True
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+
+class InstantBroker:
+    """Stands in for the central broker: every QoS 1 publish is acknowledged at once."""
+
+    def __init__(self):
+        self.published = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload, qos=0):
+        self.published += 1
+        self.bytes += len(payload)
+        return _AcknowledgedPublish(self.published)
+
+
+class StageTimer:
+    """Wrap callables so every call's duration is recorded under a stage name."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def wrap(self, stage, function):
+        samples = self.samples[stage]
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                samples.append(time.perf_counter() - started)
+
+        return timed
+
+    def report(self):
+        return {stage: _percentiles(samples) for stage, samples in self.samples.items()}
+
+
+def _command_calls(client):
+    return {
+        name[len("cmdstat_"):] if name.startswith("cmdstat_") else name: stats["calls"]
+        for name, stats in client.info("commandstats").items()
+    }
+
+
+def _command_delta(before, after):
+    delta = {name: calls - before.get(name, 0) for name, calls in after.items()}
+    return {name: calls for name, calls in delta.items() if calls > 0}
+
+
+def run(client, uplinks, devices, batch_size, options):
+    prefix = f"bench:fog:{uuid.uuid4().hex}"
+    store = RedisAggregationStore(client, prefix=prefix, **options)
+    timer = StageTimer()
+    store.update = timer.wrap("redis_update", store.update)
+    store.update_many = timer.wrap("redis_update_batch", store.update_many)
+    sink = store
+    pending = []
+    if batch_size > 1:
+        sink = UpdateBatcher(store, batch_size, 0.005).start()
+        batched_update = sink.update
+
+        def update(*args, **kwargs):
+            future = batched_update(*args, **kwargs)
+            pending.append(future)
+            return future
+
+        sink.update = update
+
+    original = (mqtt_client.decode_uplink, mqtt_client.process_message)
+    mqtt_client.decode_uplink = timer.wrap("decode", mqtt_client.decode_uplink)
+    mqtt_client.process_message = timer.wrap("process", mqtt_client.process_message)
+    on_message = timer.wrap("on_message", mqtt_client.on_message)
+    userdata = {
+        region: {"region": region, "aggregation_store": sink, "ingest_queue": None}
+        for region in REGIONS
+    }
+    try:
+        memory_before = client.info("memory")["used_memory"]
+        commands_before = _command_calls(client)
+        started = time.perf_counter()
+        for region, topic, payload in uplinks:
+            on_message(None, userdata[region], SimpleNamespace(topic=topic, payload=payload))
+        for future in pending:
+            future.result()
+        ingest_seconds = time.perf_counter() - started
+        commands_after_ingest = _command_calls(client)
+        memory_open = client.info("memory")["used_memory"]
+
+        broker = InstantBroker()
+        flush = timer.wrap("flush", store.flush_window)
+        drain = timer.wrap("drain", drain_outbox)
+        queued = 0
+        for region in REGIONS:
+            queued += max(flush(region, 300, datetime.now(timezone.utc)), 0)
+            drain(broker, store, region, "central/data", outbox_batch_size=100)
+        commands_after = _command_calls(client)
+    finally:
+        mqtt_client.decode_uplink, mqtt_client.process_message = original
+        _delete(client, f"{prefix}:*")
+
+    ingest_commands = _command_delta(commands_before, commands_after_ingest)
+    messages = len(uplinks)
+    return {
+        "messages": messages,
+        "devices": devices,
+        "batch_size": batch_size,
+        "ingest_seconds": ingest_seconds,
+        "messages_per_second": messages / ingest_seconds if ingest_seconds else 0,
+        "aggregates_queued": queued,
+        "aggregates_published": broker.published,
+        "latency": timer.report(),
+        "redis_commands_per_message": sum(ingest_commands.values()) / messages,
+        "redis_ingest_commands": ingest_commands,
+        "redis_flush_commands": _command_delta(commands_after_ingest, commands_after),
+        "redis_memory_per_device_bytes": (memory_open - memory_before) / devices,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--uplinks-per-device", type=int, default=5)
+    parser.add_argument("--event-ratio", type=float, default=0.01)
+    parser.add_argument(
+        "--batch-size", type=int, default=1,
+        help="Readings per pipelined update; 1 updates each reading directly",
+    )
+    parser.add_argument("--deduplication-backend", default="key")
+    parser.add_argument("--flush-mode", default="atomic")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    # Per-message logging would dominate the measurement
+    setup_logging("WARNING", 0)
+    message_log.configure(summary_interval=0)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    client.ping()
+    uplinks = generate_uplinks(args.devices, args.uplinks_per_device, args.event_ratio)
+    result = run(
+        client,
+        uplinks,
+        args.devices,
+        args.batch_size,
+        {
+            "deduplication_backend": args.deduplication_backend,
+            "flush_mode": args.flush_mode,
+        },
+    )
+    report = {
+        "benchmark": "fog_node",
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "codec": codec.backend(),
+        "redis_version": client.info("server")["redis_version"],
+        "results": [result],
+    }
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+            output.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Compare how fast several replicas drain the ZSET and Redis Streams outboxes.
+
+Run from the fog-nodes directory against a disposable Redis server:
+
+    python -m benchmarks.outbox_benchmark --redis-url redis://localhost:6379/15 --messages 50000 --replicas 1,4,8
+
+For each backend the outbox of one region is filled with ``--messages``
+window aggregates. Replica threads, each with its own connection and stream
+consumer, then claim and acknowledge batches until the outbox is empty,
+optionally sleeping ``--publish-ms`` per batch to stand in for the central
+broker. The report has messages per second and the number of messages
+claimed by more than one replica. Every key written by the benchmark uses a
+random prefix and is deleted afterwards. Results are printed as JSON.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import redis
+
+from aggregation_store import OUTBOX_BACKENDS, Reading, RedisAggregationStore
+from benchmarks.dedupe_benchmark import _delete
+
+
+def _fill(store, messages, batch_size):
+    for start in range(0, messages, batch_size):
+        store.update_many(
+            Reading(f"device-{index}", "Sensor", "bench", 20, 50, False)
+            for index in range(start, min(start + batch_size, messages))
+        )
+    return store.flush_window("bench", 300, datetime.now(timezone.utc))
+
+
+def _drain(store, batch_size, publish_seconds, claimed, errors):
+    try:
+        while True:
+            batch = store.claim_outbox_batch("bench", batch_size)
+            if not batch:
+                if not store.outbox_size("bench"):
+                    return
+                # Messages are still claimed by other replicas
+                time.sleep(0.001)
+                continue
+            if publish_seconds:
+                time.sleep(publish_seconds)
+            store.acknowledge_outbox_batch("bench", batch)
+            claimed.extend(message["aggregate_id"] for _, message in batch)
+    except Exception as exc:
+        errors.append(repr(exc))
+
+
+def run_backend(redis_url, backend, messages, replicas, batch_size, publish_ms):
+    client = redis.Redis.from_url(redis_url, decode_responses=True)
+    prefix = f"bench:outbox:{uuid.uuid4().hex}"
+    options = {"prefix": prefix, "outbox_backend": backend}
+    try:
+        queued = _fill(RedisAggregationStore(client, **options), messages, batch_size)
+
+        claimed = []
+        errors = []
+        threads = [
+            threading.Thread(
+                target=_drain,
+                args=(
+                    RedisAggregationStore(
+                        redis.Redis.from_url(redis_url, decode_responses=True),
+                        outbox_consumer=f"replica-{index}",
+                        **options,
+                    ),
+                    batch_size,
+                    publish_ms / 1000,
+                    claimed,
+                    errors,
+                ),
+            )
+            for index in range(replicas)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+
+        counts = Counter(claimed)
+        return {
+            "backend": backend,
+            "replicas": replicas,
+            "queued": queued,
+            "drained": len(counts),
+            "duplicates": sum(count - 1 for count in counts.values()),
+            "drain_seconds": seconds,
+            "messages_per_second": len(counts) / seconds if seconds else 0,
+            "errors": errors,
+        }
+    finally:
+        _delete(client, f"{prefix}:*")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--replicas", default="1,4,8")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--publish-ms", type=float, default=0,
+        help="Milliseconds each replica spends publishing a claimed batch",
+    )
+    parser.add_argument("--backends", default=",".join(OUTBOX_BACKENDS))
+    args = parser.parse_args(argv)
+
+    redis.Redis.from_url(args.redis_url).ping()
+    results = [
+        run_backend(
+            args.redis_url,
+            backend,
+            args.messages,
+            int(replicas),
+            args.batch_size,
+            args.publish_ms,
+        )
+        for replicas in args.replicas.split(",")
+        for backend in args.backends.split(",")
+    ]
+    json.dump({"benchmark": "outbox_drain", "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
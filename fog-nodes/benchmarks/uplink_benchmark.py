@@ -0,0 +1,105 @@
+"""
+Compare per-message CPU time of the legacy uplink walk and decode_uplink.
+
+    python -m benchmarks.uplink_benchmark --iterations 50000
+
+The legacy path reproduces how an uplink was read before decode_uplink:
+parsed from a decoded string, then walked separately by on_message,
+is_valid_payload and process_message, with the sensor values converted twice.
+Only payload handling is timed; logging, metrics and Redis are left out.
+Results are printed as JSON.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+from benchmarks.codec_benchmark import SAMPLES
+from uplink import decode_uplink, normalize_region
+
+
+def legacy_walk(raw_payload, topic):
+    payload = json.loads(raw_payload.decode())
+
+    # on_message
+    device_info = payload.get("deviceInfo", {})
+    device_id = device_info.get("devEui", "unknown")
+    payload_region = payload.get("regionConfigId")
+    parts = topic.split("/")
+    topic_region = parts[1] if len(parts) >= 2 and parts[0] == "region" else None
+    ns_time = payload.get("rxInfo", [{}])[0].get("nsTime")
+
+    # process_message
+    device_info = payload.get("deviceInfo", {})
+    device_id = device_info.get("devEui", "unknown")
+    device_name = device_info.get("deviceName", "unknown")
+    region = normalize_region(payload.get("regionConfigId", "unknown"))
+
+    # utils.is_valid_payload
+    sensor_data = payload.get("object", payload)
+    temperature = sensor_data.get("temperature")
+    humidity = sensor_data.get("humidity")
+    if temperature is None or humidity is None:
+        return None
+    if not (-50 <= float(temperature) <= 100 and 0 <= float(humidity) <= 100):
+        return None
+
+    # process_message again
+    sensor_data = payload.get("object", payload)
+    temperature = float(sensor_data.get("temperature"))
+    humidity = float(sensor_data.get("humidity", 0))
+    return (
+        device_id,
+        device_name,
+        region,
+        payload_region,
+        topic_region,
+        ns_time,
+        temperature,
+        humidity,
+        payload.get("deduplicationId"),
+    )
+
+
+def single_pass(raw_payload, topic):
+    return decode_uplink(raw_payload, topic)
+
+
+def measure(function, payload, topic, iterations):
+    started = time.process_time()
+    for _ in range(iterations):
+        function(payload, topic)
+    cpu_seconds = time.process_time() - started
+    return {
+        "cpu_microseconds_per_message": cpu_seconds / iterations * 1e6 if iterations else 0,
+        "messages_per_cpu_second": iterations / cpu_seconds if cpu_seconds else 0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sample", action="append", help="uplink JSON file; repeatable")
+    parser.add_argument("--iterations", type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    results = []
+    for path in args.sample or sorted(glob.glob(SAMPLES)):
+        with open(path, "rb") as sample:
+            payload = sample.read()
+        topic = f"region/{json.loads(payload).get('regionConfigId', 'unknown')}/up"
+        for name, function in (("legacy", legacy_walk), ("decode_uplink", single_pass)):
+            results.append(
+                {
+                    "path": name,
+                    "sample": os.path.basename(path),
+                    **measure(function, payload, topic, args.iterations),
+                }
+            )
+    json.dump({"benchmark": "uplink-decode", "results": results}, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
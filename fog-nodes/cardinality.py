@@ -0,0 +1,146 @@
+import heapq
+import logging
+import threading
+import time
+from operator import itemgetter
+
+logger = logging.getLogger(__name__)
+
+METRICS_MODES = ("device", "topk", "region")
+OTHER_DEVICES = "_other"
+# A dropped message ranks a device like this many received ones, so
+# misbehaving devices keep their own series even at low traffic
+DROP_WEIGHT = 10
+
+
+class SpaceSavingSketch:
+    """
+    Approximate heavy hitters with at most ``capacity`` counters (Metwally et
+    al.'s Space-Saving). A new item replaces the smallest counter and inherits
+    its count, so an item's count overestimates its weight by at most the
+    total weight divided by ``capacity``.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity), 1)
+        self._counts = {}
+        # Lazy min-heap; entries whose count is stale are skipped on pop
+        self._heap = []
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, item, weight=1.0):
+        count = self._counts.get(item)
+        if count is None:
+            count = self._pop_min() if len(self._counts) >= self.capacity else 0.0
+        count += weight
+        self._counts[item] = count
+        heapq.heappush(self._heap, (count, item))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild()
+
+    def _pop_min(self):
+        while True:
+            count, item = heapq.heappop(self._heap)
+            if self._counts.get(item) == count:
+                del self._counts[item]
+                return count
+
+    def _rebuild(self):
+        self._heap = [(count, item) for item, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    def decay(self, factor):
+        """Scale every count so devices that went quiet lose their rank."""
+        self._counts = {item: count * factor for item, count in self._counts.items()}
+        self._rebuild()
+
+    def top(self, k):
+        return [
+            item
+            for item, _ in heapq.nlargest(k, self._counts.items(), key=itemgetter(1))
+        ]
+
+
+class DeviceLabeler:
+    """
+    Choose the ``device_id`` label value for per-device metrics.
+
+    ``device`` keeps one series per device. ``region`` folds every device into
+    ``_other`` so only region-level series remain. ``topk`` keeps separate
+    series for the ``top_k`` heaviest or most misbehaving devices per region,
+    tracked by a decaying Space-Saving sketch. Devices that drop out of the top
+    set have their series removed, so the number of series stays bounded.
+    """
+
+    def __init__(self, metrics=(), mode="device", top_k=50, refresh_interval=60, decay=0.5):
+        self.metrics = list(metrics)
+        self._lock = threading.Lock()
+        self.configure(mode, top_k, refresh_interval, decay)
+
+    def configure(self, mode="device", top_k=50, refresh_interval=60, decay=0.5):
+        if mode not in METRICS_MODES:
+            raise ValueError(
+                f"Unknown metrics mode {mode!r}; expected one of {', '.join(METRICS_MODES)}"
+            )
+        with self._lock:
+            self.mode = mode
+            self.top_k = max(int(top_k), 0)
+            self.refresh_interval = max(float(refresh_interval), 1)
+            self.decay = min(max(float(decay), 0), 1)
+            self._sketches = {}
+            self._top = {}
+            self._refreshed_at = time.monotonic()
+        return self
+
+    def label(self, region, device_id, weight=1):
+        """Record ``weight`` for the device and return its label value."""
+        if self.mode == "device":
+            return device_id
+        if self.mode == "region" or not self.top_k:
+            return OTHER_DEVICES
+
+        with self._lock:
+            if weight:
+                sketch = self._sketches.get(region)
+                if sketch is None:
+                    sketch = self._sketches[region] = SpaceSavingSketch(
+                        max(self.top_k * 10, 100)
+                    )
+                sketch.add(device_id, weight)
+            if time.monotonic() - self._refreshed_at >= self.refresh_interval:
+                self._refresh()
+            top = self._top.get(region)
+            if top is None:
+                # Label a new region's first devices until the first refresh
+                top = self._top[region] = set()
+            if device_id in top:
+                return device_id
+            if weight and len(top) < self.top_k:
+                top.add(device_id)
+                return device_id
+        return OTHER_DEVICES
+
+    def tracked(self, region):
+        with self._lock:
+            return set(self._top.get(region, ()))
+
+    def _refresh(self):
+        self._refreshed_at = time.monotonic()
+        for region, sketch in self._sketches.items():
+            top = set(sketch.top(self.top_k))
+            evicted = self._top.get(region, set()) - top
+            for device_id in evicted:
+                self._remove_series(region, device_id)
+            if evicted:
+                logger.debug(
+                    f"[{region}] Folded {len(evicted)} device(s) into "
+                    f"device_id={OTHER_DEVICES} metrics"
+                )
+            self._top[region] = top
+            sketch.decay(self.decay)
+
+    def _remove_series(self, region, device_id):
+        for metric in self.metrics:
+            metric.remove(region, device_id)
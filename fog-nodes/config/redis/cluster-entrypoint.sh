@@ -0,0 +1,41 @@
+#!/bin/sh
+set -eu
+
+# Local Redis Cluster stand-in: several cluster-enabled redis-server processes
+# in one container, announced on 127.0.0.1 so host-side clients can follow
+# MOVED redirects through the published ports.
+first_port="${REDIS_CLUSTER_FIRST_PORT:-7000}"
+node_count="${REDIS_CLUSTER_SIZE:-3}"
+announce_ip="${REDIS_CLUSTER_ANNOUNCE_IP:-127.0.0.1}"
+
+nodes=""
+index=0
+while [ "$index" -lt "$node_count" ]; do
+    port=$((first_port + index))
+    mkdir -p "/tmp/redis-cluster/$port"
+    redis-server \
+        --port "$port" \
+        --bind 0.0.0.0 \
+        --protected-mode no \
+        --dir "/tmp/redis-cluster/$port" \
+        --cluster-enabled yes \
+        --cluster-config-file nodes.conf \
+        --cluster-node-timeout 5000 \
+        --cluster-announce-ip "$announce_ip" \
+        --appendonly no \
+        --save "" \
+        --daemonize yes
+    nodes="$nodes 127.0.0.1:$port"
+    index=$((index + 1))
+done
+
+for node in $nodes; do
+    until redis-cli -p "${node##*:}" ping >/dev/null 2>&1; do
+        sleep 0.2
+    done
+done
+
+# shellcheck disable=SC2086
+redis-cli --cluster create $nodes --cluster-replicas 0 --cluster-yes
+
+exec tail -f /dev/null
@@ -0,0 +1,80 @@
+import logging
+import queue
+import threading
+
+from metrics import buffer_queue_length, stage_timers
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("shed", "block")
+
+
+class IngestQueue:
+    """
+    Bounded hand-off between paho's network thread and a pool of processing
+    workers. When the queue is full, ``shed`` rejects the message immediately
+    and ``block`` holds the network thread until a worker frees a slot. A
+    blocked network thread sends no keepalives or PUBACKs, so a long stall
+    drops the broker connection.
+    """
+
+    def __init__(self, handler, region, maxsize=1000, workers=4, overflow_policy="shed"):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Unknown ingest overflow policy {overflow_policy!r}; "
+                f"expected one of {', '.join(OVERFLOW_POLICIES)}"
+            )
+        self.handler = handler
+        self.region = region
+        self.workers = max(int(workers), 1)
+        self.overflow_policy = overflow_policy
+        self._queue = queue.Queue(maxsize=max(int(maxsize), 1))
+        self._depth = buffer_queue_length.labels(region=region)
+        self._threads = []
+
+    def start(self):
+        for _ in range(self.workers - len(self._threads)):
+            thread = threading.Thread(
+                target=self._work,
+                name=f"ingest-{self.region}-{len(self._threads)}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+        logger.info(
+            f"[{self.region}] Ingest queue started; size={self._queue.maxsize}, "
+            f"workers={self.workers}, overflow={self.overflow_policy}"
+        )
+        return self
+
+    def put(self, *item):
+        """Queue one message for processing; returns False if it was shed."""
+        entry = (stage_timers.start(), item)
+        if self.overflow_policy == "block":
+            self._queue.put(entry)
+        else:
+            try:
+                self._queue.put_nowait(entry)
+            except queue.Full:
+                return False
+        self._depth.set(self._queue.qsize())
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _work(self):
+        while True:
+            queued_at, item = self._queue.get()
+            self._depth.set(self._queue.qsize())
+            stage_timers.observe(self.region, "ingest_queue", queued_at)
+            try:
+                self.handler(*item)
+            except Exception as e:
+                logger.error(f"[{self.region}] Ingest worker failed to handle message: {e}")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every queued message has been handled."""
+        self._queue.join()
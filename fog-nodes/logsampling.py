@@ -0,0 +1,230 @@
+"""
+Cheap logging for the per-message path.
+
+``message_log.sample(category)`` decides whether a per-message line is written
+before any formatting happens, so callers guard their f-strings with it.
+``message_log.record_*`` feeds per-region interval summaries that replace most
+per-message lines, and ``setup_logging`` moves the actual writes to stdout
+onto a background thread behind a bounded queue.
+"""
+import copy
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '[%(asctime)s] [%(levelname)s] %(message)s'
+CATEGORIES = ("received", "uplink", "latency", "event", "duplicate", "drop")
+
+
+def parse_sample_rates(spec):
+    """Parse ``"received=100,latency=0"`` into ``{"received": 100, "latency": 0}``."""
+    rates = {}
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        category, _, every = item.partition("=")
+        category = category.strip()
+        if category not in CATEGORIES:
+            raise ValueError(
+                f"Unknown log category {category!r}; expected one of {', '.join(CATEGORIES)}"
+            )
+        rates[category] = int(every)
+    return rates
+
+
+class _Category:
+    __slots__ = ("every", "seen", "tokens", "refilled_at")
+
+    def __init__(self, every, burst):
+        self.every = every
+        self.seen = 0
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+
+
+class _RegionWindow:
+    __slots__ = ("uplinks", "events", "duplicates", "dropped", "latencies", "latency_count")
+
+    def __init__(self):
+        self.uplinks = 0
+        self.events = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.latencies = []
+        self.latency_count = 0
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+class MessageLog:
+    """
+    Per-category sampling and rate limiting, plus per-region interval summaries.
+
+    A category with rate ``every`` logs one message in ``every``; ``0`` turns it
+    off. At most ``max_per_second`` sampled lines per category are let through.
+    """
+
+    def __init__(self, sample_rates=None, max_per_second=0, summary_interval=10, max_latency_samples=10000):
+        self._lock = threading.Lock()
+        self._windows = defaultdict(_RegionWindow)
+        self._thread = None
+        self._stop = threading.Event()
+        self.configure(sample_rates, max_per_second, summary_interval, max_latency_samples)
+
+    def configure(self, sample_rates=None, max_per_second=0, summary_interval=10, max_latency_samples=10000):
+        self.max_per_second = max(float(max_per_second), 0)
+        self.summary_interval = max(float(summary_interval), 0)
+        self.max_latency_samples = max(int(max_latency_samples), 1)
+        rates = dict.fromkeys(CATEGORIES, 1)
+        rates.update(sample_rates or {})
+        self._categories = {
+            category: _Category(max(int(every), 0), self.max_per_second)
+            for category, every in rates.items()
+        }
+        return self
+
+    def sample(self, category):
+        """Return True when this message's line in ``category`` should be written."""
+        # Updated without a lock: a lost increment only shifts which message
+        # is sampled
+        state = self._categories[category]
+        if state.every == 0:
+            return False
+        state.seen += 1
+        if state.every > 1 and state.seen % state.every:
+            return False
+        if not self.max_per_second:
+            return True
+        now = time.monotonic()
+        state.tokens = min(
+            self.max_per_second,
+            state.tokens + (now - state.refilled_at) * self.max_per_second,
+        )
+        state.refilled_at = now
+        if state.tokens < 1:
+            return False
+        state.tokens -= 1
+        return True
+
+    def record_uplink(self, region, latency=None):
+        with self._lock:
+            window = self._windows[region]
+            window.uplinks += 1
+            if latency is None:
+                return
+            window.latency_count += 1
+            if len(window.latencies) < self.max_latency_samples:
+                window.latencies.append(latency)
+            else:
+                # Reservoir sampling keeps the percentiles unbiased
+                slot = random.randrange(window.latency_count)
+                if slot < self.max_latency_samples:
+                    window.latencies[slot] = latency
+
+    def record_event(self, region):
+        with self._lock:
+            self._windows[region].events += 1
+
+    def record_duplicate(self, region):
+        with self._lock:
+            self._windows[region].duplicates += 1
+
+    def record_drop(self, region):
+        with self._lock:
+            self._windows[region].dropped += 1
+
+    def summaries(self):
+        """Return and reset one summary line per region with activity."""
+        with self._lock:
+            windows, self._windows = self._windows, defaultdict(_RegionWindow)
+        lines = []
+        for region, window in sorted(windows.items()):
+            line = (
+                f"[{region}] {window.uplinks} uplinks, {window.events} events, "
+                f"{window.duplicates} duplicates, {window.dropped} dropped"
+            )
+            if window.latencies:
+                latencies = sorted(window.latencies)
+                line += (
+                    f", ChirpStack -> Fog latency p50={_percentile(latencies, 0.5):.3f}s "
+                    f"p99={_percentile(latencies, 0.99):.3f}s"
+                )
+            lines.append(f"{line} in last {self.summary_interval:g}s")
+        return lines
+
+    def start(self):
+        if self._thread is None and self.summary_interval:
+            self._thread = threading.Thread(
+                target=self.run, name="message-log-summary", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stop.wait(self.summary_interval):
+            for line in self.summaries():
+                logger.info(line)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that drops records instead of blocking when the queue is
+    full and leaves formatting to the listener's handlers.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # QueueHandler.prepare formats the whole line on the logging thread.
+        # Only merge the arguments here, while they still hold their current
+        # values; the timestamp, level and traceback are formatted by the
+        # listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(level="INFO", queue_size=10000):
+    """
+    Configure the root logger. With a queue, records are formatted and written
+    by a QueueListener thread so neither formatting nor a slow log driver
+    stalls message handling. Returns the listener, or None when writing
+    synchronously.
+    """
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if not queue_size:
+        root.addHandler(stream_handler)
+        return None
+
+    log_queue = queue.Queue(maxsize=int(queue_size))
+    listener = logging.handlers.QueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+    root.addHandler(DroppingQueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
+message_log = MessageLog()
@@ -1,24 +1,39 @@
+import asyncio
 import os
 import socket
+import sys
 import threading
 from prometheus_client import start_http_server
 import logging
 import time
-from mqtt_client import setup_mqtt_client
+from mqtt_client import handle_message, setup_mqtt_client
 from aggregator import aggregation_worker
+import async_runtime
 from aggregation_store import RedisAggregationStore
-from utils import get_secret
+from async_store import AsyncRedisAggregationStore
+from batcher import UpdateBatcher
+from envelope import validate_compression
+from ingest import IngestQueue
+from logsampling import message_log, parse_sample_rates, setup_logging
+from metrics import backpressure, device_labels, stage_timers
+from rules import event_rules
+from spill import spill_log
+from preaggregation import PreAggregator
+from utils import get_secret, region_subscription, wait_for_stopped_thread
 
 # Configuration via environment variables
 REGION = os.getenv("REGION", "us915_0")
 MQTT_BROKER = os.getenv("MQTT_BROKER", "fog-haproxy")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "8883"))
 CENTRAL_TOPIC = os.getenv("CENTRAL_TOPIC", "central/data")
-FOG_SHARED_GROUP = os.getenv("FOG_SHARED_GROUP", f"fog-{REGION}")
-FOG_SUB_TOPIC = os.getenv(
-    "FOG_SUB_TOPIC",
-    f"$share/{FOG_SHARED_GROUP}/region/{REGION}/#",
-)
+FOG_REGIONS = [
+    region.strip()
+    for region in os.getenv("FOG_REGIONS", "").split(",")
+    if region.strip()
+] or [REGION]
+# ``{region}`` is replaced per region; ``{shared_group}`` in the topic too
+FOG_SHARED_GROUP = os.getenv("FOG_SHARED_GROUP", "fog-{region}")
+FOG_SUB_TOPIC = os.getenv("FOG_SUB_TOPIC", "$share/{shared_group}/region/{region}/#")
 AGGREGATION_INTERVAL = int(os.getenv("AGGREGATION_INTERVAL", "300"))
 PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT", "8000"))
 MQTT_CONNECT_RETRY_SECONDS = int(os.getenv("MQTT_CONNECT_RETRY_SECONDS", "5"))
@@ -32,19 +47,190 @@ REDIS_SENTINELS = [
     if endpoint.strip()
     for host, port in [endpoint.strip().rsplit(":", 1)]
 ]
+REDIS_CLUSTER_NODES = [
+    (host, int(port))
+    for endpoint in os.getenv("REDIS_CLUSTER_NODES", "").split(",")
+    if endpoint.strip()
+    for host, port in [endpoint.strip().rsplit(":", 1)]
+]
 REDIS_MASTER_NAME = os.getenv("REDIS_MASTER_NAME", "sensiot-fog")
 REDIS_SENTINEL_PASSWORD = get_secret("REDIS_SENTINEL_PASSWORD", REDIS_PASSWORD)
 REDIS_CONNECT_RETRY_SECONDS = int(os.getenv("REDIS_CONNECT_RETRY_SECONDS", "5"))
 DEDUPLICATION_TTL = int(os.getenv("DEDUPLICATION_TTL", "86400"))
+DEDUPLICATION_BACKEND = os.getenv("DEDUPLICATION_BACKEND", "key").strip().lower()
+DEDUPLICATION_BLOOM_CAPACITY = int(os.getenv("DEDUPLICATION_BLOOM_CAPACITY", "1000000"))
+DEDUPLICATION_BLOOM_ERROR_RATE = float(os.getenv("DEDUPLICATION_BLOOM_ERROR_RATE", "0.001"))
+DEDUPLICATION_BLOOM_BUCKET_SECONDS = int(os.getenv("DEDUPLICATION_BLOOM_BUCKET_SECONDS", "3600"))
+FLUSH_MODE = os.getenv("FLUSH_MODE", "atomic").strip().lower()
+FLUSH_CHUNK_SIZE = int(os.getenv("FLUSH_CHUNK_SIZE", "500"))
+QUANTILE_SKETCH_BUCKETS = int(os.getenv("QUANTILE_SKETCH_BUCKETS", "0"))
+WINDOW_TIME = os.getenv("WINDOW_TIME", "processing").strip().lower()
+WINDOW_SLIDE = int(os.getenv("WINDOW_SLIDE", str(AGGREGATION_INTERVAL)))
+ALLOWED_LATENESS = int(os.getenv("ALLOWED_LATENESS", "0"))
+WATERMARK_DELAY = int(os.getenv("WATERMARK_DELAY", "0"))
+WATERMARK_IDLE_TIMEOUT = int(os.getenv("WATERMARK_IDLE_TIMEOUT", str(AGGREGATION_INTERVAL)))
+MAX_CLOCK_SKEW = int(os.getenv("MAX_CLOCK_SKEW", "60"))
+EVENT_FLUSH_LIMIT = int(os.getenv("EVENT_FLUSH_LIMIT", "100"))
+PRIORITY_EVENTS_ENABLED = os.getenv("PRIORITY_EVENTS_ENABLED", "true").lower() in ("1", "true", "yes")
+OUTBOX_BACKEND = os.getenv("OUTBOX_BACKEND", "zset").strip().lower()
 OUTBOX_VISIBILITY_TIMEOUT = int(os.getenv("OUTBOX_VISIBILITY_TIMEOUT", "30"))
 OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_WAKE_TIMEOUT = float(os.getenv("OUTBOX_WAKE_TIMEOUT", "30"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
 PUBLISH_RETRY_DELAY = float(os.getenv("PUBLISH_RETRY_DELAY", "5"))
+PUBLISH_MAX_IN_FLIGHT = int(os.getenv("PUBLISH_MAX_IN_FLIGHT", "20"))
+PUBLISH_TIMEOUT = float(os.getenv("PUBLISH_TIMEOUT", "10"))
+CENTRAL_ENVELOPE_ENABLED = os.getenv("CENTRAL_ENVELOPE_ENABLED", "false").lower() in ("1", "true", "yes")
+CENTRAL_ENVELOPE_COMPRESSION = os.getenv("CENTRAL_ENVELOPE_COMPRESSION", "zlib").strip().lower()
+CENTRAL_ENVELOPE_MAX_MESSAGES = int(os.getenv("CENTRAL_ENVELOPE_MAX_MESSAGES", "100"))
+UPDATE_BATCH_SIZE = int(os.getenv("UPDATE_BATCH_SIZE", "0"))
+UPDATE_BATCH_MAX_DELAY = float(os.getenv("UPDATE_BATCH_MAX_DELAY", "0.005"))
+PREAGGREGATION_INTERVAL = float(os.getenv("PREAGGREGATION_INTERVAL", "0"))
+PREAGGREGATION_MAX_PENDING = int(os.getenv("PREAGGREGATION_MAX_PENDING", "10000"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1000"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "4"))
+INGEST_OVERFLOW_POLICY = os.getenv("INGEST_OVERFLOW_POLICY", "shed").strip().lower()
+METRICS_MODE = os.getenv("METRICS_MODE", "device").strip().lower()
+METRICS_TOP_K = int(os.getenv("METRICS_TOP_K", "50"))
+METRICS_TOP_K_REFRESH_SECONDS = float(os.getenv("METRICS_TOP_K_REFRESH_SECONDS", "60"))
+METRICS_TOP_K_DECAY = float(os.getenv("METRICS_TOP_K_DECAY", "0.5"))
+STAGE_TIMING_ENABLED = os.getenv("STAGE_TIMING_ENABLED", "true").lower() in ("1", "true", "yes")
+BACKPRESSURE_OUTBOX_HIGH = int(os.getenv("BACKPRESSURE_OUTBOX_HIGH", "0"))
+BACKPRESSURE_OUTBOX_LOW = int(os.getenv("BACKPRESSURE_OUTBOX_LOW", str(BACKPRESSURE_OUTBOX_HIGH // 2)))
+BACKPRESSURE_OUTBOX_PAUSE = int(os.getenv("BACKPRESSURE_OUTBOX_PAUSE", "0"))
+BACKPRESSURE_MEMORY_HIGH = float(os.getenv("BACKPRESSURE_MEMORY_HIGH", "0"))
+BACKPRESSURE_MEMORY_LOW = float(
+    os.getenv("BACKPRESSURE_MEMORY_LOW", str(max(BACKPRESSURE_MEMORY_HIGH - 0.1, 0)))
+)
+BACKPRESSURE_MEMORY_PAUSE = float(os.getenv("BACKPRESSURE_MEMORY_PAUSE", "0"))
+BACKPRESSURE_INTERVAL = float(os.getenv("BACKPRESSURE_INTERVAL", "2"))
+SPILL_LOG_PATH = os.getenv("SPILL_LOG_PATH", "")
+SPILL_LOG_MAX_BYTES = int(os.getenv("SPILL_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+SPILL_REPLAY_BATCH_SIZE = int(os.getenv("SPILL_REPLAY_BATCH_SIZE", "500"))
+SPILL_REPLAY_INTERVAL = float(os.getenv("SPILL_REPLAY_INTERVAL", "1"))
+RUNTIME = os.getenv("RUNTIME", "threads").strip().lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_SAMPLE_RATES = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+LOG_MAX_LINES_PER_SECOND = float(os.getenv("LOG_MAX_LINES_PER_SECOND", "0"))
+LOG_SUMMARY_INTERVAL = float(os.getenv("LOG_SUMMARY_INTERVAL", "10"))
+EVENT_RULES_FILE = os.getenv("EVENT_RULES_FILE", "").strip()
+EVENT_RULES_RELOAD_INTERVAL = float(os.getenv("EVENT_RULES_RELOAD_INTERVAL", "10"))
 
-logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+RUNTIMES = ("threads", "asyncio")
+# Event-time windows close as the watermark passes them, so they are checked
+# once per slide rather than once per aggregation interval
+FLUSH_INTERVAL = WINDOW_SLIDE if WINDOW_TIME == "event" else AGGREGATION_INTERVAL
+
+setup_logging(LOG_LEVEL, LOG_QUEUE_SIZE)
 logger = logging.getLogger(__name__)
 
 
+async def async_main(instance_id, store_options, envelope_compression):
+    """Run every configured region on one event loop (``RUNTIME=asyncio``)."""
+    if PREAGGREGATION_INTERVAL > 0:
+        logger.warning(
+            "RUNTIME=asyncio batches updates on the event loop; "
+            "PREAGGREGATION_INTERVAL is ignored"
+        )
+    if REDIS_CLUSTER_NODES:
+        aggregation_store = AsyncRedisAggregationStore.from_cluster(
+            REDIS_CLUSTER_NODES, REDIS_PASSWORD, **store_options
+        )
+        redis_target = f"Redis Cluster via {REDIS_CLUSTER_NODES}"
+    elif REDIS_SENTINELS:
+        aggregation_store = AsyncRedisAggregationStore.from_sentinel(
+            REDIS_SENTINELS,
+            REDIS_MASTER_NAME,
+            REDIS_DB,
+            REDIS_PASSWORD,
+            REDIS_SENTINEL_PASSWORD,
+            **store_options,
+        )
+        redis_target = f"Sentinel service {REDIS_MASTER_NAME} via {REDIS_SENTINELS}"
+    else:
+        aggregation_store = AsyncRedisAggregationStore.from_connection(
+            REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, **store_options
+        )
+        redis_target = f"{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
+    await async_runtime.connect_store(
+        aggregation_store, redis_target, REDIS_CONNECT_RETRY_SECONDS
+    )
+
+    await asyncio.gather(
+        *(
+            async_runtime.run_fog_node(
+                aggregation_store,
+                region,
+                region_subscription(region, FOG_SHARED_GROUP, FOG_SUB_TOPIC),
+                CENTRAL_TOPIC,
+                async_runtime.mqtt_client_options(
+                    f"fog_node_{region}_{instance_id}", region, MQTT_BROKER, MQTT_PORT
+                ),
+                FLUSH_INTERVAL,
+                OUTBOX_POLL_INTERVAL,
+                PUBLISH_RETRY_DELAY,
+                OUTBOX_BATCH_SIZE,
+                PUBLISH_MAX_IN_FLIGHT,
+                PUBLISH_TIMEOUT,
+                envelope_compression,
+                CENTRAL_ENVELOPE_MAX_MESSAGES,
+                UPDATE_BATCH_SIZE,
+                UPDATE_BATCH_MAX_DELAY,
+                MQTT_CONNECT_RETRY_SECONDS,
+                OUTBOX_WAKE_TIMEOUT,
+                INGEST_QUEUE_SIZE,
+            )
+            for region in FOG_REGIONS
+        ),
+        backpressure.run_async(aggregation_store, FOG_REGIONS),
+        spill_log.run_async(aggregation_store),
+    )
+
+
 def main():
+    envelope_compression = None
+    if CENTRAL_ENVELOPE_ENABLED:
+        envelope_compression = validate_compression(CENTRAL_ENVELOPE_COMPRESSION)
+    device_labels.configure(
+        METRICS_MODE,
+        METRICS_TOP_K,
+        METRICS_TOP_K_REFRESH_SECONDS,
+        METRICS_TOP_K_DECAY,
+    )
+    message_log.configure(
+        LOG_SAMPLE_RATES,
+        LOG_MAX_LINES_PER_SECOND,
+        LOG_SUMMARY_INTERVAL,
+    ).start()
+    event_rules.configure(EVENT_RULES_FILE, EVENT_RULES_RELOAD_INTERVAL).start()
+    stage_timers.configure(STAGE_TIMING_ENABLED)
+    backpressure.configure(
+        (BACKPRESSURE_OUTBOX_LOW, BACKPRESSURE_OUTBOX_HIGH, BACKPRESSURE_OUTBOX_PAUSE),
+        (BACKPRESSURE_MEMORY_LOW, BACKPRESSURE_MEMORY_HIGH, BACKPRESSURE_MEMORY_PAUSE),
+        BACKPRESSURE_INTERVAL,
+    )
+    spill_log.configure(
+        SPILL_LOG_PATH, SPILL_LOG_MAX_BYTES, SPILL_REPLAY_BATCH_SIZE, SPILL_REPLAY_INTERVAL
+    )
+
+    if len(FOG_REGIONS) > 1 and "{region}" not in FOG_SUB_TOPIC:
+        raise ValueError("FOG_SUB_TOPIC must contain {region} when FOG_REGIONS lists several regions")
+    if RUNTIME not in RUNTIMES:
+        raise ValueError(
+            f"Unknown runtime {RUNTIME!r}; expected one of {', '.join(RUNTIMES)}"
+        )
+    if WINDOW_TIME == "event" and PREAGGREGATION_INTERVAL > 0:
+        raise ValueError(
+            "PREAGGREGATION_INTERVAL buckets readings by arrival time; "
+            "set it to 0 with WINDOW_TIME=event"
+        )
+
+    if OUTBOX_BACKEND == "stream" and PUBLISH_RETRY_DELAY > OUTBOX_VISIBILITY_TIMEOUT:
+        raise ValueError(
+            "PUBLISH_RETRY_DELAY must not exceed OUTBOX_VISIBILITY_TIMEOUT with OUTBOX_BACKEND=stream"
+        )
+
     # Start Prometheus metrics server
     start_http_server(PROMETHEUS_PORT)
     logger.info(f"Started Prometheus metrics server on port {PROMETHEUS_PORT}")
@@ -52,8 +238,36 @@ def main():
     store_options = {
         "deduplication_ttl": DEDUPLICATION_TTL,
         "outbox_visibility_timeout": OUTBOX_VISIBILITY_TIMEOUT,
+        "deduplication_backend": DEDUPLICATION_BACKEND,
+        "bloom_capacity": DEDUPLICATION_BLOOM_CAPACITY,
+        "bloom_error_rate": DEDUPLICATION_BLOOM_ERROR_RATE,
+        "bloom_bucket_seconds": DEDUPLICATION_BLOOM_BUCKET_SECONDS,
+        "flush_mode": FLUSH_MODE,
+        "flush_chunk_size": FLUSH_CHUNK_SIZE,
+        "quantile_buckets": QUANTILE_SKETCH_BUCKETS,
+        "window_time": WINDOW_TIME,
+        "window_size": AGGREGATION_INTERVAL,
+        "window_slide": WINDOW_SLIDE,
+        "allowed_lateness": ALLOWED_LATENESS,
+        "watermark_delay": WATERMARK_DELAY,
+        "watermark_idle_timeout": WATERMARK_IDLE_TIMEOUT,
+        "max_clock_skew": MAX_CLOCK_SKEW,
+        "event_flush_limit": EVENT_FLUSH_LIMIT,
+        "priority_events": PRIORITY_EVENTS_ENABLED,
+        "outbox_backend": OUTBOX_BACKEND,
     }
-    if REDIS_SENTINELS:
+    instance_id = os.getenv("FOG_INSTANCE_ID", socket.gethostname())
+    store_options["outbox_consumer"] = instance_id
+    if RUNTIME == "asyncio":
+        asyncio.run(async_main(instance_id, store_options, envelope_compression))
+        return
+
+    if REDIS_CLUSTER_NODES:
+        # The cluster client contacts its nodes on creation, so it is created
+        # inside the connection retry loop below
+        aggregation_store = None
+        redis_target = f"Redis Cluster via {REDIS_CLUSTER_NODES}"
+    elif REDIS_SENTINELS:
         aggregation_store = RedisAggregationStore.from_sentinel(
             REDIS_SENTINELS,
             REDIS_MASTER_NAME,
@@ -74,6 +288,12 @@ def main():
         redis_target = f"{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
     while True:
         try:
+            if aggregation_store is None:
+                aggregation_store = RedisAggregationStore.from_cluster(
+                    REDIS_CLUSTER_NODES,
+                    REDIS_PASSWORD,
+                    **store_options,
+                )
             aggregation_store.ping()
             logger.info(f"Connected to fog state store at {redis_target}")
             break
@@ -84,39 +304,105 @@ def main():
             )
             time.sleep(REDIS_CONNECT_RETRY_SECONDS)
 
+    backpressure.start(aggregation_store, FOG_REGIONS)
+    spill_log.start(aggregation_store)
+    # One pipeline per region shares the Redis connection pool, while its own
+    # MQTT connection, ingest queue, update sink and worker keep a busy region
+    # from delaying the others
+    threads = []
+    for region in FOG_REGIONS:
+        threads.extend(
+            start_region(region, aggregation_store, instance_id, envelope_compression)
+        )
+    # A region whose network loop or worker died would otherwise go silent
+    # while the process keeps running; exit so the container is restarted
+    stopped = wait_for_stopped_thread(threads)
+    logger.critical(f"Thread {stopped.name} stopped; exiting so the fog node restarts")
+    sys.exit(1)
+
+
+def start_region(region, aggregation_store, instance_id, envelope_compression):
+    """
+    Start one region's subscription, ingest, update sink and aggregation
+    worker. Returns the region's network loop and aggregation worker threads.
+    """
+    # Readings are pre-aggregated in memory when enabled, otherwise micro-batched
+    # into pipelined Redis round trips unless batching is disabled too
+    update_sink = aggregation_store
+    pre_aggregator = None
+    if PREAGGREGATION_INTERVAL > 0:
+        pre_aggregator = PreAggregator(
+            aggregation_store, PREAGGREGATION_INTERVAL, PREAGGREGATION_MAX_PENDING
+        ).start()
+        update_sink = pre_aggregator
+    elif UPDATE_BATCH_SIZE > 1:
+        update_sink = UpdateBatcher(
+            aggregation_store, UPDATE_BATCH_SIZE, UPDATE_BATCH_MAX_DELAY
+        ).start()
+
+    # Decouple MQTT receive from processing unless the ingest queue is disabled
+    ingest_queue = None
+    if INGEST_QUEUE_SIZE > 0:
+        ingest_queue = IngestQueue(
+            handle_message,
+            region,
+            INGEST_QUEUE_SIZE,
+            INGEST_WORKERS,
+            INGEST_OVERFLOW_POLICY,
+        ).start()
+
     # Setup MQTT client for the fog node
-    instance_id = os.getenv("FOG_INSTANCE_ID", socket.gethostname())
-    client_id = f"fog_node_{REGION}_{instance_id}"
-    client = setup_mqtt_client(client_id, REGION, FOG_SUB_TOPIC, aggregation_store)
-    logger.info(f"[{REGION}] MQTT client identity: {client_id}")
+    client_id = f"fog_node_{region}_{instance_id}"
+    client = setup_mqtt_client(
+        client_id,
+        region,
+        region_subscription(region, FOG_SHARED_GROUP, FOG_SUB_TOPIC),
+        update_sink,
+        ingest_queue,
+    )
+    client.max_inflight_messages_set(max(PUBLISH_MAX_IN_FLIGHT, 20))
+    logger.info(f"[{region}] MQTT client identity: {client_id}")
     while True:
         try:
             client.connect(MQTT_BROKER, MQTT_PORT, 60)
             break
         except OSError as e:
             logger.warning(
-                f"[{REGION}] MQTT broker {MQTT_BROKER}:{MQTT_PORT} not reachable yet: {e}. "
+                f"[{region}] MQTT broker {MQTT_BROKER}:{MQTT_PORT} not reachable yet: {e}. "
                 f"Retrying in {MQTT_CONNECT_RETRY_SECONDS} seconds."
             )
             time.sleep(MQTT_CONNECT_RETRY_SECONDS)
 
     # Start aggregator worker thread (for aggregation and forwarding)
-    threading.Thread(
+    worker = threading.Thread(
         target=aggregation_worker,
         args=(
             client,
             aggregation_store,
-            REGION,
-            AGGREGATION_INTERVAL,
+            region,
+            FLUSH_INTERVAL,
             CENTRAL_TOPIC,
             OUTBOX_POLL_INTERVAL,
             PUBLISH_RETRY_DELAY,
+            pre_aggregator,
+            OUTBOX_BATCH_SIZE,
+            PUBLISH_MAX_IN_FLIGHT,
+            PUBLISH_TIMEOUT,
+            envelope_compression,
+            CENTRAL_ENVELOPE_MAX_MESSAGES,
+            OUTBOX_WAKE_TIMEOUT,
         ),
+        name=f"aggregation-worker-{region}",
         daemon=True,
-    ).start()
+    )
+    worker.start()
 
-    # Start MQTT loop (blocking)
-    client.loop_forever()
+    # Run the MQTT network loop on its own thread; it reconnects by itself
+    network_loop = threading.Thread(
+        target=client.loop_forever, name=f"mqtt-loop-{region}", daemon=True
+    )
+    network_loop.start()
+    return network_loop, worker
 
 if __name__ == "__main__":
     main()
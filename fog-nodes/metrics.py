@@ -1,5 +1,9 @@
 from prometheus_client import Counter, Summary, Histogram, Gauge
 
+from backpressure import BackpressureController
+from cardinality import DeviceLabeler
+from timing import StageTimers
+
 # Prometheus metrics definitions with labels for region and device_id
 received_counter = Counter(
     'received_messages',
@@ -40,10 +44,102 @@ avg_temperature_gauge = Gauge(
     ['region', 'device_id']
 )
 
-buffer_queue_length = Gauge('buffer_queue_length', 'Current length of the buffer queue')
+# Picks the device_id label value for the metrics above; configured by main.py
+device_labels = DeviceLabeler(
+    [
+        received_counter,
+        dropped_counter,
+        forwarded_counter,
+        events_detected_counter,
+        latency_summary,
+        latency_histogram,
+        avg_temperature_gauge,
+    ]
+)
+
+buffer_queue_length = Gauge(
+    'buffer_queue_length',
+    'Current length of the ingest buffer queue',
+    ['region']
+)
 
 outbox_messages_gauge = Gauge(
     'fog_outbox_messages',
     'Number of aggregate messages waiting in the durable Redis outbox',
     ['region']
 )
+
+publish_in_flight_gauge = Gauge(
+    'fog_publish_in_flight',
+    'QoS 1 publishes to central waiting for a PUBACK',
+    ['region']
+)
+publish_ack_latency_histogram = Histogram(
+    'fog_publish_ack_latency_seconds',
+    'Time from publishing an aggregate to receiving its PUBACK',
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0],
+    labelnames=['region']
+)
+
+priority_outbox_messages_gauge = Gauge(
+    'fog_priority_outbox_messages',
+    'Number of event readings waiting in the priority outbox',
+    ['region']
+)
+priority_event_latency_histogram = Histogram(
+    'fog_priority_event_latency_seconds',
+    'Time from queueing an event reading in the priority outbox to its PUBACK',
+    buckets=[0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0],
+    labelnames=['region']
+)
+
+stage_duration_histogram = Histogram(
+    'fog_stage_duration_seconds',
+    'Time spent in each stage of the fog pipeline',
+    buckets=[0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0],
+    labelnames=['region', 'stage']
+)
+# Times decode, validation, rules, Redis calls and publishing; configured by main.py
+stage_timers = StageTimers(stage_duration_histogram)
+
+backpressure_state_gauge = Gauge(
+    'fog_backpressure_state',
+    'Ingest backpressure state: 0 normal, 1 shedding non-event readings, 2 paused',
+    ['region']
+)
+backpressure_shed_counter = Counter(
+    'fog_backpressure_shed_readings',
+    'Messages dropped by backpressure: non-event readings while shedding, all while paused',
+    ['region']
+)
+# Throttles ingest from outbox depth and Redis memory; configured by main.py
+backpressure = BackpressureController(backpressure_state_gauge)
+
+spill_written_counter = Counter(
+    'fog_spill_written_readings',
+    'Readings written to the local spill log while Redis was unavailable',
+    ['region']
+)
+spill_replayed_counter = Counter(
+    'fog_spill_replayed_readings',
+    'Spilled readings replayed into Redis',
+    ['region']
+)
+spill_overflow_counter = Counter(
+    'fog_spill_overflow_readings',
+    'Readings dropped because the spill log was full',
+    ['region']
+)
+spill_discarded_counter = Counter(
+    'fog_spill_discarded_readings',
+    'Spilled readings discarded on replay because Redis rejected them',
+    ['region']
+)
+spill_bytes_gauge = Gauge(
+    'fog_spill_bytes',
+    'Bytes of readings in the spill log waiting for replay'
+)
+spill_replay_rate_gauge = Gauge(
+    'fog_spill_replay_readings_per_second',
+    'Readings per second replayed by the latest spill log replay'
+)
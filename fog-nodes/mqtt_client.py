@@ -1,12 +1,14 @@
-import json
 import logging
 import os
 import ssl
 from datetime import datetime, timezone
 import paho.mqtt.client as mqtt
-from utils import get_secret, parse_iso_timestamp
+from utils import get_region_secret, parse_iso_timestamp
 from processing import process_message
-from metrics import received_counter, latency_summary, latency_histogram, dropped_counter
+from uplink import decode_uplink, normalize_region
+from cardinality import DROP_WEIGHT
+from logsampling import message_log
+from metrics import received_counter, latency_summary, latency_histogram, dropped_counter, device_labels, stage_timers, backpressure, backpressure_shed_counter
 from collections import defaultdict
 
 # Set up logging if not already configured
@@ -18,21 +20,10 @@ logger = logging.getLogger(__name__)
 uplink_counter = defaultdict(int)
 local_dropped_counter = defaultdict(int)
 
-def _normalize_region(region):
-    return str(region or "").strip().lower()
-
-
-def _extract_topic_region(topic):
-    parts = topic.split("/")
-    if len(parts) >= 2 and parts[0] == "region":
-        return parts[1]
-    return None
-
-
 def _regions_match(expected_region, payload_region, topic_region):
-    expected = _normalize_region(expected_region)
-    payload = _normalize_region(payload_region)
-    topic = _normalize_region(topic_region)
+    expected = normalize_region(expected_region)
+    payload = normalize_region(payload_region)
+    topic = normalize_region(topic_region)
     return payload == expected and (not topic or topic == expected)
 
 
@@ -73,59 +64,103 @@ def on_subscribe(client, userdata, mid, granted_qos, properties=None):
     )
 
 
+def _drop_on_receipt(region, topic, reason):
+    message_log.record_drop(region)
+    if message_log.sample("drop"):
+        logger.warning(f"[{region}] {reason}; shedding message on topic: {topic}")
+    dropped_counter.labels(
+        region=region, device_id=device_labels.label(region, "unknown", DROP_WEIGHT)
+    ).inc()
+    local_dropped_counter[region] += 1
+
+
+def drop_if_paused(region, topic):
+    """Drop and count a message on receipt while backpressure pauses ``region``."""
+    if not backpressure.paused(region):
+        return False
+    backpressure_shed_counter.labels(region=normalize_region(region)).inc()
+    _drop_on_receipt(region, topic, "Backpressure paused ingest")
+    return True
+
+
 def on_message(client, userdata, msg):
+    received_at_fog = datetime.now(timezone.utc)
+    # Never block here: paho's network thread also carries PUBACKs and the
+    # outbox publishes that end the pause
+    if drop_if_paused(userdata.get("region"), msg.topic):
+        return
+    ingest_queue = userdata.get("ingest_queue")
+    if ingest_queue is None:
+        handle_message(userdata, msg.topic, msg.payload, received_at_fog)
+        return
+
+    # Keep paho's network thread free for socket reads and PUBACKs
+    if not ingest_queue.put(userdata, msg.topic, msg.payload, received_at_fog):
+        _drop_on_receipt(userdata.get("region"), msg.topic, "Ingest queue full")
+
+
+def handle_message(userdata, topic, raw_payload, received_at_fog):
     region = userdata.get("region")
-    logger.info(f"[{region}] Received raw message on topic: {msg.topic}")
-    
+    if message_log.sample("received"):
+        logger.info(f"[{region}] Received raw message on topic: {topic}")
+
     try:
-        # Capture receive time and parse payload
-        received_at_fog = datetime.now(timezone.utc)
-        payload = json.loads(msg.payload.decode())
-
-        # Update Prometheus received counter using device info (if available)
-        device_info = payload.get("deviceInfo", {})
-        device_id = device_info.get("devEui", "unknown")
-        payload_region = payload.get("regionConfigId")
-        topic_region = _extract_topic_region(msg.topic)
-
-        if not _regions_match(region, payload_region, topic_region):
-            logger.warning(
-                f"[{region}] Dropping message with region mismatch: "
-                f"payload_region={payload_region}, topic_region={topic_region}, topic={msg.topic}"
-            )
-            dropped_counter.labels(region=region, device_id=device_id).inc()
+        # Parse and validate the payload once for the whole pipeline
+        started = stage_timers.start()
+        record = decode_uplink(raw_payload, topic)
+        stage_timers.observe(region, "decode", started)
+        device_id = record.device_id
+
+        if not _regions_match(region, record.region, record.topic_region):
+            message_log.record_drop(region)
+            if message_log.sample("drop"):
+                logger.warning(
+                    f"[{region}] Dropping message with region mismatch: "
+                    f"payload_region={record.region_config_id}, "
+                    f"topic_region={record.topic_region}, topic={topic}"
+                )
+            dropped_counter.labels(
+                region=region, device_id=device_labels.label(region, device_id, DROP_WEIGHT)
+            ).inc()
             local_dropped_counter[region] += 1
             return
 
         uplink_counter[region] += 1
-        logger.info(f"[{region}] Uplink count: {uplink_counter[region]}")
-        received_counter.labels(region=region, device_id=device_id).inc()
+        if message_log.sample("uplink"):
+            logger.info(f"[{region}] Uplink count: {uplink_counter[region]}")
+        device_label = device_labels.label(region, device_id)
+        received_counter.labels(region=region, device_id=device_label).inc()
 
         # Calculate and log latency if available
-        rx_info = payload.get("rxInfo", [{}])[0]
-        ns_time_str = rx_info.get("nsTime")
-        if ns_time_str:
-            ns_time = parse_iso_timestamp(ns_time_str)
+        chirpstack_fog_latency = None
+        if record.ns_time:
+            ns_time = parse_iso_timestamp(record.ns_time)
             chirpstack_fog_latency = (received_at_fog - ns_time).total_seconds()
-            logger.info(f"[{region}] ChirpStack -> Fog Node Latency: {chirpstack_fog_latency:.3f} sec")
-            latency_summary.labels(region=region, device_id=device_id).observe(chirpstack_fog_latency)
-            latency_histogram.labels(region=region, device_id=device_id).observe(chirpstack_fog_latency)
-        else:
+            if message_log.sample("latency"):
+                logger.info(f"[{region}] ChirpStack -> Fog Node Latency: {chirpstack_fog_latency:.3f} sec")
+            latency_summary.labels(region=region, device_id=device_label).observe(chirpstack_fog_latency)
+            latency_histogram.labels(region=region, device_id=device_label).observe(chirpstack_fog_latency)
+        elif message_log.sample("latency"):
             logger.warning(f"[{region}] nsTime missing in payload")
+        message_log.record_uplink(region, chirpstack_fog_latency)
 
         # Hand off to further processing
-        process_message(payload, msg.topic, region, userdata["aggregation_store"])
+        process_message(record, topic, region, userdata["aggregation_store"])
 
     except Exception as e:
-        logger.error(f"[{region}] Error processing message: {e}")
-        dropped_counter.labels(region=region, device_id="unknown").inc()
+        dropped_counter.labels(
+            region=region, device_id=device_labels.label(region, "unknown", DROP_WEIGHT)
+        ).inc()
         local_dropped_counter[region] += 1
-        logger.info(f"[{region}] Local dropped count: {local_dropped_counter[region]}")
+        message_log.record_drop(region)
+        if message_log.sample("drop"):
+            logger.error(f"[{region}] Error processing message: {e}")
+            logger.info(f"[{region}] Local dropped count: {local_dropped_counter[region]}")
 
-def setup_mqtt_client(client_id, region, fog_sub_topic, aggregation_store):
+def setup_mqtt_client(client_id, region, fog_sub_topic, aggregation_store, ingest_queue=None):
     client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv311)
-    username = os.getenv("MQTT_USERNAME")
-    password = get_secret("MQTT_PASSWORD")
+    username = get_region_secret("MQTT_USERNAME", region)
+    password = get_region_secret("MQTT_PASSWORD", region)
     if username and password:
         client.username_pw_set(username, password)
     if os.getenv("MQTT_TLS_ENABLED", "true").lower() in ("1", "true", "yes"):
@@ -142,6 +177,7 @@ def setup_mqtt_client(client_id, region, fog_sub_topic, aggregation_store):
             "region": region,
             "fog_sub_topic": fog_sub_topic,
             "aggregation_store": aggregation_store,
+            "ingest_queue": ingest_queue,
         }
     )
     client.on_connect = on_connect
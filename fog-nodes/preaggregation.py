@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class PreAggregator:
+    """
+    Hold each device's readings in memory and periodically merge them into the
+    Redis window with one atomic call per device.
+
+    ``update`` takes the same arguments as ``RedisAggregationStore.update`` and
+    returns a Future that resolves to the accepted flag once the merge has run.
+    Event readings bypass the merge when the store has a priority outbox.
+    At most ``merge_interval`` seconds or ``max_pending`` readings are held in
+    memory, which bounds what a crash can lose.
+    """
+
+    def __init__(self, aggregation_store, merge_interval=5, max_pending=10000):
+        self.aggregation_store = aggregation_store
+        self.merge_interval = max(float(merge_interval), 0.1)
+        self.max_pending = max(int(max_pending), 1)
+        self._lock = threading.Lock()
+        self._partials = {}
+        self._pending = 0
+        self._merge_requested = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self.run, name="aggregate-pre-aggregator", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def update(
+        self,
+        device_id,
+        device_name,
+        region,
+        temperature,
+        humidity,
+        event_detected,
+        reading_id=None,
+        event_time=None,
+    ):
+        if event_detected and self.aggregation_store.priority_events:
+            # Applied at once so the reading reaches the priority outbox
+            # without waiting for the next merge
+            return self.aggregation_store.update(
+                device_id,
+                device_name,
+                region,
+                temperature,
+                humidity,
+                event_detected,
+                reading_id,
+            )
+        # Partials are merged into processing-time windows; event_time is
+        # accepted for a uniform update signature only
+        future = Future()
+        with self._lock:
+            partial = self._partials.get((region, device_id))
+            if partial is None:
+                partial = self._partials[(region, device_id)] = [device_name, [], []]
+            partial[0] = device_name
+            partial[1].append((reading_id, temperature, humidity, event_detected))
+            partial[2].append(future)
+            self._pending += 1
+            if self._pending >= self.max_pending:
+                self._merge_requested.set()
+        return future
+
+    def pending(self):
+        return self._pending
+
+    def flush(self):
+        """Merge every held reading into Redis on the calling thread."""
+        with self._lock:
+            partials, self._partials = self._partials, {}
+            self._pending = 0
+        if not partials:
+            return 0
+
+        batch = [
+            (device_id, device_name, region, readings)
+            for (region, device_id), (device_name, readings, _) in partials.items()
+        ]
+        try:
+            results = self.aggregation_store.merge_many(batch)
+        except Exception as e:
+            logger.error(
+                f"Failed to merge {len(batch)} pre-aggregated device window(s): {e}"
+            )
+            for _, _, futures in partials.values():
+                for future in futures:
+                    future.set_exception(e)
+            return 0
+
+        merged = 0
+        for (_, _, futures), flags in zip(partials.values(), results):
+            for future, accepted in zip(futures, flags):
+                future.set_result(accepted)
+                merged += accepted
+        return merged
+
+    def run(self):
+        logger.info(
+            f"Pre-aggregator started; merge_interval={self.merge_interval}s, "
+            f"max_pending={self.max_pending}"
+        )
+        while True:
+            self._merge_requested.wait(self.merge_interval)
+            self._merge_requested.clear()
+            started = time.monotonic()
+            merged = self.flush()
+            if merged:
+                logger.debug(
+                    f"Merged {merged} reading(s) into Redis in "
+                    f"{time.monotonic() - started:.3f}s"
+                )
@@ -1,6 +1,22 @@
 import logging
-from utils import is_valid_payload
-from metrics import dropped_counter, events_detected_counter
+import time
+from concurrent.futures import Future
+from functools import partial
+from aggregation_store import Reading
+from uplink import normalize_region
+from utils import parse_iso_timestamp
+from cardinality import DROP_WEIGHT
+from logsampling import message_log
+from metrics import (
+    backpressure,
+    backpressure_shed_counter,
+    device_labels,
+    dropped_counter,
+    events_detected_counter,
+    stage_timers,
+)
+from rules import event_rules
+from spill import spill_log
 from collections import defaultdict
 
 logger = logging.getLogger(__name__)
@@ -8,77 +24,167 @@ logger = logging.getLogger(__name__)
 # Local in-memory counter for dropped messages in processing (keyed by region)
 local_dropped_counter_processing = defaultdict(int)
 
-def _normalize_region(region):
-    return str(region or "").strip().lower()
+def _event_time(record):
+    """The uplink's event time in epoch seconds, or None to use arrival time."""
+    if not record.event_time:
+        return None
+    try:
+        return parse_iso_timestamp(record.event_time).timestamp()
+    except ValueError:
+        return None
+
+
+def _log_update_result(region, device_id, reading_id, accepted):
+    if accepted:
+        return
+    if accepted is None:
+        # Outside every event-time window's allowed lateness
+        message_log.record_drop(region)
+        if message_log.sample("drop"):
+            logger.warning(
+                f"[{region}] Dropped late reading deduplicationId={reading_id} "
+                f"for device_id={device_id}"
+            )
+        dropped_counter.labels(
+            region=region, device_id=device_labels.label(region, device_id, DROP_WEIGHT)
+        ).inc()
+        local_dropped_counter_processing[region] += 1
+        return
+    message_log.record_duplicate(region)
+    if message_log.sample("duplicate"):
+        logger.info(
+            f"[{region}] Ignored duplicate reading "
+            f"deduplicationId={reading_id} for device_id={device_id}"
+        )
+
+
+def _on_batched_update(reading, future):
+    region, device_id, reading_id = reading.region, reading.device_id, reading.reading_id
+    try:
+        accepted = future.result()
+    except Exception as e:
+        if spill_log.spill(reading, e):
+            return
+        message_log.record_drop(region)
+        if message_log.sample("drop"):
+            logger.error(f"[{region}] Failed to aggregate reading from device_id={device_id}: {e}")
+        dropped_counter.labels(
+            region=region, device_id=device_labels.label(region, device_id, DROP_WEIGHT)
+        ).inc()
+        local_dropped_counter_processing[region] += 1
+        return
+    _log_update_result(region, device_id, reading_id, accepted)
 
 
-def process_message(payload, topic, expected_region, aggregation_store):
+def process_message(record, topic, expected_region, aggregation_store):
     """
-    Process inner payload:
-      - Validate sensor data.
+    Process a decoded uplink record:
       - Enforce region ownership.
-      - Extract device information.
+      - Drop readings that failed validation in decode_uplink.
       - Aggregate sensor data.
-      - Detect events.
+      - Detect events with the configured event rules.
       
     Note: Forwarded counter logic has been removed from this file.
     It will now only be updated in the aggregator worker when aggregated data is actually published.
     """
-    # Extract device info for labeling
-    device_info = payload.get("deviceInfo", {})
-    device_id = device_info.get("devEui", "unknown")
-    device_name = device_info.get("deviceName", "unknown")
-    region_from_config = payload.get("regionConfigId", "unknown")
-    expected_region = _normalize_region(expected_region)
-    normalized_payload_region = _normalize_region(region_from_config)
+    started = stage_timers.start()
+    device_id = record.device_id
+    device_name = record.device_name
+    region_from_config = record.region_config_id
+    expected_region = normalize_region(expected_region)
 
-    if normalized_payload_region != expected_region:
-        logger.warning(
-            f"[{expected_region}] Dropping payload with unexpected regionConfigId={region_from_config} "
-            f"from topic={topic}"
-        )
-        dropped_counter.labels(region=expected_region, device_id=device_id).inc()
+    if record.region != expected_region:
+        message_log.record_drop(expected_region)
+        if message_log.sample("drop"):
+            logger.warning(
+                f"[{expected_region}] Dropping payload with unexpected regionConfigId={region_from_config} "
+                f"from topic={topic}"
+            )
+        dropped_counter.labels(
+            region=expected_region,
+            device_id=device_labels.label(expected_region, device_id, DROP_WEIGHT),
+        ).inc()
         local_dropped_counter_processing[expected_region] += 1
         return
 
-    # Validate payload; if invalid, update dropped counters
-    if not is_valid_payload(payload):
-        logger.warning(f"[{expected_region}] Dropping invalid payload from device_id={device_id}")
-        dropped_counter.labels(region=region_from_config, device_id=device_id).inc()
+    # Sensor values were converted and range-checked once by decode_uplink
+    if not record.valid:
+        dropped_counter.labels(
+            region=region_from_config,
+            device_id=device_labels.label(region_from_config, device_id, DROP_WEIGHT),
+        ).inc()
         local_dropped_counter_processing[region_from_config] += 1
-        logger.info(f"[{region_from_config}] Local dropped count in process_message: {local_dropped_counter_processing[region_from_config]}")
+        message_log.record_drop(expected_region)
+        if message_log.sample("drop"):
+            logger.warning(f"[{expected_region}] Dropping invalid payload from device_id={device_id}")
+            logger.info(f"[{region_from_config}] Local dropped count in process_message: {local_dropped_counter_processing[region_from_config]}")
         return
 
-    # Prefer sensor data from "object" field if available
-    sensor_data = payload.get("object", payload)
-    try:
-        temperature = float(sensor_data.get("temperature"))
-        humidity = float(sensor_data.get("humidity", 0))
-    except Exception as e:
-        logger.error(f"Error converting sensor values: {sensor_data} - {e}")
-        dropped_counter.labels(region=region_from_config, device_id=device_id).inc()
-        local_dropped_counter_processing[region_from_config] += 1
-        logger.info(f"[{region_from_config}] Local dropped count in process_message: {local_dropped_counter_processing[region_from_config]}")
-        return
+    temperature = record.temperature
+    humidity = record.humidity
+    stage_timers.observe(expected_region, "validate", started)
 
-    # Detect events based on thresholds
-    event_detected = (temperature > 35 or humidity > 80)
+    started = stage_timers.start()
+    event_time = _event_time(record)
+    rule_hits = event_rules.evaluate(
+        record, record.region, time.time() if event_time is None else event_time
+    )
+    stage_timers.observe(expected_region, "rules", started)
+    event_detected = bool(rule_hits)
     if event_detected:
-        events_detected_counter.labels(region=region_from_config, device_id=device_id).inc()
-        logger.info(f"Event detected for sensor {device_name} (ID: {device_id}): {sensor_data}")
+        events_detected_counter.labels(
+            region=region_from_config,
+            device_id=device_labels.label(region_from_config, device_id, weight=0),
+        ).inc()
+        message_log.record_event(expected_region)
+        if message_log.sample("event"):
+            logger.info(
+                f"Event detected for sensor {device_name} (ID: {device_id}) "
+                f"by rule(s) {', '.join(rule_hits)}: {record.sensor_data}"
+            )
+    elif backpressure.shedding(expected_region):
+        # The outbox or Redis memory is past its watermark; keep only events
+        backpressure_shed_counter.labels(region=expected_region).inc()
+        dropped_counter.labels(
+            region=region_from_config,
+            device_id=device_labels.label(region_from_config, device_id, DROP_WEIGHT),
+        ).inc()
+        local_dropped_counter_processing[region_from_config] += 1
+        message_log.record_drop(expected_region)
+        if message_log.sample("drop"):
+            logger.warning(
+                f"[{expected_region}] Backpressure: shedding reading from device_id={device_id}"
+            )
+        return
 
-    reading_id = payload.get("deduplicationId")
-    accepted = aggregation_store.update(
+    reading = Reading(
         device_id,
         device_name,
         region_from_config,
         temperature,
         humidity,
         event_detected,
-        reading_id=reading_id,
+        record.reading_id,
+        event_time,
     )
-    if not accepted:
-        logger.info(
-            f"[{region_from_config}] Ignored duplicate reading "
-            f"deduplicationId={reading_id} for device_id={device_id}"
+    try:
+        accepted = aggregation_store.update(
+            device_id,
+            device_name,
+            region_from_config,
+            temperature,
+            humidity,
+            event_detected,
+            reading_id=reading.reading_id,
+            event_time=event_time,
         )
+    except Exception as e:
+        # Kept on local disk and replayed once Redis is back
+        if spill_log.spill(reading, e):
+            return
+        raise
+    if isinstance(accepted, Future):
+        # Micro-batched update; the result arrives once the batch is applied.
+        accepted.add_done_callback(partial(_on_batched_update, reading))
+    else:
+        _log_update_result(region_from_config, device_id, reading.reading_id, accepted)
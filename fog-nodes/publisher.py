@@ -1,6 +1,9 @@
 # publisher.py
-import json
+import time
+from collections import OrderedDict
 import paho.mqtt.client as mqtt
+import codec
+from metrics import publish_ack_latency_histogram, publish_in_flight_gauge
 
 def publish_to_central(
     mqtt_client,
@@ -11,8 +14,8 @@ def publish_to_central(
     """
     Publish aggregated data at QoS 1 and wait for the broker acknowledgment.
     """
-    payload_str = json.dumps(data)
-    ret = mqtt_client.publish(central_topic, payload_str, qos=1)
+    payload = codec.dumps(data)
+    ret = mqtt_client.publish(central_topic, payload, qos=1)
     if ret.rc != mqtt.MQTT_ERR_SUCCESS:
         raise Exception(f"MQTT publish failed with return code: {ret.rc}")
     ret.wait_for_publish(timeout=publish_timeout)
@@ -21,3 +24,94 @@ def publish_to_central(
             f"MQTT broker did not acknowledge publish within {publish_timeout} seconds"
         )
     return ret
+
+
+class PublishWindow:
+    """
+    Keep up to ``max_in_flight`` QoS 1 publishes outstanding at once.
+
+    Publishes are tracked by MQTT message id. ``publish`` and ``drain`` return
+    ``(key, error)`` pairs for publishes that have completed; ``error`` is None
+    once the broker's PUBACK arrived and an exception on failure or timeout.
+    """
+
+    def __init__(
+        self,
+        mqtt_client,
+        central_topic="central/data",
+        max_in_flight=20,
+        publish_timeout=10,
+        region="unknown",
+    ):
+        self.mqtt_client = mqtt_client
+        self.central_topic = central_topic
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.publish_timeout = float(publish_timeout)
+        self._in_flight = OrderedDict()
+        self._in_flight_gauge = publish_in_flight_gauge.labels(region=region)
+        self._ack_latency = publish_ack_latency_histogram.labels(region=region)
+
+    def publish(self, key, data):
+        """Publish a message dict, or an already encoded str/bytes payload."""
+        completed = []
+        while len(self._in_flight) >= self.max_in_flight:
+            completed.extend(self._wait_for_oldest())
+
+        try:
+            payload = data if isinstance(data, (bytes, str)) else codec.dumps(data)
+            ret = self.mqtt_client.publish(self.central_topic, payload, qos=1)
+        except Exception as e:
+            # Such as a payload the client refuses; only this key fails
+            completed.append((key, e))
+        else:
+            if ret.rc != mqtt.MQTT_ERR_SUCCESS:
+                completed.append(
+                    (key, Exception(f"MQTT publish failed with return code: {ret.rc}"))
+                )
+            else:
+                self._in_flight[ret.mid] = (key, ret, time.monotonic())
+        completed.extend(self.poll())
+        return completed
+
+    def poll(self):
+        """Collect publishes that were acknowledged or timed out."""
+        completed = []
+        now = time.monotonic()
+        for mid, (key, info, sent_at) in list(self._in_flight.items()):
+            if info.is_published():
+                del self._in_flight[mid]
+                self._ack_latency.observe(now - sent_at)
+                completed.append((key, None))
+            elif now - sent_at >= self.publish_timeout:
+                del self._in_flight[mid]
+                completed.append((key, self._timeout_error()))
+        self._in_flight_gauge.set(len(self._in_flight))
+        return completed
+
+    def drain(self):
+        """Wait until every outstanding publish is acknowledged or timed out."""
+        completed = self.poll()
+        while self._in_flight:
+            completed.extend(self._wait_for_oldest())
+        return completed
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def _wait_for_oldest(self):
+        mid, (key, info, sent_at) = next(iter(self._in_flight.items()))
+        remaining = self.publish_timeout - (time.monotonic() - sent_at)
+        if remaining > 0 and not info.is_published():
+            info.wait_for_publish(timeout=remaining)
+        completed = self.poll()
+        if mid in self._in_flight:
+            # Not acknowledged within the timeout even though poll raced the clock
+            del self._in_flight[mid]
+            completed.append((key, self._timeout_error()))
+            self._in_flight_gauge.set(len(self._in_flight))
+        return completed
+
+    def _timeout_error(self):
+        return TimeoutError(
+            f"MQTT broker did not acknowledge publish within {self.publish_timeout} seconds"
+        )
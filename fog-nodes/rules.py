@@ -0,0 +1,274 @@
+"""
+Configurable event detection.
+
+Rules are read from a JSON file and compiled once into predicates, so a
+reading is checked without parsing anything. ``event_rules.evaluate`` returns
+the names of the rules a reading trips. A background thread reloads the file
+when it changes; readers keep using the previous rule set until the new one
+has compiled.
+
+Each rule names a ``metric`` (``temperature`` or ``humidity``) and a ``type``:
+
+* ``threshold``: trips while the value is above ``above`` or below ``below``.
+* ``rate``: trips when the change since the device's previous reading, scaled
+  to ``per`` seconds (default 60), is above ``above`` or below ``below``.
+* ``hysteresis``: turns on when the value goes above ``above`` (or below
+  ``below``) and stays on until it drops below ``clear_below`` (or rises above
+  ``clear_above``).
+
+``regions`` and ``device_classes`` limit a rule to those regions and ChirpStack
+device profiles; a rule without them applies everywhere.
+"""
+import json
+import logging
+import os
+import threading
+from operator import attrgetter
+
+logger = logging.getLogger(__name__)
+
+RULE_TYPES = ("threshold", "rate", "hysteresis")
+METRICS = ("temperature", "humidity")
+
+# The thresholds process_message used before rules were configurable
+DEFAULT_RULES = [
+    {"name": "high-temperature", "metric": "temperature", "above": 35},
+    {"name": "high-humidity", "metric": "humidity", "above": 80},
+]
+
+
+def _limit(spec, key):
+    value = spec.get(key)
+    return None if value is None else float(value)
+
+
+def _threshold(metric, spec):
+    above, below = _limit(spec, "above"), _limit(spec, "below")
+    if above is None and below is None:
+        raise ValueError("needs 'above' or 'below'")
+    if below is None:
+        return lambda device_id, record, timestamp: metric(record) > above
+    if above is None:
+        return lambda device_id, record, timestamp: metric(record) < below
+    return lambda device_id, record, timestamp: not below <= metric(record) <= above
+
+
+def _rate(metric, spec):
+    above, below = _limit(spec, "above"), _limit(spec, "below")
+    if above is None and below is None:
+        raise ValueError("needs 'above' or 'below'")
+    per = float(spec.get("per", 60))
+    if per <= 0:
+        raise ValueError("'per' must be positive")
+    # Updated without a lock: readings of one device rarely overlap, and a
+    # lost update only skips one rate sample
+    previous = {}
+
+    def predicate(device_id, record, timestamp):
+        value = metric(record)
+        last = previous.get(device_id)
+        previous[device_id] = (timestamp, value)
+        if last is None or timestamp <= last[0]:
+            return False
+        rate = (value - last[1]) * per / (timestamp - last[0])
+        return (above is not None and rate > above) or (below is not None and rate < below)
+
+    return predicate
+
+
+def _hysteresis(metric, spec):
+    above, below = _limit(spec, "above"), _limit(spec, "below")
+    if (above is None) == (below is None):
+        raise ValueError("needs exactly one of 'above' or 'below'")
+    if above is not None:
+        clear = _limit(spec, "clear_below")
+        if clear is None or clear > above:
+            raise ValueError("needs 'clear_below' no higher than 'above'")
+        enters = lambda value: value > above
+        clears = lambda value: value < clear
+    else:
+        clear = _limit(spec, "clear_above")
+        if clear is None or clear < below:
+            raise ValueError("needs 'clear_above' no lower than 'below'")
+        enters = lambda value: value < below
+        clears = lambda value: value > clear
+    active = set()
+
+    def predicate(device_id, record, timestamp):
+        value = metric(record)
+        if device_id in active:
+            if clears(value):
+                active.discard(device_id)
+                return False
+            return True
+        if enters(value):
+            active.add(device_id)
+            return True
+        return False
+
+    return predicate
+
+
+_COMPILERS = {"threshold": _threshold, "rate": _rate, "hysteresis": _hysteresis}
+
+
+class Rule:
+    __slots__ = ("name", "key", "regions", "device_classes", "predicate")
+
+    def __init__(self, name, key, regions, device_classes, predicate):
+        self.name = name
+        self.key = key
+        self.regions = regions
+        self.device_classes = device_classes
+        self.predicate = predicate
+
+    def applies_to(self, region, device_class):
+        return (self.regions is None or region in self.regions) and (
+            self.device_classes is None or device_class in self.device_classes
+        )
+
+
+def _scope(spec, key):
+    values = spec.get(key)
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = [values]
+    return frozenset(str(value).strip().lower() for value in values)
+
+
+def compile_rule(spec, index=0):
+    """Compile one rule specification; raises ValueError when it is invalid."""
+    if not isinstance(spec, dict):
+        raise ValueError(f"Rule {index} is not a JSON object")
+    name = str(spec.get("name") or f"rule-{index}")
+    rule_type = spec.get("type", "threshold")
+    if rule_type not in RULE_TYPES:
+        raise ValueError(
+            f"Rule {name!r} has unknown type {rule_type!r}; "
+            f"expected one of {', '.join(RULE_TYPES)}"
+        )
+    metric = spec.get("metric")
+    if metric not in METRICS:
+        raise ValueError(
+            f"Rule {name!r} has unknown metric {metric!r}; "
+            f"expected one of {', '.join(METRICS)}"
+        )
+    try:
+        predicate = _COMPILERS[rule_type](attrgetter(metric), spec)
+    except (TypeError, ValueError) as exc:
+        raise ValueError(f"Rule {name!r} {exc}") from None
+    return Rule(
+        name,
+        json.dumps(spec, sort_keys=True),
+        _scope(spec, "regions"),
+        _scope(spec, "device_classes"),
+        predicate,
+    )
+
+
+class RuleSet:
+    """Compiled rules, with the subset that applies to each region and device class cached."""
+
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self._scoped = {}
+
+    def for_scope(self, region, device_class):
+        scope = (region, device_class)
+        rules = self._scoped.get(scope)
+        if rules is None:
+            rules = self._scoped[scope] = tuple(
+                (rule.name, rule.predicate)
+                for rule in self.rules
+                if rule.applies_to(region, device_class)
+            )
+        return rules
+
+
+def compile_rules(specs, previous=None):
+    """
+    Compile a list of rule specifications. Rules that are unchanged from
+    ``previous`` are reused, so rate and hysteresis state survives a reload.
+    """
+    if not isinstance(specs, list):
+        raise ValueError("Event rules must be a JSON list")
+    reusable = {rule.key: rule for rule in previous.rules} if previous else {}
+    rules = []
+    for index, spec in enumerate(specs):
+        rule = compile_rule(spec, index)
+        rules.append(reusable.pop(rule.key, rule))
+    return RuleSet(rules)
+
+
+class RuleEngine:
+    """
+    Evaluates the configured rules for each reading. Without a rules file
+    the built-in temperature and humidity thresholds apply.
+    """
+
+    def __init__(self, path=None, reload_interval=0):
+        self._thread = None
+        self._stop = threading.Event()
+        self.configure(path, reload_interval)
+
+    def configure(self, path=None, reload_interval=0):
+        self.path = path or None
+        self.reload_interval = max(float(reload_interval), 0)
+        self._mtime = None
+        self._rules = compile_rules(DEFAULT_RULES)
+        if self.path:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            self._rules = self._load()
+            logger.info(f"Loaded {len(self._rules.rules)} event rule(s) from {self.path}")
+        return self
+
+    def _load(self):
+        with open(self.path, "rb") as rules_file:
+            try:
+                specs = json.load(rules_file)
+            except ValueError as exc:
+                raise ValueError(f"{self.path} is not valid JSON: {exc}") from None
+        return compile_rules(specs, self._rules)
+
+    def evaluate(self, record, region, timestamp):
+        """Return the names of the rules ``record`` trips, in rule order."""
+        device_id = record.device_id
+        return [
+            name
+            for name, predicate in self._rules.for_scope(region, record.device_class)
+            if predicate(device_id, record, timestamp)
+        ]
+
+    def reload(self):
+        """Recompile the rules file if it changed. Returns True when it was reloaded."""
+        if not self.path:
+            return False
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return False
+            # Remember the change even if it fails to compile, so a broken
+            # file is reported once rather than on every check
+            self._mtime = mtime
+            self._rules = self._load()
+        except (OSError, ValueError) as exc:
+            logger.error(f"Keeping the current event rules; reloading {self.path} failed: {exc}")
+            return False
+        logger.info(f"Reloaded {len(self._rules.rules)} event rule(s) from {self.path}")
+        return True
+
+    def start(self):
+        if self._thread is None and self.path and self.reload_interval:
+            self._thread = threading.Thread(
+                target=self.run, name="event-rules-reload", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stop.wait(self.reload_interval):
+            self.reload()
+
+
+event_rules = RuleEngine()
@@ -0,0 +1,305 @@
+"""
+Local spill log for readings that cannot reach Redis.
+
+During a Sentinel failover or a network split, updates fail for a few
+seconds. Instead of dropping those readings, ``process_message`` appends them
+to a fixed-size, memory-mapped file. A background replayer writes them back
+through pipelined ``update_many`` calls once Redis answers again. Replayed
+readings keep their ``reading_id``, so Redis deduplication still drops
+readings that were applied before the failure was reported.
+
+The file starts with a header holding the replay and append offsets,
+followed by length-prefixed JSON readings. A record is written before the
+append offset that covers it, so a crash never exposes half a record. The
+file is never grown: once it is full, further readings are dropped and
+counted. Space is reclaimed when the replayer catches up, or compacted once
+half of the file has been replayed.
+"""
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+import redis
+
+import codec
+from aggregation_store import Reading
+from metrics import (
+    spill_bytes_gauge,
+    spill_discarded_counter,
+    spill_overflow_counter,
+    spill_replay_rate_gauge,
+    spill_replayed_counter,
+    spill_written_counter,
+)
+
+logger = logging.getLogger(__name__)
+
+# Failures that a failover or reconnect clears; anything else is a bug and
+# is not worth replaying
+SPILL_ERRORS = (
+    redis.exceptions.ConnectionError,
+    redis.exceptions.TimeoutError,
+    redis.exceptions.ClusterDownError,
+    redis.exceptions.ReadOnlyError,
+    redis.exceptions.NoScriptError,
+)
+
+_MAGIC = b"FOGSPIL1"
+# Magic, replay offset, append offset
+_HEADER = struct.Struct("<8sQQ")
+_LENGTH = struct.Struct("<I")
+
+
+class SpillLog:
+    """A bounded append-only log of readings, replayed into Redis in batches."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._map = None
+        self._file = None
+        self._thread = None
+        self._stop = threading.Event()
+        self.configure()
+
+    def configure(self, path=None, max_bytes=64 * 1024 * 1024, replay_batch_size=500,
+                  replay_interval=1):
+        self.close()
+        self.path = path or None
+        self.max_bytes = max(int(max_bytes), _HEADER.size + 4096)
+        self.replay_batch_size = max(int(replay_batch_size), 1)
+        self.replay_interval = max(float(replay_interval), 0.1)
+        if self.path:
+            self._open()
+        return self
+
+    @property
+    def enabled(self):
+        return self._map is not None
+
+    def _open(self):
+        spill_file = open(self.path, "a+b")
+        try:
+            # Two processes appending to one mapping would corrupt it
+            fcntl.flock(spill_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            spill_file.close()
+            raise RuntimeError(f"Spill log {self.path} is in use by another process") from None
+        size = os.fstat(spill_file.fileno()).st_size
+        if size < _HEADER.size:
+            size = self.max_bytes
+            spill_file.truncate(size)
+        self._file = spill_file
+        self._map = mmap.mmap(spill_file.fileno(), size)
+        magic, self._read, self._write = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC or not _HEADER.size <= self._read <= self._write <= size:
+            if any(self._map[:_HEADER.size]):
+                logger.error(f"Spill log {self.path} has an invalid header; starting it empty")
+            self._read = self._write = _HEADER.size
+            self._store_offsets()
+        elif size != self.max_bytes:
+            logger.warning(
+                f"Spill log {self.path} keeps its existing size of {size} bytes "
+                f"until it is removed"
+            )
+        spill_bytes_gauge.set(self._write - self._read)
+        if self._write > self._read:
+            logger.warning(
+                f"Spill log {self.path} holds {self._write - self._read} bytes of "
+                f"readings to replay"
+            )
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stop.clear()
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def _store_offsets(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, self._read, self._write)
+
+    def pending_bytes(self):
+        return self._write - self._read if self._map is not None else 0
+
+    def append(self, reading):
+        """Write one reading; returns False when the log is full or disabled."""
+        if self._map is None:
+            return False
+        payload = codec.dumps(list(reading))
+        with self._lock:
+            start = self._write + _LENGTH.size
+            end = start + len(payload)
+            if end > len(self._map):
+                spill_overflow_counter.labels(region=reading.region).inc()
+                return False
+            self._map[start:end] = payload
+            _LENGTH.pack_into(self._map, self._write, len(payload))
+            self._write = end
+            self._store_offsets()
+            pending = self._write - self._read
+        spill_written_counter.labels(region=reading.region).inc()
+        spill_bytes_gauge.set(pending)
+        return True
+
+    def spill(self, reading, error):
+        """
+        Keep ``reading`` for replay after a Redis failure. Returns False when
+        the error is not a Redis outage or the reading could not be kept.
+        """
+        return isinstance(error, SPILL_ERRORS) and self.append(reading)
+
+    def _read_batch(self):
+        """Return the next readings to replay and the offset after them."""
+        with self._lock:
+            offset, write = self._read, self._write
+            readings = []
+            while offset < write and len(readings) < self.replay_batch_size:
+                (length,) = _LENGTH.unpack_from(self._map, offset)
+                start = offset + _LENGTH.size
+                readings.append(Reading(*codec.loads(self._map[start:start + length])))
+                offset = start + length
+        return readings, offset
+
+    def _consume(self, offset):
+        with self._lock:
+            self._read = offset
+            if self._read == self._write:
+                self._read = self._write = _HEADER.size
+            elif self._read - _HEADER.size >= len(self._map) // 2:
+                # Move the unreplayed tail to the front so appends have room.
+                # It is no longer than the replayed part it lands on, so a
+                # crash mid-move leaves the old offsets and records intact.
+                pending = self._write - self._read
+                self._map.move(_HEADER.size, self._read, pending)
+                self._read = _HEADER.size
+                self._write = _HEADER.size + pending
+            self._store_offsets()
+            pending = self._write - self._read
+        spill_bytes_gauge.set(pending)
+
+    def _settle(self, readings, offset, results):
+        """
+        Move the replay offset past a batch, given one result or exception per
+        reading. Readings that hit another outage are appended again rather
+        than replaying the whole batch, which would count the applied readings
+        without a ``reading_id`` twice. Readings Redis rejected for any other
+        reason would fail forever, so they are logged and discarded. Returns
+        the applied readings and the number kept for a later replay.
+        """
+        applied, discarded, retried = [], [], 0
+        for reading, result in zip(readings, results):
+            if isinstance(result, SPILL_ERRORS):
+                self.append(reading)
+                retried += 1
+            elif isinstance(result, Exception):
+                discarded.append((reading, result))
+            else:
+                applied.append(reading)
+        self._consume(offset)
+        if discarded:
+            for reading, _ in discarded:
+                spill_discarded_counter.labels(region=reading.region).inc()
+            logger.error(
+                f"Discarded {len(discarded)} spilled reading(s) that Redis rejected: "
+                f"{discarded[0][1]}"
+            )
+        if retried:
+            logger.warning(
+                f"Spill log replay paused; {retried} reading(s) failed again and were kept"
+            )
+        return applied, retried
+
+    def _replayed(self, readings, started, replayed):
+        for reading in readings:
+            spill_replayed_counter.labels(region=reading.region).inc()
+        elapsed = time.monotonic() - started
+        if elapsed > 0:
+            spill_replay_rate_gauge.set(replayed / elapsed)
+
+    def replay(self, aggregation_store):
+        """
+        Replay spilled readings until the log is empty or Redis fails again.
+        Returns the number of readings replayed.
+        """
+        started = time.monotonic()
+        replayed = 0
+        while True:
+            readings, offset = self._read_batch()
+            if not readings:
+                break
+            try:
+                results = aggregation_store.update_many(readings, raise_on_error=False)
+            except SPILL_ERRORS as e:
+                logger.warning(f"Spill log replay paused; Redis is still unavailable: {e}")
+                break
+            except Exception as e:
+                results = [e] * len(readings)
+            applied, retried = self._settle(readings, offset, results)
+            replayed += len(applied)
+            self._replayed(applied, started, replayed)
+            if retried:
+                break
+        if replayed:
+            logger.info(
+                f"Replayed {replayed} spilled reading(s) in {time.monotonic() - started:.3f}s"
+            )
+        return replayed
+
+    async def replay_async(self, aggregation_store):
+        started = time.monotonic()
+        replayed = 0
+        while True:
+            readings, offset = self._read_batch()
+            if not readings:
+                break
+            try:
+                results = await aggregation_store.update_many(readings, raise_on_error=False)
+            except SPILL_ERRORS as e:
+                logger.warning(f"Spill log replay paused; Redis is still unavailable: {e}")
+                break
+            except Exception as e:
+                results = [e] * len(readings)
+            applied, retried = self._settle(readings, offset, results)
+            replayed += len(applied)
+            self._replayed(applied, started, replayed)
+            if retried:
+                break
+        if replayed:
+            logger.info(
+                f"Replayed {replayed} spilled reading(s) in {time.monotonic() - started:.3f}s"
+            )
+        return replayed
+
+    def start(self, aggregation_store):
+        if self._thread is None and self.enabled:
+            self._thread = threading.Thread(
+                target=self.run, args=(aggregation_store,), name="spill-replay", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def run(self, aggregation_store):
+        while not self._stop.wait(self.replay_interval):
+            if self._write > self._read:
+                self.replay(aggregation_store)
+
+    async def run_async(self, aggregation_store):
+        if not self.enabled:
+            return
+        while True:
+            await asyncio.sleep(self.replay_interval)
+            if self._write > self._read:
+                await self.replay_async(aggregation_store)
+
+
+spill_log = SpillLog()
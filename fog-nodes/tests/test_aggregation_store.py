@@ -1,28 +1,105 @@
 import os
+import threading
+import time
 import unittest
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
+from prometheus_client import REGISTRY
 import redis
+from redis.cluster import ClusterNode, RedisCluster
+from redis.crc import key_slot
+from redis.exceptions import RedisClusterException
 
-from aggregation_store import RedisAggregationStore
+from aggregation_store import Reading, RedisAggregationStore
+
+
+class ScriptRecorder:
+    def __init__(self):
+        self.calls = []
+
+    def register_script(self, script):
+        def run(keys=None, args=None, client=None):
+            self.calls.append(keys)
+            return 1
+
+        return run
+
+
+class HashTaggedKeyTests(unittest.TestCase):
+    def assert_single_slot(self, keys):
+        self.assertEqual(len({key_slot(key.encode()) for key in keys}), 1, keys)
+
+    def test_every_script_call_for_a_region_uses_one_slot(self):
+        for backend in ("key", "bloom"):
+            client = ScriptRecorder()
+            store = RedisAggregationStore(
+                client,
+                deduplication_backend=backend,
+                bloom_capacity=1000,
+                hash_tags=True,
+            )
+            store.update("device-1", "Sensor 1", "eu868", 20, 50, False, "reading-1")
+            store.update("device-1", "Sensor 1", "eu868", 20, 50, False)
+            store.flush_window("eu868", 300)
+            keys, _ = store._merge_command(
+                "device-1", "Sensor 1", "eu868", [("reading-2", 20, 50, False)]
+            )
+            client.calls.append(keys)
+
+            for keys in client.calls:
+                self.assert_single_slot(keys)
+            self.assertIn("{eu868}", store._region_prefix("eu868"))
+            self.assertNotEqual(
+                key_slot(store._outbox_key("eu868").encode()),
+                key_slot(store._outbox_key("us915").encode()),
+            )
+
+    def test_keys_are_unchanged_without_hash_tags(self):
+        store = RedisAggregationStore(ScriptRecorder(), prefix="sensiot:fog")
+        self.assertEqual(store._outbox_key("eu868"), "sensiot:fog:outbox:eu868")
+        self.assertEqual(
+            store.deduplication.reading_keys("reading-1", "eu868")[0],
+            store.deduplication.key("reading-1"),
+        )
+
+
+class StageTimingTests(unittest.TestCase):
+    def count(self, region):
+        return REGISTRY.get_sample_value(
+            "fog_stage_duration_seconds_count", {"region": region, "stage": "redis_update"}
+        )
+
+    def test_updates_are_timed_under_the_normalized_region(self):
+        store = RedisAggregationStore(ScriptRecorder())
+        before = self.count("in865") or 0
+
+        store.update("device-1", "Sensor 1", "IN865", 20, 50, False, "reading-1")
+
+        self.assertEqual(self.count("in865"), before + 1)
+        self.assertIsNone(self.count("IN865"))
+
+
+def _redis_test_client():
+    client = redis.Redis(
+        host=os.getenv("REDIS_TEST_HOST", "localhost"),
+        port=int(os.getenv("REDIS_TEST_PORT", "6379")),
+        decode_responses=True,
+        socket_connect_timeout=1,
+    )
+    try:
+        client.ping()
+    except redis.RedisError as exc:
+        raise unittest.SkipTest(f"Redis test server is unavailable: {exc}")
+    return client
 
 
 class RedisAggregationStoreIntegrationTests(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        host = os.getenv("REDIS_TEST_HOST", "localhost")
-        port = int(os.getenv("REDIS_TEST_PORT", "6379"))
-        cls.client = redis.Redis(
-            host=host,
-            port=port,
-            decode_responses=True,
-            socket_connect_timeout=1,
-        )
-        try:
-            cls.client.ping()
-        except redis.RedisError as exc:
-            raise unittest.SkipTest(f"Redis test server is unavailable: {exc}")
+        cls.client = _redis_test_client()
+
+    store_options = {}
 
     def setUp(self):
         self.prefix = f"test:sensiot:{uuid.uuid4().hex}"
@@ -31,6 +108,7 @@ class RedisAggregationStoreIntegrationTests(unittest.TestCase):
             prefix=self.prefix,
             deduplication_ttl=60,
             outbox_visibility_timeout=2,
+            **self.store_options,
         )
         self.region = "eu868"
 
@@ -69,6 +147,123 @@ class RedisAggregationStoreIntegrationTests(unittest.TestCase):
         self.assertEqual(self.store.acknowledge_outbox_message(self.region, raw_message), 1)
         self.assertEqual(self.store.outbox_size(self.region), 0)
 
+    def test_event_readings_are_queued_in_the_priority_outbox_at_once(self):
+        self.store.update("device-1", "Sensor 1", self.region, 20, 50, False, "reading-1")
+        self.store.update("device-1", "Sensor 1", self.region, 41, 50, True, "reading-2")
+        self.store.update("device-1", "Sensor 1", self.region, 41, 50, True, "reading-2")
+
+        self.assertEqual(self.store.outbox_size(self.region, priority=True), 1)
+        claimed = self.store.claim_outbox_batch(self.region, 10, priority=True)
+        message = claimed[0][1]
+        self.assertEqual(message["kind"], "event")
+        self.assertEqual(message["aggregate_id"], "event:reading-2")
+        self.assertEqual((message["temperature"], message["humidity"]), (41, 50))
+        self.assertTrue(message["event"])
+        self.assertEqual(
+            self.store.acknowledge_outbox_batch(self.region, claimed, priority=True), 1
+        )
+
+        now = datetime.now(timezone.utc)
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 1)
+        _, aggregate = self.store.claim_outbox_message(self.region, now.timestamp())
+        self.assertEqual(aggregate["sample_count"], 2)
+        self.assertTrue(aggregate["event"])
+
+    def test_update_many_applies_a_pipelined_batch_with_deduplication(self):
+        self.store.update("device-1", "Sensor 1", self.region, 10, 40, False, "reading-1")
+
+        results = self.store.update_many(
+            [
+                Reading("device-1", "Sensor 1", self.region, 99, 99, True, "reading-1"),
+                Reading("device-1", "Sensor 1", self.region, 30, 60, False, "reading-2"),
+                Reading("device-2", "Sensor 2", self.region, 20, 50, True),
+                Reading("device-1", "Sensor 1", self.region, 99, 99, True, "reading-2"),
+            ]
+        )
+
+        self.assertEqual(results, [False, True, True, False])
+        now = datetime.now(timezone.utc)
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 2)
+        messages = {}
+        while True:
+            claimed = self.store.claim_outbox_message(self.region, now.timestamp())
+            if not claimed:
+                break
+            messages[claimed[1]["device_id"]] = claimed[1]
+        self.assertEqual(messages["device-1"]["sample_count"], 2)
+        self.assertAlmostEqual(messages["device-1"]["avg_temperature"], 20)
+        self.assertFalse(messages["device-1"]["event"])
+        self.assertTrue(messages["device-2"]["event"])
+
+    def test_update_many_can_report_a_failed_reading_without_raising(self):
+        results = self.store.update_many(
+            [
+                Reading("device-1", "Sensor 1", self.region, 10, 40, False, "reading-1"),
+                Reading("device-1", "Sensor 1", self.region, "not-a-number", 40, False, "reading-2"),
+                Reading("device-1", "Sensor 1", self.region, 30, 60, False, "reading-3"),
+            ],
+            raise_on_error=False,
+        )
+
+        self.assertEqual(results[0], True)
+        self.assertIsInstance(results[1], redis.ResponseError)
+        self.assertEqual(results[2], True)
+        now = datetime.now(timezone.utc)
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 1)
+        _, aggregate = self.store.claim_outbox_message(self.region, now.timestamp())
+        self.assertEqual(aggregate["sample_count"], 2)
+
+    def test_merge_many_folds_device_partials_with_deduplication(self):
+        self.store.update("device-1", "Sensor 1", self.region, 10, 40, False, "reading-1")
+
+        results = self.store.merge_many(
+            [
+                (
+                    "device-1",
+                    "Sensor 1",
+                    self.region,
+                    [
+                        ("reading-1", 99, 99, True),
+                        ("reading-2", 20.1, 50, False),
+                        ("reading-3", 29.9, 60, False),
+                    ],
+                ),
+                ("device-2", "Sensor 2", self.region, [("reading-4", 36, 50, True)]),
+            ]
+        )
+
+        self.assertEqual(results, [[False, True, True], [True]])
+        now = datetime.now(timezone.utc)
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 2)
+        messages = {}
+        while True:
+            claimed = self.store.claim_outbox_message(self.region, now.timestamp())
+            if not claimed:
+                break
+            messages[claimed[1]["device_id"]] = claimed[1]
+        self.assertEqual(messages["device-1"]["sample_count"], 3)
+        self.assertAlmostEqual(messages["device-1"]["avg_temperature"], 20)
+        self.assertAlmostEqual(messages["device-1"]["min_temperature"], 10)
+        self.assertAlmostEqual(messages["device-1"]["max_temperature"], 29.9)
+        self.assertAlmostEqual(messages["device-1"]["max_humidity"], 60)
+        self.assertFalse(messages["device-1"]["event"])
+        self.assertTrue(messages["device-2"]["event"])
+
+    def test_window_keeps_min_max_and_variance(self):
+        for temperature, humidity in ((10, 40), (30, 60), (20, 50)):
+            self.store.update("device-1", "Sensor 1", self.region, temperature, humidity, False)
+
+        now = datetime.now(timezone.utc)
+        self.store.flush_window(self.region, 300, now)
+        _, message = self.store.claim_outbox_message(self.region, now.timestamp())
+
+        self.assertAlmostEqual(message["min_temperature"], 10)
+        self.assertAlmostEqual(message["max_temperature"], 30)
+        self.assertAlmostEqual(message["sum_sq_temperature"], 1400)
+        self.assertAlmostEqual(message["var_temperature"], 200 / 3)
+        self.assertAlmostEqual(message["min_humidity"], 40)
+        self.assertAlmostEqual(message["var_humidity"], 200 / 3)
+
     def test_only_one_replica_can_flush_a_region_window(self):
         now = datetime.now(timezone.utc)
         self.store.update("device-1", "Sensor 1", self.region, 20, 50, False)
@@ -83,6 +278,7 @@ class RedisAggregationStoreIntegrationTests(unittest.TestCase):
             prefix=self.prefix,
             deduplication_ttl=60,
             outbox_visibility_timeout=2,
+            **self.store_options,
         )
         self.store.update("device-1", "Sensor 1", self.region, 10, 40, False)
         replica_two.update("device-1", "Sensor 1", self.region, 30, 60, False)
@@ -108,6 +304,384 @@ class RedisAggregationStoreIntegrationTests(unittest.TestCase):
         second = self.store.claim_outbox_message(self.region, now.timestamp() + 3)
         self.assertEqual(second[0], first[0])
 
+    def test_batch_claim_hides_messages_until_acknowledged_or_timed_out(self):
+        now = datetime.now(timezone.utc)
+        for index in range(5):
+            self.store.update(f"device-{index}", "Sensor", self.region, 20, 50, False)
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 5)
+
+        first = self.store.claim_outbox_batch(self.region, 3, now.timestamp())
+        second = self.store.claim_outbox_batch(self.region, 3, now.timestamp())
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertEqual(self.store.claim_outbox_batch(self.region, 3, now.timestamp() + 1), [])
+
+        self.assertEqual(self.store.acknowledge_outbox_batch(self.region, first), 3)
+        self.assertEqual(self.store.outbox_size(self.region), 2)
+        reclaimed = self.store.claim_outbox_batch(self.region, 10, now.timestamp() + 3)
+        self.assertEqual(
+            sorted(raw for raw, _ in reclaimed), sorted(raw for raw, _ in second)
+        )
+
+    def test_deferred_batch_becomes_visible_after_retry_delay(self):
+        now = datetime.now(timezone.utc)
+        self.store.update("device-1", "Sensor 1", self.region, 20, 50, False)
+        self.store.flush_window(self.region, 300, now)
+
+        claimed = self.store.claim_outbox_batch(self.region, 10)
+        self.store.defer_outbox_batch(self.region, claimed, 0)
+        self.assertEqual(len(self.store.claim_outbox_batch(self.region, 10)), 1)
+
+    def test_queuing_messages_keeps_a_wake_token_for_the_next_waiting_replica(self):
+        self.assertFalse(self.store.wait_for_outbox(self.region, 0.05))
+
+        now = datetime.now(timezone.utc)
+        self.store.update("device-1", "Sensor 1", self.region, 20, 50, False)
+        self.store.flush_window(self.region, 300, now)
+        self.store.update("device-1", "Sensor 1", self.region, 40, 50, True)
+
+        self.assertEqual(self.client.llen(self.store._wake_key(self.region)), 1)
+        self.assertTrue(self.store.wait_for_outbox(self.region, 1))
+        self.assertFalse(self.store.wait_for_outbox(self.region, 0.05))
+
+    def test_queuing_messages_wakes_every_waiting_replica(self):
+        woken = []
+        waiters = [
+            threading.Thread(
+                target=lambda: woken.append(self.store.wait_for_outbox(self.region, 3))
+            )
+            for _ in range(3)
+        ]
+        for waiter in waiters:
+            waiter.start()
+        waiters_key = self.store._waiters_key(self.region)
+        deadline = time.monotonic() + 2
+        while self.client.zcard(waiters_key) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.store.update("device-1", "Sensor 1", self.region, 40, 50, True)
+        for waiter in waiters:
+            waiter.join(3)
+
+        self.assertEqual(woken, [True, True, True])
+        self.assertEqual(self.client.zcard(waiters_key), 0)
+
+
+class BloomDeduplicationIntegrationTests(RedisAggregationStoreIntegrationTests):
+    store_options = {
+        "deduplication_backend": "bloom",
+        "bloom_capacity": 1000,
+        "bloom_error_rate": 0.0001,
+        "bloom_bucket_seconds": 30,
+    }
+
+    def test_bloom_buckets_replace_per_reading_keys(self):
+        for index in range(20):
+            self.store.update(
+                "device-1", "Sensor 1", self.region, 20, 50, False, f"reading-{index}"
+            )
+
+        self.assertEqual(list(self.client.scan_iter(f"{self.prefix}:dedupe:*")), [])
+        buckets = list(self.client.scan_iter(f"{self.prefix}:dedupe-bloom:*"))
+        self.assertEqual(len(buckets), 1)
+        self.assertGreater(self.client.ttl(buckets[0]), 60)
+
+
+class ChunkedFlushIntegrationTests(RedisAggregationStoreIntegrationTests):
+    store_options = {"flush_mode": "chunked", "flush_chunk_size": 2}
+
+    def test_chunked_flush_drains_every_device(self):
+        now = datetime.now(timezone.utc)
+        for index in range(7):
+            self.store.update(f"device-{index}", "Sensor", self.region, 20, 50, False)
+
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 7)
+        self.assertEqual(self.store.outbox_size(self.region), 7)
+        self.assertEqual(list(self.client.scan_iter(f"{self.prefix}:aggregate:*")), [])
+        self.assertEqual(self.client.zcard(self.store._snapshots_key(self.region)), 0)
+
+    def test_readings_after_a_snapshot_belong_to_the_next_window(self):
+        now = datetime.now(timezone.utc)
+        self.store.update("device-1", "Sensor 1", self.region, 10, 40, False)
+        self.store.snapshot_window(
+            self.region, "window-1", self.store._flushed_marker_key(self.region, 1), 60, now
+        )
+        self.store.update("device-1", "Sensor 1", self.region, 30, 60, False)
+
+        self.assertEqual(self.store.drain_snapshots(self.region, now.timestamp()), 1)
+        raw_message, message = self.store.claim_outbox_message(
+            self.region, now.timestamp()
+        )
+        self.assertEqual(message["sample_count"], 1)
+        self.assertAlmostEqual(message["avg_temperature"], 10)
+        self.store.acknowledge_outbox_message(self.region, raw_message)
+
+        later = now + timedelta(seconds=300)
+        self.assertEqual(self.store.flush_window(self.region, 300, later), 1)
+        _, message = self.store.claim_outbox_message(self.region, later.timestamp())
+        self.assertAlmostEqual(message["avg_temperature"], 30)
+
+    def test_a_crashed_drain_is_finished_by_the_next_flush(self):
+        now = datetime.now(timezone.utc)
+        for index in range(3):
+            self.store.update(f"device-{index}", "Sensor", self.region, 20, 50, False)
+        marker_key = self.store._flushed_marker_key(self.region, 1)
+        self.assertEqual(
+            self.store.snapshot_window(self.region, "window-1", marker_key, 60, now), 3
+        )
+
+        replica_two = RedisAggregationStore(
+            self.client, prefix=self.prefix, **self.store_options
+        )
+        self.assertEqual(replica_two.flush_window(self.region, 300, now), 3)
+        self.assertEqual(self.store.outbox_size(self.region), 3)
+
+
+class QuantileSketchIntegrationTests(RedisAggregationStoreIntegrationTests):
+    store_options = {"quantile_buckets": 150}
+
+    def test_sketch_estimates_percentiles_and_is_emitted(self):
+        self.store.update_many(
+            Reading("device-1", "Sensor 1", self.region, temperature, 50, False)
+            for temperature in range(100)
+        )
+        self.store.merge_many(
+            [("device-1", "Sensor 1", self.region, [(None, 99, 50, False)])]
+        )
+
+        now = datetime.now(timezone.utc)
+        self.store.flush_window(self.region, 300, now)
+        _, message = self.store.claim_outbox_message(self.region, now.timestamp())
+
+        self.assertEqual(message["sample_count"], 101)
+        self.assertAlmostEqual(message["p50_temperature"], 50.5)
+        self.assertAlmostEqual(message["p95_temperature"], 95.5)
+        self.assertAlmostEqual(message["p99_temperature"], 99.5)
+        sketch = message["temperature_sketch"]
+        self.assertEqual((sketch["low"], sketch["width"]), (-50, 1))
+        self.assertEqual(sketch["counts"]["149"], 2)
+        self.assertEqual(sum(sketch["counts"].values()), 101)
+
+
+class StreamOutboxIntegrationTests(RedisAggregationStoreIntegrationTests):
+    store_options = {"outbox_backend": "stream", "outbox_consumer": "replica-1"}
+
+    def test_replicas_read_their_own_batches_and_take_over_stale_entries(self):
+        now = datetime.now(timezone.utc)
+        for index in range(5):
+            self.store.update(f"device-{index}", "Sensor", self.region, 20, 50, False)
+        self.assertEqual(self.store.flush_window(self.region, 300, now), 5)
+        replica_two = RedisAggregationStore(
+            self.client,
+            prefix=self.prefix,
+            outbox_visibility_timeout=2,
+            outbox_backend="stream",
+            outbox_consumer="replica-2",
+        )
+
+        first = self.store.claim_outbox_batch(self.region, 3)
+        second = replica_two.claim_outbox_batch(self.region, 3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse({raw for raw, _ in first} & {raw for raw, _ in second})
+        self.assertEqual(replica_two.acknowledge_outbox_batch(self.region, second), 2)
+        self.assertEqual(replica_two.outbox_size(self.region), 3)
+
+        taken_over = replica_two.claim_outbox_batch(self.region, 10, now.timestamp() + 3)
+        self.assertEqual(
+            sorted(raw for raw, _ in taken_over), sorted(raw for raw, _ in first)
+        )
+        self.assertEqual(self.store.acknowledge_outbox_batch(self.region, first), 3)
+        self.assertEqual(self.store.outbox_size(self.region), 0)
+
+    def test_retry_delay_longer_than_the_visibility_timeout_is_rejected(self):
+        now = datetime.now(timezone.utc)
+        self.store.update("device-1", "Sensor 1", self.region, 20, 50, False)
+        self.store.flush_window(self.region, 300, now)
+        claimed = self.store.claim_outbox_batch(self.region, 10)
+
+        with self.assertRaises(ValueError):
+            self.store.defer_outbox_batch(self.region, claimed, 5)
+        self.assertEqual(self.store.defer_outbox_batch(self.region, claimed, 2), 1)
+
+
+class EventTimeWindowIntegrationTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = _redis_test_client()
+
+    def setUp(self):
+        self.prefix = f"test:sensiot:{uuid.uuid4().hex}"
+        self.region = "eu868"
+        # Ten minutes ago, aligned to the one-minute windows used below
+        self.base = (int(time.time()) // 60 - 10) * 60
+
+    def tearDown(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def make_store(self, **options):
+        # Readings start ten minutes back, so neither the node's clock nor an
+        # idle timeout may close their windows unless a test asks for it
+        options.setdefault("max_clock_skew", 900)
+        options.setdefault("watermark_idle_timeout", 0)
+        return RedisAggregationStore(
+            self.client,
+            prefix=self.prefix,
+            window_time="event",
+            window_size=60,
+            **options,
+        )
+
+    def reading(self, store, device_id, offset, temperature=20, reading_id=None):
+        return store.update(
+            device_id, "Sensor", self.region, temperature, 50, False,
+            reading_id, self.base + offset,
+        )
+
+    def flush(self, store):
+        now = datetime.now(timezone.utc)
+        store.flush_window(self.region, 60, now)
+        messages = []
+        while True:
+            claimed = store.claim_outbox_message(self.region, now.timestamp())
+            if not claimed:
+                return messages
+            store.acknowledge_outbox_message(self.region, claimed[0])
+            messages.append(claimed[1])
+
+    def test_windows_follow_the_uplink_time_and_close_at_the_watermark(self):
+        store = self.make_store()
+        self.assertTrue(self.reading(store, "device-1", 5, 10))
+        self.assertTrue(self.reading(store, "device-1", 30, 30))
+        self.assertEqual(self.flush(store), [])
+
+        self.assertTrue(self.reading(store, "device-2", 125))
+        messages = self.flush(store)
+
+        self.assertEqual(len(messages), 1)
+        message = messages[0]
+        self.assertEqual(message["device_id"], "device-1")
+        self.assertEqual(message["sample_count"], 2)
+        self.assertAlmostEqual(message["avg_temperature"], 20)
+        self.assertEqual((message["window_start"], message["window_end"]), (self.base, self.base + 60))
+        self.assertEqual(message["timestamp"], self.base + 60)
+        self.assertEqual(message["revision"], 0)
+        self.assertEqual(
+            list(self.client.scan_iter(f"{self.prefix}:event-window:{self.region}:{self.base}:*")),
+            [],
+        )
+
+    def test_late_readings_amend_a_closed_window_within_the_allowed_lateness(self):
+        store = self.make_store(allowed_lateness=120)
+        self.reading(store, "device-1", 5, 10, "reading-1")
+        self.reading(store, "device-2", 125)
+        self.assertEqual(len(self.flush(store)), 1)
+
+        self.assertTrue(self.reading(store, "device-1", 50, 40, "reading-2"))
+        self.assertFalse(self.reading(store, "device-1", 50, 40, "reading-2"))
+        self.assertIsNone(self.reading(store, "device-1", -200))
+        messages = self.flush(store)
+
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["revision"], 1)
+        self.assertTrue(messages[0]["amended"])
+        self.assertEqual(messages[0]["sample_count"], 2)
+        self.assertAlmostEqual(messages[0]["avg_temperature"], 25)
+        self.assertEqual(messages[0]["aggregate_id"], f"{self.region}-{self.base}:device-1")
+
+    def test_readings_join_a_passed_window_until_it_is_flushed(self):
+        store = self.make_store()
+        self.assertTrue(self.reading(store, "device-1", 5))
+        # Another device moves the watermark past the window's end
+        self.assertTrue(self.reading(store, "device-2", 60.5))
+        self.assertTrue(self.reading(store, "device-3", 59.9))
+
+        messages = [message for message in self.flush(store) if message["window_start"] == self.base]
+        self.assertEqual(sorted(message["device_id"] for message in messages), ["device-1", "device-3"])
+        self.assertIsNone(self.reading(store, "device-3", 59.8))
+
+    def test_hopping_windows_count_a_reading_in_every_window_covering_it(self):
+        store = self.make_store(window_slide=30)
+        self.reading(store, "device-1", 45)
+        self.reading(store, "device-2", 200)
+
+        starts = sorted(
+            message["window_start"]
+            for message in self.flush(store)
+            if message["device_id"] == "device-1"
+        )
+        self.assertEqual(starts, [self.base, self.base + 30])
+
+    def test_event_readings_reach_the_priority_outbox_stamped_with_their_event_time(self):
+        store = self.make_store()
+        self.assertTrue(
+            store.update("device-1", "Sensor", self.region, 41, 50, True, "reading-1", self.base + 5)
+        )
+
+        claimed = store.claim_outbox_batch(self.region, 10, priority=True)
+        self.assertEqual([message["timestamp"] for _, message in claimed], [self.base + 5])
+
+    def test_an_idle_region_emits_its_last_window_after_the_idle_timeout(self):
+        store = self.make_store(watermark_idle_timeout=120)
+        started = time.time()
+        self.assertTrue(
+            store.update("device-1", "Sensor", self.region, 20, 50, False, None, started - 5)
+        )
+        now = datetime.now(timezone.utc)
+        self.assertEqual(store.flush_window(self.region, 60, now), 0)
+
+        later = now + timedelta(seconds=200)
+        self.assertEqual(store.flush_window(self.region, 60, later), 1)
+        _, message = store.claim_outbox_message(self.region, later.timestamp())
+        self.assertEqual(message["device_id"], "device-1")
+        self.assertLessEqual(message["window_start"], started - 5)
+
+    def test_a_regions_first_reading_is_judged_against_the_node_clock(self):
+        store = self.make_store(max_clock_skew=60)
+        self.assertIsNone(self.reading(store, "device-1", 5))
+        self.assertIsNone(self.client.get(store._event_key(self.region, "clock")))
+        self.assertTrue(
+            store.update("device-1", "Sensor", self.region, 20, 50, False, None, time.time())
+        )
+
+        idle_store = self.make_store(watermark_idle_timeout=60)
+        self.assertIsNone(
+            idle_store.update(
+                "device-2", "Sensor", "us915_0", 20, 50, False, None, self.base + 5
+            )
+        )
+        self.assertIsNone(self.client.get(idle_store._event_key("us915_0", "clock")))
+
+    def test_readings_far_ahead_of_the_node_clock_are_rejected(self):
+        store = self.make_store(max_clock_skew=60)
+        self.assertIsNone(self.reading(store, "device-1", 3600 * 24))
+        self.assertIsNone(self.client.get(store._event_key(self.region, "clock")))
+
+
+class RedisClusterIntegrationTests(RedisAggregationStoreIntegrationTests):
+    store_options = {"hash_tags": True, "flush_mode": "chunked"}
+
+    @classmethod
+    def setUpClass(cls):
+        nodes = os.getenv("REDIS_CLUSTER_TEST_NODES", "localhost:7000")
+        try:
+            cls.client = RedisCluster(
+                startup_nodes=[
+                    ClusterNode(*node.strip().rsplit(":", 1)) for node in nodes.split(",")
+                ],
+                decode_responses=True,
+                socket_connect_timeout=1,
+            )
+            cls.client.ping()
+        except (redis.RedisError, RedisClusterException) as exc:
+            raise unittest.SkipTest(f"Redis Cluster test nodes are unavailable: {exc}")
+
+    def setUp(self):
+        super().setUp()
+        self.store.load_scripts()
+
 
 if __name__ == "__main__":
     unittest.main()
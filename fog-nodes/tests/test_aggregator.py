@@ -0,0 +1,204 @@
+import threading
+import unittest
+
+import paho.mqtt.client as mqtt
+import redis
+
+import codec
+from aggregator import aggregation_worker, drain_outbox
+from envelope import decode_envelope
+
+
+class FakeOutboxStore:
+    def __init__(self, messages, priority_messages=None):
+        self.messages = list(messages)
+        self.priority_events = priority_messages is not None
+        self.priority_messages = list(priority_messages or ())
+        self.claims = []
+        self.acknowledged = []
+        self.priority_acknowledged = []
+        self.deferred = []
+
+    def claim_outbox_batch(self, region, n, priority=False):
+        if priority:
+            claimed, self.priority_messages = self.priority_messages[:n], self.priority_messages[n:]
+            return claimed
+        self.claims.append(n)
+        claimed, self.messages = self.messages[:n], self.messages[n:]
+        return claimed
+
+    def acknowledge_outbox_batch(self, region, items, priority=False):
+        (self.priority_acknowledged if priority else self.acknowledged).append(list(items))
+        return len(items)
+
+    def defer_outbox_batch(self, region, items, retry_delay, priority=False):
+        self.deferred.append((list(items), retry_delay))
+        return len(items)
+
+
+class FakePublishInfo:
+    def __init__(self, mid, published):
+        self.mid = mid
+        self.rc = mqtt.MQTT_ERR_SUCCESS
+        self._published = published
+
+    def is_published(self):
+        return self._published
+
+    def wait_for_publish(self, timeout):
+        pass
+
+
+class FakeMqttClient:
+    def __init__(self, unacknowledged=(), rejected=()):
+        self.unacknowledged = set(unacknowledged)
+        self.rejected = set(rejected)
+        self.published = []
+
+    def publish(self, topic, payload, qos):
+        if any(device_id.encode() in payload for device_id in self.rejected):
+            raise ValueError("Payload too large.")
+        self.published.append(payload)
+        mid = len(self.published)
+        return FakePublishInfo(mid, mid not in self.unacknowledged)
+
+
+def _message(index):
+    msg = {
+        "aggregate_id": f"eu868-1:device-{index}",
+        "device_id": f"device-{index}",
+        "region": "eu868",
+        "avg_temperature": 20.0,
+    }
+    return f"raw-{index}", msg
+
+
+class DrainOutboxTests(unittest.TestCase):
+    def test_outbox_is_drained_in_batches(self):
+        client = FakeMqttClient()
+        store = FakeOutboxStore([_message(index) for index in range(5)])
+
+        published = drain_outbox(client, store, "eu868", "central/data", outbox_batch_size=2)
+
+        self.assertEqual(published, 5)
+        self.assertEqual(len(client.published), 5)
+        self.assertEqual(
+            store.acknowledged, [["raw-0", "raw-1"], ["raw-2", "raw-3"], ["raw-4"]]
+        )
+        self.assertEqual(store.deferred, [])
+
+    def test_unacknowledged_publish_is_deferred_individually(self):
+        client = FakeMqttClient(unacknowledged={2})
+        store = FakeOutboxStore([_message(index) for index in range(3)])
+
+        published = drain_outbox(
+            client,
+            store,
+            "eu868",
+            "central/data",
+            outbox_batch_size=10,
+            publish_retry_delay=7,
+            publish_timeout=0.01,
+        )
+
+        self.assertEqual(published, 2)
+        self.assertEqual(sorted(store.acknowledged[0]), ["raw-0", "raw-2"])
+        self.assertEqual(store.deferred, [(["raw-1"], 7)])
+
+    def test_a_publish_error_defers_only_its_own_message(self):
+        client = FakeMqttClient(rejected={"device-1"})
+        store = FakeOutboxStore([_message(index) for index in range(3)])
+        messages = dict(store.messages)
+        messages["raw-2"]["avg_temperature"] = object()
+
+        published = drain_outbox(
+            client, store, "eu868", "central/data", outbox_batch_size=10, publish_retry_delay=7
+        )
+
+        self.assertEqual(published, 1)
+        self.assertEqual(store.acknowledged, [["raw-0"]])
+        self.assertEqual(store.deferred, [(["raw-1", "raw-2"], 7)])
+
+    def test_envelope_packs_many_aggregates_into_one_publish(self):
+        client = FakeMqttClient()
+        store = FakeOutboxStore([_message(index) for index in range(5)])
+
+        published = drain_outbox(
+            client,
+            store,
+            "eu868",
+            "central/data",
+            outbox_batch_size=10,
+            envelope_compression="zlib",
+            envelope_max_messages=3,
+        )
+
+        self.assertEqual(published, 5)
+        self.assertEqual(len(client.published), 2)
+        self.assertEqual(
+            [message["device_id"] for message in decode_envelope(client.published[0])],
+            ["device-0", "device-1", "device-2"],
+        )
+        self.assertEqual(
+            store.acknowledged, [["raw-0", "raw-1", "raw-2", "raw-3", "raw-4"]]
+        )
+
+    def test_priority_events_are_published_before_window_aggregates(self):
+        client = FakeMqttClient()
+        event = {
+            "kind": "event",
+            "aggregate_id": "event:reading-1",
+            "device_id": "device-9",
+            "region": "eu868",
+            "temperature": 41.0,
+            "queued_at": 0,
+        }
+        store = FakeOutboxStore(
+            [_message(index) for index in range(3)], priority_messages=[("raw-event", event)]
+        )
+
+        published = drain_outbox(client, store, "eu868", "central/data", outbox_batch_size=2)
+
+        self.assertEqual(published, 4)
+        self.assertEqual(codec.loads(client.published[0]), event)
+        self.assertEqual(store.priority_acknowledged, [["raw-event"]])
+        self.assertEqual(store.acknowledged, [["raw-0", "raw-1"], ["raw-2"]])
+
+
+class FlakyRedisStore(FakeOutboxStore):
+    """Fails its first flushes as during a Sentinel failover."""
+
+    def __init__(self, failures):
+        super().__init__([_message(0)])
+        self.failures = failures
+        self.flushed = threading.Event()
+
+    def flush_window(self, region, aggregation_interval):
+        if self.failures:
+            self.failures -= 1
+            raise redis.ConnectionError("Connection refused")
+        self.flushed.set()
+        return 0
+
+    def outbox_size(self, region, priority=False):
+        return len(self.messages)
+
+
+class AggregationWorkerTests(unittest.TestCase):
+    def test_redis_errors_are_retried_instead_of_stopping_the_worker(self):
+        store = FlakyRedisStore(failures=2)
+        worker = threading.Thread(
+            target=aggregation_worker,
+            args=(FakeMqttClient(), store, "eu868", 0.01, "central/data", 0.01),
+            kwargs={"outbox_wake_timeout": 0},
+            daemon=True,
+        )
+        worker.start()
+
+        self.assertTrue(store.flushed.wait(2))
+        self.assertTrue(worker.is_alive())
+        self.assertEqual(store.acknowledged, [["raw-0"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,255 @@
+import asyncio
+import os
+import unittest
+import time
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import redis
+import redis.asyncio as aioredis
+
+import codec
+from async_runtime import AsyncUpdateBatcher, drain_outbox, ingest
+from async_store import AsyncRedisAggregationStore
+
+
+class FakeAsyncStore:
+    priority_events = False
+
+    def __init__(self, error=None, messages=(), failing=()):
+        self.batches = []
+        self.error = error
+        self.failing = set(failing)
+        self.seen = set()
+        self.outbox = [(codec.dumps(msg).decode(), msg) for msg in messages]
+        self.acknowledged = []
+        self.deferred = []
+
+    async def update_many(self, readings, raise_on_error=True):
+        await asyncio.sleep(0)
+        if self.error:
+            raise self.error
+        self.batches.append(list(readings))
+        results = []
+        for reading in readings:
+            if reading.reading_id in self.failing:
+                results.append(ValueError(f"bad reading {reading.reading_id}"))
+                continue
+            results.append(reading.reading_id not in self.seen)
+            self.seen.add(reading.reading_id)
+        return results
+
+    async def claim_outbox_batch(self, region, n, priority=False):
+        claimed, self.outbox = self.outbox[:n], self.outbox[n:]
+        return claimed
+
+    async def acknowledge_outbox_batch(self, region, items, priority=False):
+        self.acknowledged.extend(items)
+
+    async def defer_outbox_batch(self, region, items, retry_delay, priority=False):
+        self.deferred.extend(items)
+
+
+class FakeAsyncMqttClient:
+    def __init__(self, fail_payloads=()):
+        self.published = []
+        self.fail_payloads = set(fail_payloads)
+        self.in_flight = 0
+        self.max_seen_in_flight = 0
+
+    async def publish(self, topic, payload, qos=0, timeout=None):
+        self.in_flight += 1
+        self.max_seen_in_flight = max(self.max_seen_in_flight, self.in_flight)
+        await asyncio.sleep(0.001)
+        self.in_flight -= 1
+        if codec.loads(payload)["aggregate_id"] in self.fail_payloads:
+            raise TimeoutError("no PUBACK")
+        self.published.append((topic, payload, qos))
+
+
+def _message(index):
+    return {
+        "aggregate_id": f"agg-{index}",
+        "region": "eu868",
+        "device_id": f"device-{index}",
+        "avg_temperature": 20.0,
+    }
+
+
+class AsyncUpdateBatcherTests(unittest.IsolatedAsyncioTestCase):
+    async def test_queued_updates_are_applied_in_capped_batches(self):
+        store = FakeAsyncStore()
+        batcher = AsyncUpdateBatcher(store, max_batch_size=2, max_delay=0)
+
+        futures = [
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index % 2}")
+            for index in range(3)
+        ]
+        await batcher.flush()
+
+        self.assertEqual([len(batch) for batch in store.batches], [2, 1])
+        self.assertEqual([future.result(0) for future in futures], [True, True, False])
+
+    async def test_redis_failure_is_reported_to_every_waiting_reading(self):
+        batcher = AsyncUpdateBatcher(FakeAsyncStore(error=ConnectionError("redis down")))
+
+        futures = [
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index}")
+            for index in range(3)
+        ]
+        await batcher.flush()
+
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                future.result(0)
+
+    async def test_a_failed_reading_does_not_fail_the_rest_of_its_batch(self):
+        batcher = AsyncUpdateBatcher(FakeAsyncStore(failing={"r-1"}))
+
+        futures = [
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index}")
+            for index in range(3)
+        ]
+        await batcher.flush()
+
+        self.assertTrue(futures[0].result(0))
+        with self.assertRaises(ValueError):
+            futures[1].result(0)
+        self.assertTrue(futures[2].result(0))
+
+    async def test_ingest_waits_for_room_once_max_pending_is_queued(self):
+        batcher = AsyncUpdateBatcher(FakeAsyncStore(), max_batch_size=2, max_pending=2)
+        batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-1")
+        batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-2")
+
+        waiter = asyncio.create_task(batcher.wait_for_room())
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+
+        worker = asyncio.create_task(batcher.run())
+        await asyncio.wait_for(waiter, 1)
+        worker.cancel()
+
+
+class AsyncIngestTests(unittest.IsolatedAsyncioTestCase):
+    async def test_paused_region_drops_messages_and_keeps_reading(self):
+        async def messages():
+            for index in range(3):
+                yield SimpleNamespace(topic="region/eu868/up", payload=b"{}")
+
+        mqtt_client = MagicMock()
+        mqtt_client.subscribe.return_value = asyncio.sleep(0)
+        mqtt_client.messages = messages()
+        backpressure = MagicMock()
+        backpressure.paused.return_value = True
+        userdata = {"region": "eu868", "fog_sub_topic": "region/eu868/#"}
+
+        with patch("mqtt_client.backpressure", backpressure), patch(
+            "async_runtime.handle_message"
+        ) as handle_message:
+            await asyncio.wait_for(ingest(mqtt_client, userdata, AsyncUpdateBatcher(None)), 1)
+
+        handle_message.assert_not_called()
+        self.assertEqual(backpressure.paused.call_count, 3)
+
+
+class AsyncDrainOutboxTests(unittest.IsolatedAsyncioTestCase):
+    async def test_publishes_overlap_and_failures_are_deferred(self):
+        store = FakeAsyncStore(messages=[_message(index) for index in range(6)])
+        mqtt_client = FakeAsyncMqttClient(fail_payloads={"agg-3"})
+
+        published = await drain_outbox(
+            mqtt_client, store, "eu868", "central/data", outbox_batch_size=10, max_in_flight=4
+        )
+
+        self.assertEqual(published, 5)
+        self.assertEqual(len(store.acknowledged), 5)
+        self.assertEqual([codec.loads(raw)["aggregate_id"] for raw in store.deferred], ["agg-3"])
+        self.assertEqual(mqtt_client.max_seen_in_flight, 4)
+        self.assertTrue(all(qos == 1 for _, _, qos in mqtt_client.published))
+
+
+class AsyncRedisAggregationStoreIntegrationTests(unittest.IsolatedAsyncioTestCase):
+    store_options = {}
+
+    async def asyncSetUp(self):
+        self.client = aioredis.Redis(
+            host=os.getenv("REDIS_TEST_HOST", "localhost"),
+            port=int(os.getenv("REDIS_TEST_PORT", "6379")),
+            decode_responses=True,
+            socket_connect_timeout=1,
+        )
+        try:
+            await self.client.ping()
+        except redis.RedisError as exc:
+            await self.client.aclose()
+            raise unittest.SkipTest(f"Redis test server is unavailable: {exc}")
+        self.prefix = f"test:sensiot:{uuid.uuid4().hex}"
+        self.store = AsyncRedisAggregationStore(
+            self.client,
+            prefix=self.prefix,
+            deduplication_ttl=60,
+            outbox_visibility_timeout=2,
+            **self.store_options,
+        )
+        self.region = "eu868"
+
+    async def asyncTearDown(self):
+        keys = [key async for key in self.client.scan_iter(f"{self.prefix}:*")]
+        if keys:
+            await self.client.delete(*keys)
+        await self.client.aclose()
+
+    async def test_pipelined_updates_flush_and_outbox_use_the_shared_scripts(self):
+        accepted = await self.store.update_many(
+            [
+                ("device-1", "Sensor 1", self.region, 10, 40, False, "reading-1"),
+                ("device-1", "Sensor 1", self.region, 99, 99, True, "reading-1"),
+                ("device-1", "Sensor 1", self.region, 30, 60, True, None),
+            ]
+        )
+        self.assertEqual(accepted, [True, False, True])
+
+        now = datetime.now(timezone.utc)
+        self.assertEqual(await self.store.flush_window(self.region, 300, now), 1)
+        self.assertEqual(await self.store.flush_window(self.region, 300, now), -1)
+        claimed = await self.store.claim_outbox_batch(self.region, 10, now.timestamp())
+
+        self.assertEqual(len(claimed), 1)
+        message = claimed[0][1]
+        self.assertEqual(message["sample_count"], 2)
+        self.assertAlmostEqual(message["avg_temperature"], 20)
+        self.assertTrue(message["event"])
+        self.assertEqual(await self.store.acknowledge_outbox_batch(self.region, claimed), 1)
+        self.assertEqual(await self.store.outbox_size(self.region), 0)
+
+    async def test_single_message_claim_defer_and_acknowledge_are_awaitable(self):
+        await self.store.update("device-1", "Sensor 1", self.region, 20, 50, False, "reading-1")
+        now = datetime.now(timezone.utc)
+        self.assertEqual(await self.store.flush_window(self.region, 300, now), 1)
+
+        raw_message, message = await self.store.claim_outbox_message(
+            self.region, now.timestamp()
+        )
+        self.assertEqual(message["device_id"], "device-1")
+        self.assertIsNone(await self.store.claim_outbox_message(self.region, now.timestamp()))
+        await self.store.defer_outbox_message(self.region, raw_message, 0)
+
+        claimed = await self.store.claim_outbox_message(self.region, time.time() + 1)
+        self.assertEqual(claimed[1]["device_id"], "device-1")
+        self.assertEqual(await self.store.acknowledge_outbox_message(self.region, claimed[0]), 1)
+        self.assertEqual(await self.store.outbox_size(self.region), 0)
+
+
+class AsyncChunkedFlushIntegrationTests(AsyncRedisAggregationStoreIntegrationTests):
+    store_options = {"flush_mode": "chunked", "flush_chunk_size": 1}
+
+
+class AsyncStreamOutboxIntegrationTests(AsyncRedisAggregationStoreIntegrationTests):
+    store_options = {"outbox_backend": "stream"}
+
+
+if __name__ == "__main__":
+    unittest.main()
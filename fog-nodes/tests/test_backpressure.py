@@ -0,0 +1,130 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import paho.mqtt.client as mqtt
+from prometheus_client import REGISTRY, CollectorRegistry, Gauge
+
+from aggregator import drain_outbox
+from backpressure import NORMAL, PAUSED, SHEDDING, BackpressureController
+from mqtt_client import on_connect, on_message
+from tests.test_aggregator import FakeMqttClient, FakeOutboxStore, _message
+
+TOPIC = "$share/fog-eu868/region/eu868/#"
+
+
+class FakeStore:
+    priority_events = True
+
+    def __init__(self, depth=0, priority_depth=0, memory=None):
+        self.depth = depth
+        self.priority_depth = priority_depth
+        self.memory = memory
+
+    def outbox_size(self, region, priority=False):
+        return self.priority_depth if priority else self.depth
+
+    def memory_usage(self):
+        return self.memory
+
+
+class SubscribingMqttClient(FakeMqttClient):
+    def __init__(self):
+        super().__init__()
+        self.subscriptions = []
+
+    def subscribe(self, topic, qos):
+        self.subscriptions.append(("subscribe", topic))
+        return mqtt.MQTT_ERR_SUCCESS, len(self.subscriptions)
+
+
+
+class DepthOutboxStore(FakeOutboxStore):
+    def outbox_size(self, region, priority=False):
+        return len(self.messages)
+
+    def memory_usage(self):
+        return None
+
+
+class BackpressureControllerTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.controller = BackpressureController(
+            Gauge("test_backpressure_state", "Test state", ["region"], registry=self.registry)
+        ).configure(outbox=(100, 200, 400), memory=(0.7, 0.8, 0.9))
+
+    def states(self, depths, region="eu868"):
+        return [self.controller.update(region, depth) for depth in depths]
+
+    def test_states_change_with_hysteresis(self):
+        self.assertEqual(
+            self.states([150, 200, 150, 101, 100, 150]),
+            [NORMAL, SHEDDING, SHEDDING, SHEDDING, NORMAL, NORMAL],
+        )
+        self.assertEqual(
+            self.states([400, 300, 199, 400, 50]),
+            [PAUSED, PAUSED, SHEDDING, PAUSED, NORMAL],
+        )
+        self.assertEqual(
+            self.registry.get_sample_value("test_backpressure_state", {"region": "eu868"}),
+            NORMAL,
+        )
+
+    def test_the_worst_signal_decides_and_unmeasured_signals_are_ignored(self):
+        self.assertEqual(self.controller.update("eu868", 10, 0.85), SHEDDING)
+        self.assertEqual(self.controller.update("eu868", 10, 0.75), SHEDDING)
+        self.assertEqual(self.controller.update("eu868", 10, None), NORMAL)
+        self.assertEqual(self.controller.update("eu868", None, 0.95), PAUSED)
+
+    def test_only_the_pressured_region_sheds(self):
+        self.controller.check(FakeStore(depth=150, priority_depth=60), ["EU868"])
+        self.controller.check(FakeStore(depth=10), ["us915_0"])
+
+        self.assertTrue(self.controller.shedding("eu868"))
+        self.assertFalse(self.controller.shedding("us915_0"))
+
+    def test_outbox_drains_while_a_region_is_paused(self):
+        client = SubscribingMqttClient()
+        store = DepthOutboxStore([_message(index) for index in range(450)])
+        ingest_queue = MagicMock()
+        userdata = {"region": "eu868", "fog_sub_topic": TOPIC, "ingest_queue": ingest_queue}
+        message = SimpleNamespace(topic="region/eu868/up", payload=b"{}")
+        shed = REGISTRY.get_sample_value("fog_backpressure_shed_readings_total", {"region": "eu868"}) or 0
+
+        self.controller.check(store, ["eu868"])
+        self.assertTrue(self.controller.paused("eu868"))
+        with patch("mqtt_client.backpressure", self.controller):
+            # Every replica pauses together, so the shared subscription is kept
+            on_connect(client, userdata, None, 0)
+            # Dropped on receipt; paho's network thread is never held
+            on_message(client, userdata, message)
+            ingest_queue.put.assert_not_called()
+
+            # The same client still publishes the outbox to central
+            self.assertEqual(drain_outbox(client, store, "eu868", "central/data"), 450)
+            self.controller.check(store, ["eu868"])
+            on_message(client, userdata, message)
+
+        self.assertEqual(self.controller.state("eu868"), NORMAL)
+        self.assertEqual(client.subscriptions, [("subscribe", TOPIC)])
+        ingest_queue.put.assert_called_once()
+        self.assertEqual(
+            REGISTRY.get_sample_value("fog_backpressure_shed_readings_total", {"region": "eu868"}),
+            shed + 1,
+        )
+
+    def test_disabled_signals_never_throttle(self):
+        controller = self.controller.configure()
+        self.assertFalse(controller.enabled)
+        self.assertEqual(controller.update("eu868", 10**9, 1.0), NORMAL)
+
+    def test_watermarks_must_be_ordered(self):
+        with self.assertRaises(ValueError):
+            self.controller.configure(outbox=(300, 200, 400))
+        with self.assertRaises(ValueError):
+            self.controller.configure(memory=(0.7, 0.9, 0.8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import threading
+import unittest
+
+from batcher import UpdateBatcher
+
+
+class FakeAggregationStore:
+    def __init__(self, error=None, failing=()):
+        self.batches = []
+        self.error = error
+        self.failing = set(failing)
+        self.seen = set()
+
+    def update_many(self, readings, raise_on_error=True):
+        if self.error:
+            raise self.error
+        self.batches.append(list(readings))
+        results = []
+        for reading in readings:
+            if reading.reading_id in self.failing:
+                results.append(ValueError(f"bad reading {reading.reading_id}"))
+                continue
+            accepted = reading.reading_id not in self.seen
+            self.seen.add(reading.reading_id)
+            results.append(accepted)
+        return results
+
+
+class UpdateBatcherTests(unittest.TestCase):
+    def test_queued_updates_are_applied_in_one_batch(self):
+        store = FakeAggregationStore()
+        batcher = UpdateBatcher(store, max_batch_size=10, max_delay=0)
+
+        futures = [
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, "reading-1"),
+            batcher.update("device-2", "Sensor 2", "eu868", 21, 51, True, "reading-2"),
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, "reading-1"),
+        ]
+        batcher.flush()
+
+        self.assertEqual(len(store.batches), 1)
+        self.assertEqual(store.batches[0][1].event_detected, True)
+        self.assertEqual([future.result(0) for future in futures], [True, True, False])
+
+    def test_batches_are_capped_at_the_configured_size(self):
+        store = FakeAggregationStore()
+        batcher = UpdateBatcher(store, max_batch_size=2, max_delay=0)
+
+        for index in range(5):
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index}")
+        batcher.flush()
+
+        self.assertEqual([len(batch) for batch in store.batches], [2, 2, 1])
+
+    def test_redis_failure_is_reported_to_every_waiting_reading(self):
+        batcher = UpdateBatcher(
+            FakeAggregationStore(error=ConnectionError("redis down")),
+            max_batch_size=10,
+            max_delay=0,
+        )
+
+        futures = [
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index}")
+            for index in range(3)
+        ]
+        batcher.flush()
+
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                future.result(0)
+
+    def test_a_failed_reading_does_not_fail_the_rest_of_its_batch(self):
+        batcher = UpdateBatcher(
+            FakeAggregationStore(failing={"r-1"}), max_batch_size=10, max_delay=0
+        )
+
+        futures = [
+            batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index}")
+            for index in range(3)
+        ]
+        batcher.flush()
+
+        self.assertTrue(futures[0].result(0))
+        with self.assertRaises(ValueError):
+            futures[1].result(0)
+        self.assertTrue(futures[2].result(0))
+
+    def test_worker_thread_applies_updates_in_the_background(self):
+        store = FakeAggregationStore()
+        batcher = UpdateBatcher(store, max_batch_size=10, max_delay=0.001).start()
+
+        done = threading.Event()
+        future = batcher.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-1")
+        future.add_done_callback(lambda _: done.set())
+
+        self.assertTrue(done.wait(2))
+        self.assertTrue(future.result(0))
+
+
+if __name__ == "__main__":
+    unittest.main()
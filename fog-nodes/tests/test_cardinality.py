@@ -0,0 +1,75 @@
+import unittest
+from unittest import mock
+
+from prometheus_client import CollectorRegistry, Counter
+
+from cardinality import DROP_WEIGHT, OTHER_DEVICES, DeviceLabeler, SpaceSavingSketch
+
+
+class SpaceSavingSketchTests(unittest.TestCase):
+    def test_heavy_hitters_survive_a_long_tail(self):
+        sketch = SpaceSavingSketch(20)
+        for index in range(5000):
+            sketch.add(f"tail-{index}")
+            if index % 10 == 0:
+                sketch.add("heavy-1", 3)
+                sketch.add("heavy-2", 2)
+
+        self.assertLessEqual(len(sketch), 20)
+        self.assertEqual(sketch.top(2), ["heavy-1", "heavy-2"])
+
+    def test_decay_lets_new_heavy_hitters_overtake(self):
+        sketch = SpaceSavingSketch(10)
+        sketch.add("old", 100)
+        sketch.decay(0.01)
+        sketch.add("new", 5)
+        self.assertEqual(sketch.top(1), ["new"])
+
+
+class DeviceLabelerTests(unittest.TestCase):
+    def setUp(self):
+        self.counter = Counter(
+            "test_messages", "Test messages", ["region", "device_id"],
+            registry=CollectorRegistry(),
+        )
+        self.clock = mock.patch("cardinality.time.monotonic", return_value=0)
+        self.monotonic = self.clock.start()
+        self.addCleanup(self.clock.stop)
+
+    def series(self):
+        return {
+            sample.labels["device_id"]
+            for sample in self.counter.collect()[0].samples
+            if sample.name.endswith("_total")
+        }
+
+    def count(self, labeler, device_id, weight=1):
+        self.counter.labels(
+            region="eu868", device_id=labeler.label("eu868", device_id, weight)
+        ).inc()
+
+    def test_device_and_region_modes(self):
+        self.assertEqual(DeviceLabeler(mode="device").label("eu868", "dev-1"), "dev-1")
+        self.assertEqual(DeviceLabeler(mode="region").label("eu868", "dev-1"), OTHER_DEVICES)
+        with self.assertRaises(ValueError):
+            DeviceLabeler(mode="everything")
+
+    def test_topk_bounds_series_and_evicts_quiet_devices(self):
+        labeler = DeviceLabeler([self.counter], mode="topk", top_k=2, refresh_interval=10)
+        for index in range(100):
+            self.count(labeler, f"dev-{index}")
+        for _ in range(20):
+            self.count(labeler, "busy")
+        self.count(labeler, "failing", DROP_WEIGHT)
+        self.assertEqual(self.series(), {"dev-0", "dev-1", OTHER_DEVICES})
+
+        self.monotonic.return_value = 10
+        self.count(labeler, "busy")
+        self.assertEqual(labeler.tracked("eu868"), {"busy", "failing"})
+        self.assertEqual(self.series(), {"busy", OTHER_DEVICES})
+        self.count(labeler, "failing")
+        self.assertEqual(self.series(), {"busy", "failing", OTHER_DEVICES})
+
+
+if __name__ == "__main__":
+    unittest.main()
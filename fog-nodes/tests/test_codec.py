@@ -0,0 +1,43 @@
+import json
+import unittest
+from unittest import mock
+
+import codec
+
+UPLINK = {
+    "deviceInfo": {"devEui": "0101010101010142", "deviceName": "Sensor 42"},
+    "object": {"temperature": 23.4, "humidity": 51.2},
+    "regionConfigId": "eu868",
+    "rxInfo": [{"nsTime": "2026-10-18T13:08:31.215408+00:00"}],
+}
+
+
+class CodecTests(unittest.TestCase):
+    def assert_round_trip(self):
+        raw = json.dumps(UPLINK).encode("utf-8")
+        for payload in (raw, bytearray(raw), memoryview(raw), raw.decode("utf-8")):
+            with self.subTest(type=type(payload).__name__):
+                self.assertEqual(codec.loads(payload), UPLINK)
+        encoded = codec.dumps(UPLINK)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual(json.loads(encoded), UPLINK)
+
+    def test_active_backend_decodes_payload_buffers(self):
+        self.assert_round_trip()
+
+    def test_standard_library_fallback(self):
+        with mock.patch.object(codec, "orjson", None):
+            self.assertEqual(codec.backend(), "json")
+            self.assert_round_trip()
+            self.assertEqual(codec.dumps({"a": 1}), b'{"a":1}')
+
+    def test_invalid_json_raises_json_decode_error(self):
+        with self.assertRaises(codec.JSONDecodeError):
+            codec.loads(b"{not json")
+        with mock.patch.object(codec, "orjson", None):
+            with self.assertRaises(codec.JSONDecodeError):
+                codec.loads(b"{not json")
+
+
+if __name__ == "__main__":
+    unittest.main()
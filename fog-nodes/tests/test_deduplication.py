@@ -0,0 +1,55 @@
+import unittest
+
+from aggregation_store import BloomDeduplication, KeyDeduplication, RedisAggregationStore
+
+
+class FakeRedis:
+    def register_script(self, script):
+        return script
+
+
+class DeduplicationBackendTests(unittest.TestCase):
+    def test_key_backend_uses_one_key_per_reading(self):
+        backend = KeyDeduplication("sensiot:fog", 60)
+
+        self.assertEqual(backend.shared_keys(), [])
+        self.assertEqual(len(backend.reading_keys("reading-1")), 1)
+        self.assertTrue(backend.reading_keys("reading-1")[0].startswith("sensiot:fog:dedupe:"))
+        self.assertEqual(backend.reading_args("reading-1"), [60])
+
+    def test_bloom_backend_checks_every_live_bucket(self):
+        backend = BloomDeduplication(
+            "sensiot:fog", 86400, capacity=1000, error_rate=0.01, bucket_seconds=3600
+        )
+
+        keys = backend.shared_keys(now=7200)
+        self.assertEqual(backend.bucket_count, 25)
+        self.assertEqual(keys[0], "sensiot:fog:dedupe-bloom:2")
+        self.assertEqual(keys[1], "sensiot:fog:dedupe-bloom:1")
+        self.assertEqual(len(keys), 25)
+        self.assertEqual(backend.expire, 86400 + 3600)
+
+    def test_bloom_offsets_are_stable_and_within_the_bitmap(self):
+        backend = BloomDeduplication("sensiot:fog", 3600, capacity=1000, error_rate=0.001)
+
+        args = backend.reading_args("reading-1")
+        self.assertEqual(args, backend.reading_args("reading-1"))
+        self.assertNotEqual(args, backend.reading_args("reading-2"))
+        self.assertEqual(len(args), backend.hashes + 1)
+        self.assertTrue(all(0 <= offset < backend.bits for offset in args[1:]))
+        self.assertEqual(len(backend.reading_args(None)), len(args))
+
+    def test_bloom_memory_is_bounded_by_capacity(self):
+        backend = BloomDeduplication(
+            "sensiot:fog", 86400, capacity=1000000, error_rate=0.001
+        )
+
+        self.assertLess(backend.memory_bytes(), 100 * 1024 * 1024)
+
+    def test_store_rejects_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            RedisAggregationStore(FakeRedis(), deduplication_backend="cuckoo")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import json
+import unittest
+
+from envelope import decode_envelope, encode_envelope, is_envelope, validate_compression
+
+
+AGGREGATES = [
+    {"aggregate_id": f"eu868-1:device-{index}", "avg_temperature": 20.5 + index}
+    for index in range(50)
+]
+
+
+class EnvelopeTests(unittest.TestCase):
+    def test_round_trip_for_each_compression(self):
+        for compression in ("none", "zlib"):
+            with self.subTest(compression=compression):
+                payload = encode_envelope(AGGREGATES, compression)
+                self.assertTrue(is_envelope(payload))
+                self.assertEqual(decode_envelope(payload), AGGREGATES)
+
+    def test_compressed_envelope_is_smaller_than_separate_messages(self):
+        separate = sum(len(json.dumps(aggregate)) for aggregate in AGGREGATES)
+
+        self.assertLess(len(encode_envelope(AGGREGATES, "zlib")), separate / 2)
+
+    def test_plain_json_aggregate_is_not_an_envelope(self):
+        self.assertFalse(is_envelope(json.dumps(AGGREGATES[0]).encode("utf-8")))
+
+    def test_unknown_version_is_rejected(self):
+        payload = bytearray(encode_envelope(AGGREGATES, "none"))
+        payload[4] = 99
+
+        with self.assertRaises(ValueError):
+            decode_envelope(bytes(payload))
+
+    def test_unknown_compression_is_rejected(self):
+        with self.assertRaises(ValueError):
+            validate_compression("brotli")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from prometheus_client import REGISTRY
+
+from ingest import IngestQueue
+from mqtt_client import on_message
+
+
+class IngestQueueTests(unittest.TestCase):
+    def test_workers_handle_queued_messages(self):
+        handled = []
+        ingest_queue = IngestQueue(
+            lambda *item: handled.append(item), "eu868", maxsize=10, workers=2
+        ).start()
+
+        for index in range(5):
+            self.assertTrue(ingest_queue.put("topic", index))
+        ingest_queue.join()
+
+        self.assertEqual(sorted(index for _, index in handled), [0, 1, 2, 3, 4])
+
+    def test_default_shed_policy_rejects_messages_when_full(self):
+        release = threading.Event()
+        ingest_queue = IngestQueue(
+            lambda *item: release.wait(2), "eu868-shed", maxsize=1, workers=1
+        )
+
+        self.assertTrue(ingest_queue.put("first"))
+        self.assertFalse(ingest_queue.put("second"))
+        self.assertEqual(
+            REGISTRY.get_sample_value("buffer_queue_length", {"region": "eu868-shed"}),
+            1,
+        )
+        release.set()
+
+    def test_block_policy_holds_the_caller_until_a_slot_frees(self):
+        ingest_queue = IngestQueue(
+            lambda *item: None, "eu868-block", maxsize=1, overflow_policy="block"
+        )
+        self.assertTrue(ingest_queue.put("first"))
+
+        put = threading.Thread(target=ingest_queue.put, args=("second",), daemon=True)
+        put.start()
+        put.join(0.05)
+        self.assertTrue(put.is_alive())
+
+        ingest_queue.start()
+        put.join(2)
+        self.assertFalse(put.is_alive())
+        ingest_queue.join()
+
+    def test_unknown_overflow_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            IngestQueue(lambda: None, "eu868", overflow_policy="spill-to-nowhere")
+
+
+class OnMessageTests(unittest.TestCase):
+    def test_message_is_queued_instead_of_processed_inline(self):
+        ingest_queue = MagicMock()
+        ingest_queue.put.return_value = True
+        userdata = {"region": "eu868", "ingest_queue": ingest_queue}
+        message = SimpleNamespace(topic="region/eu868/up", payload=b"{}")
+
+        with patch("mqtt_client.handle_message") as handle_message:
+            on_message(None, userdata, message)
+
+        handle_message.assert_not_called()
+        args = ingest_queue.put.call_args.args
+        self.assertEqual(args[:3], (userdata, "region/eu868/up", b"{}"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import logging
+import queue
+import sys
+import unittest
+from unittest import mock
+
+from logsampling import DroppingQueueHandler, MessageLog, parse_sample_rates
+
+
+class MessageLogTests(unittest.TestCase):
+    def test_sampling_keeps_one_in_n_and_zero_disables(self):
+        log = MessageLog({"received": 10, "uplink": 0})
+
+        self.assertEqual(sum(log.sample("received") for _ in range(100)), 10)
+        self.assertFalse(any(log.sample("uplink") for _ in range(100)))
+        self.assertTrue(all(log.sample("event") for _ in range(100)))
+
+    def test_rate_limit_caps_lines_per_second(self):
+        with mock.patch("logsampling.time.monotonic", return_value=100):
+            log = MessageLog(max_per_second=5)
+            self.assertEqual(sum(log.sample("drop") for _ in range(50)), 5)
+        with mock.patch("logsampling.time.monotonic", return_value=101):
+            self.assertEqual(sum(log.sample("drop") for _ in range(50)), 5)
+
+    def test_summaries_report_counts_and_latency_percentiles_then_reset(self):
+        log = MessageLog(summary_interval=10, max_latency_samples=50)
+        for index in range(100):
+            log.record_uplink("eu868", index / 100)
+        log.record_uplink("eu868")
+        log.record_event("eu868")
+        log.record_duplicate("eu868")
+        log.record_drop("us915")
+
+        eu868, us915 = log.summaries()
+        self.assertIn("[eu868] 101 uplinks, 1 events, 1 duplicates, 0 dropped", eu868)
+        self.assertIn("p50=", eu868)
+        self.assertIn("in last 10s", eu868)
+        self.assertIn("[us915] 0 uplinks, 0 events, 0 duplicates, 1 dropped", us915)
+        self.assertEqual(log.summaries(), [])
+
+    def test_unknown_category_is_rejected(self):
+        self.assertEqual(parse_sample_rates("received=100, latency=0"), {"received": 100, "latency": 0})
+        with self.assertRaises(ValueError):
+            parse_sample_rates("everything=1")
+
+
+class DroppingQueueHandlerTests(unittest.TestCase):
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = DroppingQueueHandler(queue.Queue(maxsize=1))
+        record = logging.makeLogRecord({"msg": "uplink"})
+
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 1)
+
+    def test_records_are_queued_unformatted(self):
+        handler = DroppingQueueHandler(queue.Queue())
+        handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+        try:
+            raise ValueError("bad uplink")
+        except ValueError:
+            record = logging.makeLogRecord(
+                {"msg": "uplink %d", "args": (7,), "levelname": "ERROR", "exc_info": sys.exc_info()}
+            )
+
+        handler.handle(record)
+        queued = handler.queue.get_nowait()
+
+        self.assertEqual((queued.msg, queued.args), ("uplink 7", None))
+        self.assertIsNotNone(queued.exc_info)
+        self.assertEqual(record.args, (7,))
+        formatted = logging.Formatter("[%(levelname)s] %(message)s").format(queued)
+        self.assertTrue(formatted.startswith("[ERROR] uplink 7\nTraceback"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import threading
+import time
+import unittest
+from collections import Counter
+from functools import partial
+from unittest.mock import MagicMock, patch
+
+from batcher import UpdateBatcher
+from ingest import IngestQueue
+from tests.test_aggregator import FakeOutboxStore
+from utils import wait_for_stopped_thread
+
+# main configures logging when imported; keep the test runner's handlers
+with patch("logsampling.setup_logging"):
+    import main
+
+
+class RegionFlushStore(FakeOutboxStore):
+    """Records the windows each region's worker flushes."""
+
+    def __init__(self):
+        super().__init__([])
+        self.flushes = Counter()
+
+    def flush_window(self, region, aggregation_interval):
+        self.flushes[region] += 1
+        return 0
+
+    def outbox_size(self, region, priority=False):
+        return 0
+
+
+class StartRegionTests(unittest.TestCase):
+    def test_each_region_gets_its_own_ingest_queue_batcher_and_worker(self):
+        store = RegionFlushStore()
+        setup_mqtt_client = MagicMock(side_effect=lambda *args: MagicMock())
+        with patch.multiple(
+            main,
+            setup_mqtt_client=setup_mqtt_client,
+            FOG_SHARED_GROUP="fog-{region}",
+            FOG_SUB_TOPIC="$share/{shared_group}/region/{region}/#",
+            PREAGGREGATION_INTERVAL=0,
+            UPDATE_BATCH_SIZE=10,
+            INGEST_QUEUE_SIZE=10,
+            FLUSH_INTERVAL=0.01,
+            OUTBOX_POLL_INTERVAL=0.01,
+            OUTBOX_WAKE_TIMEOUT=0,
+        ):
+            threads = [
+                thread
+                for region in ("eu868", "us915_0")
+                for thread in main.start_region(region, store, "replica-1", None)
+            ]
+
+        self.assertEqual(
+            [thread.name for thread in threads],
+            [
+                "mqtt-loop-eu868",
+                "aggregation-worker-eu868",
+                "mqtt-loop-us915_0",
+                "aggregation-worker-us915_0",
+            ],
+        )
+        calls = [call.args for call in setup_mqtt_client.call_args_list]
+        self.assertEqual([args[1] for args in calls], ["eu868", "us915_0"])
+        self.assertEqual([args[2] for args in calls], [
+            "$share/fog-eu868/region/eu868/#",
+            "$share/fog-us915_0/region/us915_0/#",
+        ])
+        sinks = [args[3] for args in calls]
+        queues = [args[4] for args in calls]
+        self.assertTrue(all(isinstance(sink, UpdateBatcher) for sink in sinks))
+        self.assertIsNot(sinks[0], sinks[1])
+        self.assertTrue(all(isinstance(ingest_queue, IngestQueue) for ingest_queue in queues))
+        self.assertEqual([ingest_queue.region for ingest_queue in queues], ["eu868", "us915_0"])
+
+        # Each worker flushes its own region's windows on its own schedule
+        for _ in range(200):
+            if store.flushes["eu868"] > 1 and store.flushes["us915_0"] > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(set(store.flushes), {"eu868", "us915_0"})
+        self.assertGreater(min(store.flushes.values()), 1)
+
+
+class MainTests(unittest.TestCase):
+    def test_process_exits_when_a_region_thread_stops(self):
+        running = threading.Event()
+        stopped = threading.Thread(target=lambda: None, name="mqtt-loop-us915_0", daemon=True)
+        alive = threading.Thread(target=running.wait, name="aggregation-worker-eu868", daemon=True)
+        stopped.start()
+        alive.start()
+        self.addCleanup(running.set)
+        start_region = MagicMock(side_effect=[[alive], [stopped]])
+
+        with patch.multiple(
+            main,
+            FOG_REGIONS=["eu868", "us915_0"],
+            RUNTIME="threads",
+            REDIS_CLUSTER_NODES=[],
+            REDIS_SENTINELS=[],
+            RedisAggregationStore=MagicMock(),
+            start_region=start_region,
+            start_http_server=MagicMock(),
+            device_labels=MagicMock(),
+            message_log=MagicMock(),
+            event_rules=MagicMock(),
+            stage_timers=MagicMock(),
+            backpressure=MagicMock(),
+            spill_log=MagicMock(),
+            wait_for_stopped_thread=partial(wait_for_stopped_thread, poll_interval=0.01),
+        ), self.assertLogs("main", "CRITICAL") as logs:
+            with self.assertRaises(SystemExit) as raised:
+                main.main()
+
+        self.assertEqual(raised.exception.code, 1)
+        self.assertEqual([call.args[0] for call in start_region.call_args_list], ["eu868", "us915_0"])
+        self.assertIn("mqtt-loop-us915_0", logs.output[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+from preaggregation import PreAggregator
+
+
+class FakeAggregationStore:
+    def __init__(self, error=None, priority_events=False):
+        self.merges = []
+        self.updates = []
+        self.error = error
+        self.seen = set()
+        self.priority_events = priority_events
+
+    def update(self, *reading):
+        self.updates.append(reading)
+        return True
+
+    def merge_many(self, partials):
+        if self.error:
+            raise self.error
+        partials = list(partials)
+        self.merges.append(partials)
+        results = []
+        for _, _, _, readings in partials:
+            flags = []
+            for reading_id, _, _, _ in readings:
+                flags.append(reading_id not in self.seen)
+                self.seen.add(reading_id)
+            results.append(flags)
+        return results
+
+
+class PreAggregatorTests(unittest.TestCase):
+    def test_readings_are_merged_with_one_call_per_device(self):
+        store = FakeAggregationStore()
+        pre_aggregator = PreAggregator(store, merge_interval=60)
+
+        futures = [
+            pre_aggregator.update("device-1", "Sensor 1", "eu868", 20, 50, False, f"r-{index}")
+            for index in range(30)
+        ]
+        futures.append(
+            pre_aggregator.update("device-2", "Sensor 2", "eu868", 36, 50, True, "r-x")
+        )
+        futures.append(
+            pre_aggregator.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-0")
+        )
+
+        self.assertEqual(pre_aggregator.flush(), 31)
+        self.assertEqual(len(store.merges), 1)
+        self.assertEqual(len(store.merges[0]), 2)
+        device_1 = store.merges[0][0]
+        self.assertEqual(device_1[:3], ("device-1", "Sensor 1", "eu868"))
+        self.assertEqual(len(device_1[3]), 31)
+        self.assertFalse(futures[-1].result(0))
+        self.assertTrue(all(future.result(0) for future in futures[:-1]))
+        self.assertEqual(pre_aggregator.pending(), 0)
+
+    def test_event_readings_skip_the_merge_with_a_priority_outbox(self):
+        store = FakeAggregationStore(priority_events=True)
+        pre_aggregator = PreAggregator(store, merge_interval=60)
+
+        self.assertTrue(
+            pre_aggregator.update("device-1", "Sensor 1", "eu868", 36, 50, True, "r-1")
+        )
+        pre_aggregator.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-2")
+
+        self.assertEqual(store.updates, [("device-1", "Sensor 1", "eu868", 36, 50, True, "r-1")])
+        self.assertEqual(pre_aggregator.pending(), 1)
+
+    def test_reaching_max_pending_requests_an_early_merge(self):
+        pre_aggregator = PreAggregator(FakeAggregationStore(), merge_interval=60, max_pending=2)
+
+        pre_aggregator.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-1")
+        self.assertFalse(pre_aggregator._merge_requested.is_set())
+        pre_aggregator.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-2")
+        self.assertTrue(pre_aggregator._merge_requested.is_set())
+
+    def test_merge_failure_is_reported_to_every_held_reading(self):
+        pre_aggregator = PreAggregator(
+            FakeAggregationStore(error=ConnectionError("redis down")), merge_interval=60
+        )
+        future = pre_aggregator.update("device-1", "Sensor 1", "eu868", 20, 50, False, "r-1")
+
+        self.assertEqual(pre_aggregator.flush(), 0)
+        with self.assertRaises(ConnectionError):
+            future.result(0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,13 +1,17 @@
+import itertools
+import time
 import unittest
+from unittest.mock import patch
 
 import paho.mqtt.client as mqtt
 
-from publisher import publish_to_central
+from publisher import PublishWindow, publish_to_central
 
 
 class FakePublishInfo:
-    def __init__(self, published=True, rc=mqtt.MQTT_ERR_SUCCESS):
+    def __init__(self, published=True, rc=mqtt.MQTT_ERR_SUCCESS, mid=1):
         self.rc = rc
+        self.mid = mid
         self._published = published
         self.timeout = None
 
@@ -18,6 +22,29 @@ class FakePublishInfo:
         return self._published
 
 
+class WindowedMqttClient:
+    """Acknowledges publishes only when the test says so."""
+
+    def __init__(self, never_ack=()):
+        self.never_ack = set(never_ack)
+        self.infos = []
+        self._mids = itertools.count(1)
+
+    def publish(self, topic, payload, qos):
+        info = FakePublishInfo(published=False, mid=next(self._mids))
+        info.payload = payload
+        self.infos.append(info)
+        return info
+
+    def ack_all(self):
+        for info in self.infos:
+            if info.mid not in self.never_ack:
+                info._published = True
+
+    def in_flight(self):
+        return sum(not info._published for info in self.infos)
+
+
 class FakeMqttClient:
     def __init__(self, result):
         self.result = result
@@ -45,5 +72,53 @@ class PublisherTests(unittest.TestCase):
             publish_to_central(client, {"aggregate_id": "a-1"}, publish_timeout=1)
 
 
+class PublishWindowTests(unittest.TestCase):
+    def test_many_publishes_are_in_flight_at_once(self):
+        client = WindowedMqttClient()
+        window = PublishWindow(client, max_in_flight=5, publish_timeout=10)
+
+        completed = []
+        for index in range(5):
+            completed.extend(window.publish(f"raw-{index}", {"aggregate_id": index}))
+
+        self.assertEqual(completed, [])
+        self.assertEqual(window.in_flight(), 5)
+        client.ack_all()
+        self.assertEqual(
+            window.drain(), [(f"raw-{index}", None) for index in range(5)]
+        )
+        self.assertEqual(window.in_flight(), 0)
+
+    def test_full_window_waits_for_the_oldest_publish(self):
+        client = WindowedMqttClient()
+        window = PublishWindow(client, max_in_flight=2, publish_timeout=10)
+        window.publish("raw-0", {})
+        window.publish("raw-1", {})
+        client.infos[0].wait_for_publish = lambda timeout: setattr(
+            client.infos[0], "_published", True
+        )
+
+        completed = window.publish("raw-2", {})
+
+        self.assertEqual(completed, [("raw-0", None)])
+        self.assertEqual(window.in_flight(), 2)
+
+    def test_unacknowledged_publish_times_out_individually(self):
+        client = WindowedMqttClient(never_ack={2})
+        window = PublishWindow(client, max_in_flight=5, publish_timeout=5)
+        for index in range(3):
+            window.publish(f"raw-{index}", {})
+        client.ack_all()
+
+        later = time.monotonic() + 6
+        with patch("publisher.time.monotonic", return_value=later):
+            results = dict(window.drain())
+
+        self.assertEqual(len(results), 3)
+        self.assertIsNone(results["raw-0"])
+        self.assertIsInstance(results["raw-1"], TimeoutError)
+        self.assertIsNone(results["raw-2"])
+
+
 if __name__ == "__main__":
     unittest.main()
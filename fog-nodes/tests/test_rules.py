@@ -0,0 +1,103 @@
+import json
+import os
+import tempfile
+import unittest
+
+from rules import RuleEngine, compile_rules
+from uplink import UplinkRecord
+
+
+def _record(temperature, humidity=50, device_id="device-1", region="eu868", device_class=None):
+    return UplinkRecord(
+        device_id, "Sensor", region, region, None, {}, temperature, humidity,
+        device_class=device_class,
+    )
+
+
+class RuleEngineTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "rules.json")
+
+    def write_rules(self, rules, mtime):
+        with open(self.path, "w") as rules_file:
+            json.dump(rules, rules_file)
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def evaluate(self, engine, *args, timestamp=0, **kwargs):
+        record = _record(*args, **kwargs)
+        return engine.evaluate(record, record.region, timestamp)
+
+    def test_default_rules_keep_the_previous_thresholds(self):
+        engine = RuleEngine()
+        self.assertEqual(self.evaluate(engine, 35, 80), [])
+        self.assertEqual(self.evaluate(engine, 35.5, 90), ["high-temperature", "high-humidity"])
+
+    def test_rules_apply_only_to_their_regions_and_device_classes(self):
+        self.write_rules(
+            [{"name": "cold", "metric": "temperature", "below": 0,
+              "regions": ["EU868"], "device_classes": ["Freezer"]}],
+            1,
+        )
+        engine = RuleEngine(self.path)
+
+        self.assertEqual(self.evaluate(engine, -5, device_class="freezer"), ["cold"])
+        self.assertEqual(self.evaluate(engine, -5, device_class="greenhouse"), [])
+        self.assertEqual(self.evaluate(engine, -5, region="us915", device_class="freezer"), [])
+
+    def test_rate_rules_compare_consecutive_readings_of_one_device(self):
+        self.write_rules([{"name": "warming", "type": "rate", "metric": "temperature", "above": 2}], 1)
+        engine = RuleEngine(self.path)
+
+        self.assertEqual(self.evaluate(engine, 20, timestamp=0), [])
+        self.assertEqual(self.evaluate(engine, 21, timestamp=60), [])
+        self.assertEqual(self.evaluate(engine, 20, device_id="device-2", timestamp=90), [])
+        self.assertEqual(self.evaluate(engine, 23, timestamp=90), ["warming"])
+        self.assertEqual(self.evaluate(engine, 30, timestamp=80), [])
+
+    def test_hysteresis_rules_stay_on_until_the_clear_level(self):
+        self.write_rules(
+            [{"name": "hot", "type": "hysteresis", "metric": "temperature", "above": 30, "clear_below": 25}],
+            1,
+        )
+        engine = RuleEngine(self.path)
+
+        hits = [bool(self.evaluate(engine, value)) for value in (28, 31, 27, 26, 24, 28)]
+        self.assertEqual(hits, [False, True, True, True, False, False])
+
+    def test_invalid_rules_are_rejected_when_compiled(self):
+        for spec in (
+            {"metric": "pressure", "above": 1},
+            {"type": "spike", "metric": "temperature", "above": 1},
+            {"metric": "temperature"},
+            {"type": "hysteresis", "metric": "temperature", "above": 30, "clear_below": 35},
+            {"type": "rate", "metric": "humidity", "above": 1, "per": 0},
+        ):
+            with self.subTest(spec=spec), self.assertRaises(ValueError):
+                compile_rules([spec])
+
+    def test_reload_swaps_changed_rules_and_keeps_state_of_unchanged_ones(self):
+        hysteresis = {"name": "hot", "type": "hysteresis", "metric": "temperature", "above": 30, "clear_below": 25}
+        self.write_rules([hysteresis], 1)
+        engine = RuleEngine(self.path)
+        self.assertEqual(self.evaluate(engine, 31), ["hot"])
+        self.assertFalse(engine.reload())
+
+        self.write_rules([hysteresis, {"name": "humid", "metric": "humidity", "above": 60}], 2)
+        self.assertTrue(engine.reload())
+        self.assertEqual(self.evaluate(engine, 28, 70), ["hot", "humid"])
+
+    def test_a_broken_rules_file_keeps_the_current_rules(self):
+        self.write_rules([{"name": "hot", "metric": "temperature", "above": 30}], 1)
+        engine = RuleEngine(self.path)
+
+        self.write_rules([{"name": "hot", "metric": "temperature"}], 2)
+        with self.assertLogs("rules", "ERROR"):
+            self.assertFalse(engine.reload())
+        self.assertFalse(engine.reload())
+        self.assertEqual(self.evaluate(engine, 31), ["hot"])
+
+
+if __name__ == "__main__":
+    unittest.main()
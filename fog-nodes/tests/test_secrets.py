@@ -4,7 +4,7 @@ import unittest
 from pathlib import Path
 from unittest.mock import patch
 
-from utils import get_secret
+from utils import get_region_secret, get_secret
 
 
 class SecretReaderTests(unittest.TestCase):
@@ -29,5 +29,16 @@ class SecretReaderTests(unittest.TestCase):
                 self.assertEqual(get_secret("TEST_SECRET"), "from-file")
 
 
+class RegionSettingTests(unittest.TestCase):
+    def test_region_override_takes_precedence_over_the_shared_value(self):
+        with patch.dict(
+            os.environ,
+            {"TEST_USER": "fog-shared", "TEST_USER_US915_0": "fog-us915"},
+            clear=False,
+        ):
+            self.assertEqual(get_region_secret("TEST_USER", "us915_0"), "fog-us915")
+            self.assertEqual(get_region_secret("TEST_USER", "eu868"), "fog-shared")
+
+
 if __name__ == "__main__":
     unittest.main()
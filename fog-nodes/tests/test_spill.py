@@ -0,0 +1,170 @@
+import os
+import tempfile
+import unittest
+import uuid
+
+from prometheus_client import REGISTRY
+import redis
+
+from aggregation_store import Reading, RedisAggregationStore
+from spill import SpillLog
+from tests.test_aggregation_store import _redis_test_client
+
+
+class FakeStore:
+    def __init__(self, error=None, fail_after=None, failures=None):
+        self.error = error
+        self.fail_after = fail_after
+        self.failures = failures or {}
+        self.batches = []
+
+    def update_many(self, readings, raise_on_error=True):
+        if self.error:
+            raise self.error
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise redis.ConnectionError("down again")
+        self.batches.append(list(readings))
+        return [self.failures.get(reading.reading_id, True) for reading in readings]
+
+
+def _reading(index, region="eu868"):
+    return Reading(f"device-{index}", "Sensor", region, 20.5, 50, False, f"reading-{index}", None)
+
+
+class SpillLogTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "spill.log")
+
+    def open_log(self, **options):
+        spill_log = SpillLog().configure(self.path, **options)
+        self.addCleanup(spill_log.close)
+        return spill_log
+
+    def test_spilled_readings_are_replayed_in_batches(self):
+        spill_log = self.open_log(replay_batch_size=2)
+        for index in range(3):
+            self.assertTrue(spill_log.spill(_reading(index), redis.ConnectionError("down")))
+        store = FakeStore()
+
+        self.assertEqual(spill_log.replay(store), 3)
+        self.assertEqual([len(batch) for batch in store.batches], [2, 1])
+        self.assertEqual(store.batches[0][0], _reading(0))
+        self.assertEqual(spill_log.pending_bytes(), 0)
+
+    def test_readings_stay_in_the_log_while_redis_is_down(self):
+        spill_log = self.open_log()
+        spill_log.append(_reading(1))
+
+        self.assertEqual(spill_log.replay(FakeStore(redis.ConnectionError("down"))), 0)
+        self.assertGreater(spill_log.pending_bytes(), 0)
+        self.assertEqual(spill_log.replay(FakeStore()), 1)
+
+    def test_pending_readings_survive_a_restart(self):
+        spill_log = self.open_log()
+        spill_log.append(_reading(1))
+        spill_log.close()
+
+        store = FakeStore()
+        self.assertEqual(self.open_log().replay(store), 1)
+        self.assertEqual(store.batches, [[_reading(1)]])
+
+    def test_only_redis_outages_are_spilled(self):
+        spill_log = self.open_log()
+        self.assertFalse(spill_log.spill(_reading(1), ValueError("bad reading")))
+        self.assertFalse(SpillLog().spill(_reading(1), redis.ConnectionError("down")))
+        self.assertEqual(spill_log.pending_bytes(), 0)
+
+    def test_a_full_log_rejects_readings_and_compacts_after_replay(self):
+        spill_log = self.open_log(max_bytes=8192)
+        appended = 0
+        while spill_log.append(_reading(appended)):
+            appended += 1
+        self.assertGreater(appended, 50)
+
+        # Redis fails again after one batch of two thirds of the log
+        spill_log.replay_batch_size = appended * 2 // 3
+        store = FakeStore(fail_after=1)
+        self.assertEqual(spill_log.replay(store), appended * 2 // 3)
+        self.assertTrue(spill_log.append(_reading(appended)))
+
+        store = FakeStore()
+        spill_log.replay_batch_size = appended
+        spill_log.replay(store)
+        self.assertEqual(
+            store.batches,
+            [[_reading(index) for index in range(appended * 2 // 3, appended + 1)]],
+        )
+
+    def test_readings_that_fail_again_are_kept_without_resending_their_batch(self):
+        spill_log = self.open_log()
+        for index in range(3):
+            spill_log.append(_reading(index))
+        store = FakeStore(failures={"reading-1": redis.ConnectionError("down again")})
+
+        self.assertEqual(spill_log.replay(store), 2)
+        self.assertEqual(store.batches, [[_reading(0), _reading(1), _reading(2)]])
+
+        store = FakeStore()
+        self.assertEqual(spill_log.replay(store), 1)
+        self.assertEqual(store.batches, [[_reading(1)]])
+        self.assertEqual(spill_log.pending_bytes(), 0)
+
+    def test_rejected_readings_are_discarded_instead_of_blocking_the_log(self):
+        spill_log = self.open_log()
+        for index in range(3):
+            spill_log.append(_reading(index))
+        discarded = REGISTRY.get_sample_value(
+            "fog_spill_discarded_readings_total", {"region": "eu868"}
+        ) or 0
+
+        store = FakeStore(failures={"reading-1": redis.ResponseError("script error")})
+        self.assertEqual(spill_log.replay(store), 2)
+        self.assertEqual(spill_log.pending_bytes(), 0)
+
+        spill_log.append(_reading(3))
+        self.assertEqual(spill_log.replay(FakeStore(ValueError("bad batch"))), 0)
+        self.assertEqual(spill_log.pending_bytes(), 0)
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                "fog_spill_discarded_readings_total", {"region": "eu868"}
+            ),
+            discarded + 2,
+        )
+
+    def test_one_log_file_per_process(self):
+        self.open_log()
+        with self.assertRaises(RuntimeError):
+            SpillLog().configure(self.path)
+
+
+class SpillReplayIntegrationTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.client = _redis_test_client()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.spill_log = SpillLog().configure(os.path.join(directory.name, "spill.log"))
+        self.addCleanup(self.spill_log.close)
+        self.prefix = f"test:sensiot:{uuid.uuid4().hex}"
+        self.store = RedisAggregationStore(self.client, prefix=self.prefix, deduplication_ttl=60)
+
+    def tearDown(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def test_replayed_readings_are_deduplicated(self):
+        self.store.update_many([_reading(1)])
+        self.spill_log.append(_reading(1))
+        self.spill_log.append(_reading(2))
+
+        self.assertEqual(self.spill_log.replay(self.store), 2)
+        self.assertEqual(self.store.update_many([_reading(1), _reading(2)]), [False, False])
+
+
+if __name__ == "__main__":
+    unittest.main()
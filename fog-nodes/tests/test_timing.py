@@ -0,0 +1,49 @@
+import unittest
+from unittest import mock
+
+from prometheus_client import CollectorRegistry, Histogram
+
+from timing import StageTimers
+
+
+class StageTimersTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.histogram = Histogram(
+            "test_stage_duration_seconds", "Test stages", ["region", "stage"],
+            registry=self.registry,
+        )
+
+    def count(self, region, stage):
+        return self.registry.get_sample_value(
+            "test_stage_duration_seconds_count", {"region": region, "stage": stage}
+        )
+
+    def test_stages_are_observed_per_region(self):
+        timers = StageTimers(self.histogram)
+        with mock.patch("timing.time.perf_counter", side_effect=[10.0, 10.25, 11.0, 11.5]):
+            timers.observe("eu868", "decode", timers.start())
+            timers.observe("eu868", "decode", timers.start())
+
+        self.assertEqual(self.count("eu868", "decode"), 2)
+        self.assertEqual(
+            self.registry.get_sample_value(
+                "test_stage_duration_seconds_sum", {"region": "eu868", "stage": "decode"}
+            ),
+            0.75,
+        )
+        self.assertIsNone(self.count("us915_0", "decode"))
+
+    def test_disabled_timers_never_read_the_clock(self):
+        timers = StageTimers(self.histogram, enabled=False)
+        with mock.patch("timing.time.perf_counter") as perf_counter:
+            started = timers.start()
+            timers.observe("eu868", "decode", started)
+
+        self.assertIsNone(started)
+        perf_counter.assert_not_called()
+        self.assertIsNone(self.count("eu868", "decode"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import json
+import unittest
+from datetime import datetime, timezone
+
+from mqtt_client import handle_message
+from uplink import UplinkRecord, decode_uplink
+from utils import is_valid_payload
+
+UPLINK = {
+    "deduplicationId": "reading-1",
+    "deviceInfo": {"devEui": "0101010101010142", "deviceName": "Sensor 42"},
+    "object": {"temperature": "36.5", "humidity": 51.2},
+    "regionConfigId": "EU868",
+    "rxInfo": [{"nsTime": "2026-10-18T13:08:31.215408123+00:00"}],
+}
+
+
+class RecordingStore:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, *args, **kwargs):
+        self.updates.append((args, kwargs))
+        return True
+
+
+class DecodeUplinkTests(unittest.TestCase):
+    def test_decodes_every_field_in_one_pass(self):
+        record = decode_uplink(json.dumps(UPLINK).encode("utf-8"), "region/eu868/up")
+
+        self.assertIsInstance(record, UplinkRecord)
+        self.assertFalse(hasattr(record, "__dict__"))
+        self.assertEqual(record.device_id, "0101010101010142")
+        self.assertEqual(record.device_name, "Sensor 42")
+        self.assertEqual(record.region_config_id, "EU868")
+        self.assertEqual(record.region, "eu868")
+        self.assertEqual(record.topic_region, "eu868")
+        self.assertEqual(record.ns_time, UPLINK["rxInfo"][0]["nsTime"])
+        self.assertEqual((record.temperature, record.humidity), (36.5, 51.2))
+        self.assertTrue(record.valid)
+        self.assertEqual(record.reading_id, "reading-1")
+        self.assertEqual(record.event_time, record.ns_time)
+
+    def test_uplink_time_takes_precedence_as_event_time(self):
+        record = decode_uplink(dict(UPLINK, time="2026-10-18T13:08:30+00:00"))
+
+        self.assertEqual(record.event_time, "2026-10-18T13:08:30+00:00")
+
+    def test_missing_or_out_of_range_values_are_invalid(self):
+        for sensor_data in (
+            {"temperature": 20},
+            {"temperature": "warm", "humidity": 40},
+            {"temperature": 20, "humidity": 140},
+        ):
+            with self.subTest(sensor_data=sensor_data):
+                payload = dict(UPLINK, object=sensor_data)
+                self.assertFalse(decode_uplink(payload).valid)
+                self.assertFalse(is_valid_payload(payload))
+
+    def test_non_object_payload_is_rejected(self):
+        with self.assertRaises(ValueError):
+            decode_uplink(b"[1, 2]")
+
+
+class HandleMessageTests(unittest.TestCase):
+    def handle(self, payload, topic="region/eu868/up"):
+        store = RecordingStore()
+        handle_message(
+            {"region": "eu868", "aggregation_store": store},
+            topic,
+            json.dumps(payload).encode("utf-8"),
+            datetime.now(timezone.utc),
+        )
+        return store.updates
+
+    def test_valid_uplink_is_aggregated_with_converted_values(self):
+        updates = self.handle(UPLINK)
+
+        self.assertEqual(
+            updates,
+            [
+                (
+                    ("0101010101010142", "Sensor 42", "EU868", 36.5, 51.2, True),
+                    {
+                        "reading_id": "reading-1",
+                        "event_time": datetime(
+                            2026, 10, 18, 13, 8, 31, 215408, tzinfo=timezone.utc
+                        ).timestamp(),
+                    },
+                )
+            ],
+        )
+
+    def test_region_mismatch_and_invalid_values_are_dropped(self):
+        self.assertEqual(self.handle(UPLINK, "region/us915/up"), [])
+        self.assertEqual(self.handle(dict(UPLINK, object={"temperature": 20})), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
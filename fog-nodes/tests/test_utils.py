@@ -0,0 +1,34 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from utils import region_subscription, wait_for_stopped_thread
+
+
+class RegionSubscriptionTests(unittest.TestCase):
+    def test_subscription_templates_are_filled_per_region(self):
+        self.assertEqual(
+            region_subscription("eu868"), "$share/fog-eu868/region/eu868/#"
+        )
+        self.assertEqual(
+            region_subscription("in865", "fog-all", "$share/{shared_group}/region/{region}/+"),
+            "$share/fog-all/region/in865/+",
+        )
+
+
+class ThreadSupervisionTests(unittest.TestCase):
+    def test_returns_the_first_thread_that_stops(self):
+        release = threading.Event()
+        running = threading.Thread(target=release.wait, daemon=True)
+        failing = threading.Thread(target=lambda: 1 / 0, name="aggregation-worker-eu868")
+        running.start()
+        with patch("threading.excepthook"):
+            failing.start()
+            failing.join()
+
+        self.assertIs(wait_for_stopped_thread([running, failing], poll_interval=0.01), failing)
+        release.set()
+
+
+if __name__ == "__main__":
+    unittest.main()
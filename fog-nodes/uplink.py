@@ -0,0 +1,133 @@
+"""
+Single-pass decoding of ChirpStack uplink events.
+
+``decode_uplink`` parses an MQTT payload once and keeps only the fields the
+pipeline reads. Sensor values are converted and range-checked up front, so
+later stages use ``record.valid`` instead of walking the payload again.
+"""
+import codec
+
+TEMPERATURE_RANGE = (-50, 100)
+HUMIDITY_RANGE = (0, 100)
+
+
+def normalize_region(region):
+    return str(region or "").strip().lower()
+
+
+def extract_topic_region(topic):
+    parts = (topic or "").split("/")
+    if len(parts) >= 2 and parts[0] == "region":
+        return parts[1]
+    return None
+
+
+def read_sensor_values(sensor_data):
+    """
+    Return ``(temperature, humidity)`` as floats, or None when either value is
+    missing, not numeric or outside the accepted range.
+    """
+    try:
+        temperature = sensor_data.get("temperature")
+        humidity = sensor_data.get("humidity")
+        if temperature is None or humidity is None:
+            return None
+        temperature = float(temperature)
+        humidity = float(humidity)
+    except Exception:
+        return None
+    if (
+        TEMPERATURE_RANGE[0] <= temperature <= TEMPERATURE_RANGE[1]
+        and HUMIDITY_RANGE[0] <= humidity <= HUMIDITY_RANGE[1]
+    ):
+        return temperature, humidity
+    return None
+
+
+class UplinkRecord:
+    """The fields of one uplink that the fog pipeline uses."""
+
+    __slots__ = (
+        "device_id",
+        "device_name",
+        "region_config_id",
+        "region",
+        "topic_region",
+        "ns_time",
+        "event_time",
+        "sensor_data",
+        "temperature",
+        "humidity",
+        "valid",
+        "reading_id",
+        "device_class",
+    )
+
+    def __init__(
+        self,
+        device_id,
+        device_name,
+        region_config_id,
+        topic_region,
+        ns_time,
+        sensor_data,
+        temperature,
+        humidity,
+        reading_id=None,
+        event_time=None,
+        device_class=None,
+    ):
+        self.device_id = device_id
+        self.device_name = device_name
+        self.region_config_id = region_config_id
+        self.region = normalize_region(region_config_id)
+        self.topic_region = topic_region
+        self.ns_time = ns_time
+        self.sensor_data = sensor_data
+        self.temperature = temperature
+        self.humidity = humidity
+        self.valid = temperature is not None
+        self.reading_id = reading_id
+        # The uplink's own time when the gateway reported one, else nsTime
+        self.event_time = event_time or ns_time
+        # The ChirpStack device profile, which event rules can be scoped to
+        self.device_class = str(device_class).strip().lower() if device_class else None
+
+    def __repr__(self):
+        return (
+            f"UplinkRecord(device_id={self.device_id!r}, region={self.region!r}, "
+            f"temperature={self.temperature!r}, humidity={self.humidity!r}, "
+            f"valid={self.valid!r}, reading_id={self.reading_id!r})"
+        )
+
+
+def decode_uplink(raw_payload, topic=None):
+    """
+    Decode an uplink from its raw MQTT payload, or from an already parsed dict.
+    Raises ValueError when the payload is not a JSON object.
+    """
+    if isinstance(raw_payload, dict):
+        payload = raw_payload
+    else:
+        payload = codec.loads(raw_payload)
+        if not isinstance(payload, dict):
+            raise ValueError("Uplink payload is not a JSON object")
+
+    device_info = payload.get("deviceInfo") or {}
+    rx_info = payload.get("rxInfo") or [{}]
+    sensor_data = payload.get("object", payload)
+    values = read_sensor_values(sensor_data)
+    temperature, humidity = values if values is not None else (None, None)
+    return UplinkRecord(
+        device_info.get("devEui", "unknown"),
+        device_info.get("deviceName", "unknown"),
+        payload.get("regionConfigId", "unknown"),
+        extract_topic_region(topic),
+        rx_info[0].get("nsTime"),
+        sensor_data,
+        temperature,
+        humidity,
+        payload.get("deduplicationId"),
+        payload.get("time"),
+        device_info.get("deviceProfileName"),
+    )
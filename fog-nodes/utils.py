@@ -1,6 +1,10 @@
 import os
+import re
+import time
 from datetime import datetime
 
+from uplink import read_sensor_values
+
 
 def get_secret(name, default=None):
     """Read a value from an environment variable or its Docker secret file."""
@@ -14,6 +18,31 @@ def get_secret(name, default=None):
     with open(secret_path, "r", encoding="utf-8") as secret_file:
         return secret_file.read().strip()
 
+def get_region_secret(name, region, default=None):
+    """
+    Read a per-region override such as ``MQTT_PASSWORD_US915_0``, falling back
+    to ``name`` when the region has none.
+    """
+    suffix = re.sub(r"[^A-Z0-9]", "_", region.upper())
+    return get_secret(f"{name}_{suffix}", get_secret(name, default))
+
+def region_subscription(
+    region,
+    shared_group="fog-{region}",
+    topic="$share/{shared_group}/region/{region}/#",
+):
+    """Return the shared-subscription topic of ``region`` from its templates."""
+    shared_group = shared_group.format(region=region)
+    return topic.format(shared_group=shared_group, region=region)
+
+def wait_for_stopped_thread(threads, poll_interval=1):
+    """Block until one of ``threads`` is no longer alive and return it."""
+    while True:
+        for thread in threads:
+            if not thread.is_alive():
+                return thread
+        time.sleep(poll_interval)
+
 def parse_iso_timestamp(ts_str):
     """
     Parse an ISO 8601 timestamp, truncating fractional seconds to 6 digits if necessary.
@@ -50,12 +79,6 @@ def is_valid_payload(payload):
     """
     try:
         sensor_data = payload.get("object", payload)
-        temp = sensor_data.get("temperature")
-        hum = sensor_data.get("humidity")
-        if temp is None or hum is None:
-            return False
-        temp = float(temp)
-        hum = float(hum)
-        return -50 <= temp <= 100 and 0 <= hum <= 100
     except Exception:
         return False
+    return read_sensor_values(sensor_data) is not None